@@ -1,68 +1,231 @@
 #!/usr/bin/env python
 # -*- coding:utf-8
+"""
+Decrypt the FTP credentials of CZDAP.
+
+Run as a script, this fetches the credentials with the token in config.json and prints
+them as CSV. Imported, decrypt_all() decrypts a list of credentials as returned by the
+CZDAP API:
+
+  import decrypt
+  key = decrypt.load_key('czdap.private.key')
+  for (host, username, password) in decrypt.decrypt_all(credsData, key, 'credentials.cache'):
+    ...
+
+RSA decryption is spread over a process pool for large sets of credentials. With a cache
+file, credentials whose ciphertext did not change since the last run are taken from the
+cache instead of being decrypted again. The cache is encrypted and authenticated with keys
+derived from the private key (AES-CTR and HMAC-SHA256), so it reveals nothing to whoever
+does not have that key, and entries that do not verify are decrypted again.
+"""
 
 from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_v1_5
-import requests
+from Crypto.Cipher import PKCS1_v1_5, AES
+from Crypto.Util import Counter
+import multiprocessing
+import hashlib
+import hmac
 import json
 import base64
+import os
 import sys
 
-# Create a session
-s = requests.Session()
-
-# Load the config file and validate.
-try:
-  configFile = open("config.json", "r")
-  config = json.load(configFile)
-  configFile.close()
-except:
-  sys.stderr.write("Error loading config.json file.\n")
-  exit(1)
-if not config.has_key('token'):
-  sys.stderr.write("'token' parameter not found in the config.json file\n")
-  exit(1)
-if not config.has_key('base_url'):
-  sys.stderr.write("'base_url' parameter not found in the config.json file\n")
-  exit(1)
-
-# For development purposes, we sometimes run this against an environment with
-# basic auth and a self-signed certificate. If these params are present, use
-# them. If you're not a developer working on CZDAP itself, ignore these.
-if config.has_key('auth_user') and config.has_key('auth_pass'):
-  s.auth = (config['auth_user'], config['auth_pass'])
-if config.has_key('ssl_skip_verify'):
-  s.verify = False
-
-# Load the private key.
-try:
-  privateKeyFile = open("czdap.private.key", "r")
-  key = RSA.importKey(privateKeyFile.read())
-  cipher = PKCS1_v1_5.new(key)
-  privateKeyFile.close()
-except:
-  sys.stderr.write("Error loading private key from file 'czdap.private.key'. Please copy your key into this directory.\n")
-  exit(1)
-
-# Get the credentials JSON from CZDAP API.
-r = s.get(config['base_url'] + '/user-credentials.json?token=' + config['token'])
-if r.status_code != 200:
-  sys.stderr.write("Unexpected response from CZDAP. Are you sure your token and base_url are correct in config.json?\n")
-  exit(1)
-try:
-  credsData = json.loads(r.text)
-except:
-  sys.stderr.write("Unable to parse JSON returned from CZDAP.\n")
-  exit(1)
-
-# Decrypt and output.
-print "server,username,password"
-for creds in credsData:
-  piecesJSON = cipher.decrypt(base64.b64decode(creds['credentials']), 0)
-  if not piecesJSON:
-    print "\nError: Decryption failed, do you have the correct keyfile?"
+# A credential takes about a millisecond to decrypt with a 2048 bit key. Below this many,
+# starting the processes takes longer than the work.
+PARALLEL_THRESHOLD = 200
+CACHE_VERSION = 1
+
+
+class DecryptError(Exception):
+  pass
+
+
+def load_key(keyFilename = "czdap.private.key"):
+  """ the RSA private key in keyFilename """
+  with open(keyFilename, "r") as privateKeyFile:
+    return RSA.importKey(privateKeyFile.read())
+
+
+def decrypt_one(cipher, ciphertext):
+  """ the credentials JSON of one base64 ciphertext, or None if it does not decrypt """
+  try:
+    return cipher.decrypt(base64.b64decode(ciphertext), 0) or None
+  except (TypeError, ValueError):
+    return None
+
+
+# Cipher of the pool processes, made once per process from the exported key.
+_cipher = None
+
+
+def _init_worker(keyData):
+  global _cipher
+  _cipher = PKCS1_v1_5.new(RSA.importKey(keyData))
+
+
+def _decrypt_worker(ciphertext):
+  return decrypt_one(_cipher, ciphertext)
+
+
+class CredentialsCache(object):
+  """ Decrypted credentials by SHA-256 of their ciphertext, kept encrypted in a file """
+
+  def __init__(self, filename, key):
+    self.filename = filename
+    secret = key.exportKey('DER')
+    self.encryptKey = hmac.new(secret, b'czdap credentials cache: encrypt', hashlib.sha256).digest()
+    self.macKey = hmac.new(secret, b'czdap credentials cache: authenticate', hashlib.sha256).digest()
+    self.entries = {}
+    self.load()
+
+  @staticmethod
+  def digest(ciphertext):
+    return hashlib.sha256(ciphertext.encode('ascii')).hexdigest()
+
+  def load(self):
+    if not self.filename or not os.path.exists(self.filename):
+      return
+    try:
+      with open(self.filename, "r") as cacheFile:
+        data = json.load(cacheFile)
+    except ValueError:
+      return
+    if data.get('version') == CACHE_VERSION:
+      self.entries = data.get('entries', {})
+
+  def save(self, digests):
+    """ write the entries of digests, which drops the credentials that are gone """
+    if not self.filename:
+      return
+    entries = dict((digest, self.entries[digest]) for digest in digests if digest in self.entries)
+    tmpFilename = self.filename + '.tmp'
+    fd = os.open(tmpFilename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as cacheFile:
+      json.dump({'version': CACHE_VERSION, 'entries': entries}, cacheFile, indent = 1, sort_keys = True)
+    os.rename(tmpFilename, self.filename)
+    self.entries = entries
+
+  def cipher(self, nonce):
+    return AES.new(self.encryptKey, AES.MODE_CTR, counter = Counter.new(64, prefix = nonce))
+
+  def get(self, digest):
+    """ the cached plaintext for digest, or None if there is none or it does not verify """
+    try:
+      blob = base64.b64decode(self.entries[digest])
+    except (KeyError, TypeError, ValueError):
+      return None
+    if len(blob) < 40:
+      return None
+    (nonce, ciphertext, tag) = (blob[:8], blob[8:-32], blob[-32:])
+    expected = hmac.new(self.macKey, digest.encode('ascii') + nonce + ciphertext, hashlib.sha256).digest()
+    if not hmac.compare_digest(tag, expected):
+      return None
+    return self.cipher(nonce).decrypt(ciphertext)
+
+  def put(self, digest, plaintext):
+    nonce = os.urandom(8)
+    ciphertext = self.cipher(nonce).encrypt(plaintext)
+    tag = hmac.new(self.macKey, digest.encode('ascii') + nonce + ciphertext, hashlib.sha256).digest()
+    self.entries[digest] = base64.b64encode(nonce + ciphertext + tag).decode('ascii')
+
+
+def decrypt_all(credsData, key, cacheFilename = None, processes = None):
+  """
+  Decrypt credentials as returned by the CZDAP API, a list of {'host', 'credentials'}.
+  Returns a list of (host, username, password) in the same order. Raises DecryptError
+  if any of them does not decrypt with key.
+  """
+  cache = CredentialsCache(cacheFilename, key)
+  digests = [cache.digest(creds['credentials']) for creds in credsData]
+  plaintexts = [cache.get(digest) for digest in digests]
+
+  pending = [i for (i, plaintext) in enumerate(plaintexts) if plaintext is None]
+  ciphertexts = [credsData[i]['credentials'] for i in pending]
+  processes = processes or multiprocessing.cpu_count()
+  if processes > 1 and len(pending) >= PARALLEL_THRESHOLD:
+    pool = multiprocessing.Pool(processes, _init_worker, (key.exportKey(),))
+    try:
+      results = pool.map(_decrypt_worker, ciphertexts, max(1, len(ciphertexts) // (processes * 4)))
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    cipher = PKCS1_v1_5.new(key)
+    results = [decrypt_one(cipher, ciphertext) for ciphertext in ciphertexts]
+
+  for (i, plaintext) in zip(pending, results):
+    if plaintext is None:
+      raise DecryptError("Decryption failed for '" + credsData[i]['host'] + "', do you have the correct keyfile?")
+    cache.put(digests[i], plaintext)
+    plaintexts[i] = plaintext
+  cache.save(digests)
+
+  credentials = []
+  for (creds, piecesJSON) in zip(credsData, plaintexts):
+    pieces = json.loads(piecesJSON.decode('utf-8'))
+    username = base64.b64decode(pieces[0]).decode('utf-8')
+    password = base64.b64decode(pieces[1]).decode('utf-8')
+    credentials.append((creds['host'], username, password))
+  return credentials
+
+
+def main():
+  import requests
+
+  # Create a session
+  s = requests.Session()
+
+  # Load the config file and validate.
+  try:
+    configFile = open("config.json", "r")
+    config = json.load(configFile)
+    configFile.close()
+  except:
+    sys.stderr.write("Error loading config.json file.\n")
+    exit(1)
+  if 'token' not in config:
+    sys.stderr.write("'token' parameter not found in the config.json file\n")
     exit(1)
-  pieces = json.loads(piecesJSON)
-  username = unicode(base64.b64decode(pieces[0]), "utf-8")
-  password = unicode(base64.b64decode(pieces[1]), "utf-8")
-  print ",".join([creds['host'],username,password])
+  if 'base_url' not in config:
+    sys.stderr.write("'base_url' parameter not found in the config.json file\n")
+    exit(1)
+
+  # For development purposes, we sometimes run this against an environment with
+  # basic auth and a self-signed certificate. If these params are present, use
+  # them. If you're not a developer working on CZDAP itself, ignore these.
+  if 'auth_user' in config and 'auth_pass' in config:
+    s.auth = (config['auth_user'], config['auth_pass'])
+  if 'ssl_skip_verify' in config:
+    s.verify = False
+
+  # Load the private key.
+  try:
+    key = load_key("czdap.private.key")
+  except:
+    sys.stderr.write("Error loading private key from file 'czdap.private.key'. Please copy your key into this directory.\n")
+    exit(1)
+
+  # Get the credentials JSON from CZDAP API.
+  r = s.get(config['base_url'] + '/user-credentials.json?token=' + config['token'])
+  if r.status_code != 200:
+    sys.stderr.write("Unexpected response from CZDAP. Are you sure your token and base_url are correct in config.json?\n")
+    exit(1)
+  try:
+    credsData = json.loads(r.text)
+  except:
+    sys.stderr.write("Unable to parse JSON returned from CZDAP.\n")
+    exit(1)
+
+  # Decrypt and output.
+  print("server,username,password")
+  try:
+    credentials = decrypt_all(credsData, key, config.get('cache_file'), config.get('processes'))
+  except DecryptError as e:
+    print("\nError: " + str(e))
+    exit(1)
+  for creds in credentials:
+    print(",".join(creds))
+
+
+if __name__ == "__main__":
+  main()
@@ -1,28 +1,29 @@
 #!/usr/bin/env python
 # -*- coding:utf-8
 
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_v1_5
+import os
+import sys
 import json
-import base64
+import tempfile
 
-privateKeyFile = open("czdap.private.key", "r")
-key = RSA.importKey(privateKeyFile.read())
-cipher = PKCS1_v1_5.new(key)
-privateKeyFile.close()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import decrypt
+
+key = decrypt.load_key("czdap.private.key")
 
 credsFile = open("credentials.json", "r")
 credsData = json.load(credsFile)
 credsFile.close()
 
-print "server,username,password"
+# Decrypt twice with a cache: the second run takes all credentials from the cache.
+cacheFilename = os.path.join(tempfile.mkdtemp(), "credentials.cache")
+credentials = decrypt.decrypt_all(credsData, key, cacheFilename)
+if decrypt.decrypt_all(credsData, key, cacheFilename) != credentials:
+  print("\nError: Credentials from the cache differ")
+  exit(1)
+os.remove(cacheFilename)
+os.rmdir(os.path.dirname(cacheFilename))
 
-for creds in credsData:
-  piecesJSON = cipher.decrypt(base64.b64decode(creds['credentials']), 0)
-  if not piecesJSON:
-    print "\nError: Decryption failed, do you have the correct keyfile?"
-    exit(1)
-  pieces = json.loads(piecesJSON)
-  username = unicode(base64.b64decode(pieces[0]), "utf-8")
-  password = unicode(base64.b64decode(pieces[1]), "utf-8")
-  print ",".join([creds['host'],username,password])
+print("server,username,password")
+for creds in credentials:
+  print(",".join(creds))
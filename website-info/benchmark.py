@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding:utf-8
+""" Micro-benchmark of the extraction of records from the pages of the CZDS website, on the
+    saved pages in fixtures/: the regular expressions info.py used to search the whole page
+    with, against the single pass of czdspages.py. Both have to give the same records.
+"""
+import argparse, datetime, os, re, sys, time, HTMLParser
+import czdspages
+
+
+class RegexExtraction(object):
+    """ the extraction as info.py did it before czdspages
+    """
+    ignore_tlds = [ 'TEST', 'test2' ]
+
+    open_tlds_re = re.compile("""<div class="form-item form-type-checkbox form-item-tlds-fieldset-tld-.+?">\s*<input(.+?)/>\s*<label.+?>(.+?)\s*<""", re.DOTALL)
+    open_tld_ipt_name_re = re.compile('name="([^"]+)"')
+    open_tld_ipt_class_re = re.compile('class="([^"]+)"')
+    request_table_re = re.compile("""<table.+?class=".*?my-requests[^"]*">(.+?)<\/table>""", re.DOTALL)
+    table_tr_re = re.compile("""<tr[^>]*>(.+?)</tr>""", re.DOTALL)
+    table_td_re = re.compile("""<td[^>]*>\s*(.*?)\s*</td>""", re.DOTALL | re.M)
+    a_re = re.compile("""<a.+?href=["|'](.+?)["|'][^>]*>(.+?)</a>""", re.DOTALL)
+    pager_last_page_re = re.compile("""<ul class="pager">.+?<li class="pager-current last">.+?<\/ul>""", re.DOTALL)
+    request_info_re = re.compile("""<div class="title-request"[^>]*>(.+?):<\/div>.+?<div class="field-request"[^>]*>(.+?)<\/div>""", re.DOTALL)
+    request_info_history_re = re.compile("""history-request">.+?<table[^>]+>(.+?)<\/table>""", re.DOTALL)
+
+    @staticmethod
+    def remove_tags(text):
+        h = HTMLParser.HTMLParser()
+        TAG_RE = re.compile(r'<[^>]+>')
+        return h.unescape(TAG_RE.sub('', text))
+
+    def dashboard(self, body):
+        tableMatch = self.request_table_re.search(body)
+        data = []
+        table = tableMatch.group(1)
+        for row in self.table_tr_re.findall(table):
+            cols = self.table_td_re.findall(row)
+            if not cols:
+                continue
+            (lnk, zone) = self.a_re.search(cols[0]).groups()
+            if zone in self.ignore_tlds:
+                continue
+            request_id = re.search('request/(\d+)', lnk).group(1)
+            request_date = datetime.datetime.strptime(cols[1], "%d %B %Y")
+            data.append({
+                'id': request_id,
+                'date': request_date,
+                'zone': zone.strip().lower(),
+                'status': cols[2]
+            })
+        lastPage = False
+        if self.pager_last_page_re.search(body):
+            lastPage = True
+        return (data, lastPage)
+
+    def request(self, body):
+        data = {}
+        for kv in self.request_info_re.findall(body):
+            (ky, vl) = kv
+            if 'IP address' in ky:
+                ips = []
+                for ip in vl.split('<br/>'):
+                    ip = self.remove_tags(ip)
+                    if ip:
+                        ips.append(ip)
+                vl = ips
+            elif 'Expires' in ky:
+                vl = datetime.datetime.strptime(vl, "%d %B %Y, %H:%M:%S %Z")
+            else:
+                vl = self.remove_tags(vl).strip()
+            data[ky.strip().lower()] = vl
+        tableMatch = self.request_info_history_re.search(body)
+        data['history'] = []
+        table = tableMatch.group(1)
+        for row in self.table_tr_re.findall(table):
+            cols = self.table_td_re.findall(row)
+            if not cols:
+                continue
+            history_date = datetime.datetime.strptime(cols[0], "%d %B %Y, %H:%M:%S %Z")
+            data['history'].append({
+                'date': history_date,
+                'user': cols[1].strip(),
+                'action': self.remove_tags(cols[2]).strip(),
+                'response':  self.remove_tags(cols[3]).strip()
+            })
+        return data
+
+    def request_add(self, body):
+        data = {}
+        for option in self.open_tlds_re.findall(body):
+            (ipt, tld) = option
+            if tld in self.ignore_tlds or tld == 'All TLDs':
+                continue
+            (name, ) = self.open_tld_ipt_name_re.findall(ipt)
+            (cls, ) = self.open_tld_ipt_class_re.findall(ipt)
+            ky = cls.replace('form-checkbox', '').strip()
+            if ky == '' :
+                ky = 'open'
+            if not ky in data:
+                data[ky] = []
+            data[ky].append((name, tld))
+        return data
+
+
+def best_of(function, body, repeat):
+    """ the fastest of repeat runs, in seconds, and the result
+    """
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        result = function(body)
+        seconds = time.time() - started
+        if best is None or seconds < best:
+            best = seconds
+    return (best, result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the extraction of records from CZDS website pages')
+    parser.add_argument('--fixtures', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                    'fixtures'), help='folder with the saved pages')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per page, the fastest counts')
+    args = parser.parse_args()
+
+    regex = RegexExtraction()
+    pages = [
+        ('dashboard.html', regex.dashboard,
+         lambda body: czdspages.parse_dashboard(body, RegexExtraction.ignore_tlds)[:2]),
+        ('request.html', regex.request, czdspages.parse_request),
+        ('request-add.html', regex.request_add,
+         lambda body: czdspages.parse_request_add(body, RegexExtraction.ignore_tlds)),
+    ]
+    failed = False
+    print '%-18s %10s %12s %12s %8s' % ('page', 'bytes', 'regex ms', 'single ms', 'speedup')
+    for (name, old, new) in pages:
+        body = open(os.path.join(args.fixtures, name)).read()
+        (old_seconds, old_result) = best_of(old, body, args.repeat)
+        (new_seconds, new_result) = best_of(new, body, args.repeat)
+        print '%-18s %10d %12.2f %12.2f %7.1fx' % (name, len(body), old_seconds * 1000, new_seconds * 1000,
+                                                   old_seconds / max(new_seconds, 1e-9))
+        if old_result != new_result:
+            sys.stderr.write('%s: the records differ\n' % name)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
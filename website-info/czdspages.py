@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding:utf-8
+""" Extraction of records from the pages of the CZDS website in a single pass over the HTML.
+
+    Every page type has one precompiled expression that matches only the parts of the page
+    it needs (the rows and cells of a table, the fields of a request, ...), and the page
+    is scanned once with it while a small state machine builds the records. The
+    expressions only use character classes that stop at the next quote, tag or cell end,
+    so they never run ahead into the rest of the page and backtrack out of it, as .+? with
+    DOTALL does. Dates are parsed without strptime, which is slow and depends on the locale.
+"""
+import datetime, re, htmlentitydefs
+
+# every alternative starts with '<', outside of the group, so the scan skips ahead to the
+# next '<' without trying the alternatives anywhere else
+DASHBOARD_RE = re.compile(r'''<(?:
+    table\b[^>]*?\bclass="(?P<table>[^"]*)"
+  | (?P<table_end>/table>)
+  | (?P<row>tr\b)
+  | td\b[^>]*>(?P<cell>[^<]*(?:<(?!/td>)[^<]*)*)</td>
+  | li\s+class="(?P<li>[^"]*)"[^>]*>(?:\s*<a\b[^>]*?\bhref="[^"]*?[?&]page=(?P<page>\d+))?
+)''', re.VERBOSE)
+REQUEST_RE = re.compile(r'''<(?:
+    div\s+class="title-request"[^>]*>(?P<title>[^<]*)</div>
+  | div\s+class="field-request"[^>]*>(?P<field>[^<]*(?:<(?!/div>)[^<]*)*)</div>
+  | div\s+class="(?P<history>[^"]*\bhistory-request)"
+  | table\b(?P<table>)
+  | (?P<table_end>/table>)
+  | (?P<row>tr\b)
+  | td\b[^>]*>(?P<cell>[^<]*(?:<(?!/td>)[^<]*)*)</td>
+)''', re.VERBOSE)
+REQUEST_ADD_RE = re.compile(r'''
+    <div\s+class="form-item\ form-type-checkbox\ form-item-tlds-fieldset-tld-[^"]*">\s*
+    <input(?=[^>]*\bname="(?P<name>[^"]*)")(?=[^>]*\bclass="(?P<class>[^"]*)")[^>]*>\s*
+    <label\b[^>]*>(?P<label>[^<]*)
+''', re.VERBOSE)
+TAG_RE = re.compile(r'<[^>]*>')
+HREF_RE = re.compile(r'''\bhref=["']([^"']*)''')
+BR_RE = re.compile(r'<br\s*/?>')
+ENTITY_RE = re.compile(r'&(#[xX][0-9a-fA-F]+|#[0-9]+|[a-zA-Z][a-zA-Z0-9]*);')
+REQUEST_ID_RE = re.compile(r'request/(\d+)')
+
+MONTHS = dict((month, number) for (number, month) in enumerate(
+    ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November',
+     'December'], 1))
+
+
+class PageError(Exception):
+    pass
+
+
+def replace_entity(match):
+    entity = match.group(1)
+    try:
+        if entity[:2] in ('#x', '#X'):
+            return unichr(int(entity[2:], 16))
+        if entity[0] == '#':
+            return unichr(int(entity[1:]))
+        return unichr(htmlentitydefs.name2codepoint[entity])
+    except (KeyError, ValueError, OverflowError):
+        return match.group(0)
+
+
+def unescape(text):
+    """ text with its character references replaced
+    """
+    if '&' not in text:
+        return text
+    return ENTITY_RE.sub(replace_entity, text.decode('utf-8', 'replace') if isinstance(text, str) else text)
+
+
+def text_of(html):
+    """ the text of a piece of HTML, without its tags and with its white space collapsed
+    """
+    if '<' in html:
+        html = TAG_RE.sub('', html)
+    return unescape(' '.join(html.split()))
+
+
+def parse_date(text):
+    """ a date like '07 March 2014', or with the time: '07 March 2014, 10:21:09 UTC'
+    """
+    try:
+        (day, month, year) = text[:text.index(',')].split() if ',' in text else text.split()
+        if ',' not in text:
+            return datetime.datetime(int(year), MONTHS[month], int(day))
+        (hour, minute, second) = text.split()[3].split(':')
+        return datetime.datetime(int(year), MONTHS[month], int(day), int(hour), int(minute), int(second))
+    except (KeyError, IndexError, ValueError):
+        if ',' in text:
+            return datetime.datetime.strptime(text, "%d %B %Y, %H:%M:%S %Z")
+        return datetime.datetime.strptime(text, "%d %B %Y")
+
+
+def parse_dashboard(body, ignore_tlds = ()):
+    """ requests on a dashboard page: (requests, whether this is the last page, number
+        of the last page if the pager links to it)
+    """
+    requests = []
+    last_page = False
+    last_page_number = None
+    found_table = False
+    in_table = False
+    row = None
+    for match in DASHBOARD_RE.finditer(body):
+        cell = match.group('cell')
+        if cell is not None:
+            if in_table and row is not None:
+                row.append(cell)
+        elif match.group('row') is not None:
+            if in_table:
+                add_dashboard_row(requests, row, ignore_tlds)
+                row = []
+        elif match.group('table') is not None:
+            in_table = 'my-requests' in match.group('table')
+            found_table = found_table or in_table
+            row = None
+        elif match.group('table_end') is not None:
+            if in_table:
+                add_dashboard_row(requests, row, ignore_tlds)
+            in_table = False
+            row = None
+        else:
+            li_classes = match.group('li').split()
+            if 'pager-current' in li_classes and 'last' in li_classes:
+                last_page = True
+            elif 'pager-last' in li_classes and match.group('page'):
+                last_page_number = int(match.group('page'))
+    if not found_table:
+        raise PageError("Request Table not found!")
+    return (requests, last_page, last_page_number)
+
+
+def add_dashboard_row(requests, cols, ignore_tlds):
+    if not cols or len(cols) < 3:
+        return
+    link = HREF_RE.search(cols[0])
+    zone = text_of(cols[0])
+    if not link or zone in ignore_tlds:
+        return
+    requests.append({
+        'id': REQUEST_ID_RE.search(link.group(1)).group(1),
+        'date': parse_date(cols[1].strip()),
+        'zone': zone.lower(),
+        'status': cols[2].strip()
+    })
+
+
+def parse_request(body):
+    """ details on a request from its page, with its history
+    """
+    data = {}
+    history = None
+    key = None
+    in_history = False
+    in_table = False
+    row = None
+    for match in REQUEST_RE.finditer(body):
+        cell = match.group('cell')
+        if cell is not None:
+            if in_table and row is not None:
+                row.append(cell)
+        elif match.group('row') is not None:
+            if in_table:
+                add_history_row(history, row)
+                row = []
+        elif match.group('title') is not None:
+            key = match.group('title').strip().rstrip(':').strip()
+        elif match.group('field') is not None:
+            if key is not None:
+                (ky, vl) = request_field(key, match.group('field'))
+                data[ky] = vl
+                key = None
+        elif match.group('history') is not None:
+            in_history = history is None
+        elif match.group('table') is not None:
+            if in_history:
+                in_table = True
+                history = []
+            row = None
+        elif match.group('table_end') is not None:
+            if in_table:
+                add_history_row(history, row)
+            in_table = in_history = False
+            row = None
+    if history is None:
+        raise PageError("History Table not found!")
+    data['history'] = history
+    return data
+
+
+def add_history_row(history, cols):
+    if not cols or len(cols) < 4:
+        return
+    history.append({
+        'date': parse_date(cols[0].strip()),
+        'user': cols[1].strip(),
+        'action': text_of(cols[2]),
+        'response': text_of(cols[3])
+    })
+
+
+def request_field(key, value):
+    """ (key, value) of a field of a request, with the value as the type it stands for
+    """
+    if 'IP address' in key:
+        value = [ip for ip in (text_of(line) for line in BR_RE.split(value)) if ip]
+    elif 'Expires' in key:
+        value = parse_date(value.strip())
+    else:
+        value = text_of(value)
+    return (key.lower(), value)
+
+
+def parse_request_add(body, ignore_tlds = ()):
+    """ TLDs of the request form by their status: {status: [(input name, TLD)]}, where
+        the TLDs that can be requested are 'open'
+    """
+    data = {}
+    for match in REQUEST_ADD_RE.finditer(body):
+        # the TLD is the text of its label up to the first tag in it
+        tld = match.group('label').strip()
+        if tld in ignore_tlds or tld == 'All TLDs':
+            continue
+        ky = match.group('class').replace('form-checkbox', '').strip() or 'open'
+        data.setdefault(ky, []).append((match.group('name'), tld))
+    return data
@@ -1,23 +1,17 @@
 #!/usr/bin/env python
 # -*- coding:utf-8
-import json, sys, re, datetime, mechanize, cookielib, HTMLParser
+import json, os, sys, re, datetime, threading, urllib2, mechanize, cookielib
+from multiprocessing.pool import ThreadPool
+import czdspages
 
 class czdsException(Exception):
     pass
 
 class czdsWebsite(object):
     ignore_tlds = [ 'TEST', 'test2' ]
+    base_url = 'https://czds.icann.org'
 
-    open_tlds_re = re.compile("""<div class="form-item form-type-checkbox form-item-tlds-fieldset-tld-.+?">\s*<input(.+?)/>\s*<label.+?>(.+?)\s*<""", re.DOTALL)
-    open_tld_ipt_name_re = re.compile('name="([^"]+)"')
-    open_tld_ipt_class_re = re.compile('class="([^"]+)"')
-    request_table_re = re.compile("""<table.+?class=".*?my-requests[^"]*">(.+?)<\/table>""", re.DOTALL)
-    table_tr_re = re.compile("""<tr[^>]*>(.+?)</tr>""", re.DOTALL)
-    table_td_re = re.compile("""<td[^>]*>\s*(.*?)\s*</td>""", re.DOTALL | re.M)
-    a_re = re.compile("""<a.+?href=["|'](.+?)["|'][^>]*>(.+?)</a>""", re.DOTALL)
-    pager_last_page_re = re.compile("""<ul class="pager">.+?<li class="pager-current last">.+?<\/ul>""", re.DOTALL)
-    request_info_re = re.compile("""<div class="title-request"[^>]*>(.+?):<\/div>.+?<div class="field-request"[^>]*>(.+?)<\/div>""", re.DOTALL)
-    request_info_history_re = re.compile("""history-request">.+?<table[^>]+>(.+?)<\/table>""", re.DOTALL)
+    tag_re = re.compile(r'<[^>]+>')
 
     def __init__(self):
         """ Create mechanize browser instance
@@ -51,6 +45,9 @@ class czdsWebsite(object):
         self.br.addheaders = [('User-agent', 'Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.0.1) Gecko/2008071615 Fedora/3.0.1-1.fc9 Firefox/3.0.1')]
         self.body = None
         self.__login = False
+        """ Openers of the crawler threads, see fetchPage
+        """
+        self.local = threading.local()
 
     def __del__(self):
         """ do auto-logout on object destruction
@@ -60,11 +57,18 @@ class czdsWebsite(object):
 
     """ remove all HTML tags from given string
     """
+    @classmethod
+    def remove_tags(cls, text):
+        return czdspages.unescape(cls.tag_re.sub('', text))
+
+    """ records of a page by one of the czdspages functions
+    """
     @staticmethod
-    def remove_tags(text):
-        h = HTMLParser.HTMLParser()
-        TAG_RE = re.compile(r'<[^>]+>')
-        return h.unescape(TAG_RE.sub('', text))
+    def parsePage(parse, *args):
+        try:
+            return parse(*args)
+        except czdspages.PageError, e:
+            raise czdsException(str(e))
 
     """ read given json config file
     """
@@ -73,11 +77,12 @@ class czdsWebsite(object):
             self.conf = json.load(open(configFilename))
         except:
             raise czdsException("Error loading '" + configFilename + "' file.")
+        self.base_url = self.conf.get('base_url', self.base_url).rstrip('/')
 
     """ login on CZDS page
     """
     def login(self):
-        self.br.open('https://czds.icann.org/')
+        self.br.open(self.base_url + '/')
         self.br.select_form(nr=0)
         self.br["name"] = self.conf['username']
         self.br["pass"] = self.conf['password']
@@ -90,107 +95,128 @@ class czdsWebsite(object):
     """ do logout by simply calling logout page
     """
     def logout(self):
-        self.br.open('https://czds.icann.org/en/user/logout')
+        self.br.open(self.base_url + '/en/user/logout')
 
     """ fetch all requests stats on dashboard
     """
     def requestStats(self, page = 0):
-        res = self.br.open('https://czds.icann.org/en/dashboard?page=' + str(page))
+        res = self.br.open(self.base_url + '/en/dashboard?page=' + str(page))
         self.body = res.read()
-        tableMatch = self.request_table_re.search(self.body)
-        if not tableMatch:
-            raise czdsException("Request Table not found!")
-
-        data = []
-        table = tableMatch.group(1)
-        for row in self.table_tr_re.findall(table):
-            cols = self.table_td_re.findall(row)
-            if not cols:
-                continue
-
-            (lnk, zone) = self.a_re.search(cols[0]).groups()
-            if zone in self.ignore_tlds:
-                continue
-
-            request_id = re.search('request/(\d+)', lnk).group(1)
-            request_date = datetime.datetime.strptime(cols[1], "%d %B %Y")
-            data.append({
-                'id': request_id,
-                'date': request_date,
-                'zone': zone.strip().lower(),
-                'status': cols[2]
-            })
-        lastPage = False
-        if self.pager_last_page_re.search(self.body):
-            lastPage = True
-
-        return (data, lastPage)
+        return self.parseRequestStats(self.body)
+
+    """ requests on a dashboard page, and whether it is the last page
+    """
+    def parseRequestStats(self, body):
+        return self.parsePage(czdspages.parse_dashboard, body, self.ignore_tlds)[:2]
 
     """ fetch details on request
     """
     def fetchRequestDetails(self, request_id):
-        res = self.br.open('https://czds.icann.org/en/request/' + str(request_id))
+        res = self.br.open(self.base_url + '/en/request/' + str(request_id))
         self.body = res.read()
-        data = {}
-        for kv in self.request_info_re.findall(self.body):
-            (ky, vl) = kv
-            if 'IP address' in ky:
-                ips = []
-                for ip in vl.split('<br/>'):
-                    ip = self.remove_tags(ip)
-                    if ip:
-                        ips.append(ip)
-                vl = ips
-            elif 'Expires' in ky:
-                vl = datetime.datetime.strptime(vl, "%d %B %Y, %H:%M:%S %Z")
-            else:
-                vl = self.remove_tags(vl).strip()
-
-            data[ky.strip().lower()] = vl
-
-        tableMatch = self.request_info_history_re.search(self.body)
-        if not tableMatch:
-            raise czdsException("History Table not found!")
-
-        data['history'] = []
-        table = tableMatch.group(1)
-        for row in self.table_tr_re.findall(table):
-            cols = self.table_td_re.findall(row)
-            if not cols:
-                continue
-
-            history_date = datetime.datetime.strptime(cols[0], "%d %B %Y, %H:%M:%S %Z")
-            data['history'].append({
-                'date': history_date,
-                'user': cols[1].strip(),
-                'action': self.remove_tags(cols[2]).strip(),
-                'response':  self.remove_tags(cols[3]).strip()
-            })
-
-        return data
+        return self.parseRequestDetails(self.body)
+
+    """ details on a request from its page
+    """
+    def parseRequestDetails(self, body):
+        return self.parsePage(czdspages.parse_request, body)
+
+    """ fetch a page with an opener of the calling thread. The openers share the cookie jar
+        of the browser, so they use the session it logged in (cookielib locks the jar).
+    """
+    def fetchPage(self, path):
+        opener = getattr(self.local, 'opener', None)
+        if opener is None:
+            opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cj))
+            opener.addheaders = list(self.br.addheaders)
+            self.local.opener = opener
+        return opener.open(self.base_url + path).read()
+
+    def fetchRequestStatsPage(self, page):
+        return self.parseRequestStats(self.fetchPage('/en/dashboard?page=' + str(page)))
+
+    def fetchRequestDetailsPage(self, request_id):
+        return self.parseRequestDetails(self.fetchPage('/en/request/' + str(request_id)))
+
+    """ fetch all requests on the dashboard with their details, several pages at a time.
+        Details are cached in cacheFilename and only fetched again for requests whose
+        status on the dashboard changed.
+    """
+    def crawl(self, workers = 8, cacheFilename = None):
+        pool = ThreadPool(workers)
+        try:
+            body = self.fetchPage('/en/dashboard?page=0')
+            (requests, lastPage, lastPageNumber) = self.parsePage(czdspages.parse_dashboard, body, self.ignore_tlds)
+            page = 1
+            while not lastPage:
+                # all remaining pages at once if the pager says how many there are
+                count = max(1, lastPageNumber + 1 - page) if lastPageNumber is not None else workers
+                for (data, last) in pool.map(self.fetchRequestStatsPage, range(page, page + count)):
+                    # pages after the last one repeat it
+                    if not lastPage:
+                        requests.extend(data)
+                        lastPage = last or not data
+                page += count
+                lastPageNumber = None
+
+            cache = self.loadCache(cacheFilename)
+            stale = [request for request in requests if self.isStale(cache.get(request['id']), request)]
+            for (request, details) in zip(stale, pool.map(self.fetchRequestDetailsPage,
+                                                          [request['id'] for request in stale])):
+                cache[request['id']] = {'status': request['status'], 'details': details}
+            for request in requests:
+                request['details'] = cache[request['id']]['details']
+            self.saveCache(cacheFilename, cache)
+        finally:
+            pool.close()
+            pool.join()
+        return requests
+
+    """ whether the cached details of a request may be out of date. The dashboard only
+        shows the date a request was created, so its status is all that tells of a change.
+    """
+    @staticmethod
+    def isStale(entry, request):
+        if entry is None or entry['status'] != request['status']:
+            return True
+        return not entry['details'].get('history')
+
+    """ the request details cache, as a dict keyed by request id
+    """
+    def loadCache(self, cacheFilename):
+        if not cacheFilename or not os.path.exists(cacheFilename):
+            return {}
+        try:
+            return json.load(open(cacheFilename), object_hook = self.decodeDate)
+        except ValueError:
+            return {}
+
+    def saveCache(self, cacheFilename, cache):
+        if not cacheFilename:
+            return
+        tmpFilename = cacheFilename + '.tmp'
+        with open(tmpFilename, 'w') as fd:
+            json.dump(cache, fd, default = self.encodeDate, indent = 1, sort_keys = True)
+        os.rename(tmpFilename, cacheFilename)
+
+    @staticmethod
+    def encodeDate(obj):
+        if isinstance(obj, datetime.datetime):
+            return {'__datetime__': obj.strftime('%Y-%m-%dT%H:%M:%S')}
+        raise TypeError(repr(obj) + ' is not JSON serializable')
+
+    @staticmethod
+    def decodeDate(obj):
+        if '__datetime__' in obj:
+            return datetime.datetime.strptime(obj['__datetime__'], '%Y-%m-%dT%H:%M:%S')
+        return obj
 
     """ get list of current status of all zones
     """
     def checkOpenReq(self):
-        res = self.br.open('https://czds.icann.org/en/request/add')
+        res = self.br.open(self.base_url + '/en/request/add')
         self.body = res.read()
-        data = {
-        }
-        for option in self.open_tlds_re.findall(self.body):
-            (ipt, tld) = option
-            if tld in self.ignore_tlds or tld == 'All TLDs':
-                continue
-            (name, ) = self.open_tld_ipt_name_re.findall(ipt)
-            (cls, ) = self.open_tld_ipt_class_re.findall(ipt)
-
-            ky = cls.replace('form-checkbox', '').strip()
-            if ky == '' :
-                ky = 'open'
-            if not ky in data:
-                data[ky] = []
-            data[ky].append((name, tld))
-
-        return data
+        return self.parsePage(czdspages.parse_request_add, self.body, self.ignore_tlds)
 
     """ print current requests
     """
@@ -201,13 +227,25 @@ class czdsWebsite(object):
                 for item in data[ky]:
                     print ' ', item[1]
 
+    """ print crawled requests with the last entry of their history
+    """
+    def printRequests(self, requests):
+        for request in sorted(requests, key = lambda request: request['zone']):
+            history = request['details'].get('history') or [{}]
+            last = max(history, key = lambda item: item.get('date'))
+            print '%-20s %-12s %s %s' % (request['zone'], request['status'],
+                                         last.get('date', ''), last.get('action', ''))
+
 if __name__ == "__main__":
     try:
         ws = czdsWebsite()
         ws.readConfig()
         ws.login()
-        data = ws.checkOpenReq()
-        ws.printData(data)
+        if len(sys.argv) > 1 and sys.argv[1] == 'crawl':
+            ws.printRequests(ws.crawl(ws.conf.get('crawl_workers', 8), ws.conf.get('cache_file')))
+        else:
+            data = ws.checkOpenReq()
+            ws.printData(data)
     except Exception, e:
         sys.stderr.write("Error occoured: " + str(e) + "\n")
         exit(1)
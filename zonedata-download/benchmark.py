@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8
+""" Benchmark download.py end to end against the local stand-in CZDS server in mock_czds.py.
+
+    Every scenario runs CZDSDownloader in a fresh process, so the peak RSS reported is that
+    of the downloader alone, and reports zones/s, MB/s, peak RSS and retry counts. Results
+    can be saved as JSON and compared with an earlier run to catch regressions.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import mock_czds
+
+# fault injection settings of the stand-in server for each scenario
+SCENARIOS = {
+    'baseline': {},
+    'latency': {'latency': 0.05},
+    'bandwidth': {'bandwidth': 4 * 1024 * 1024},
+    'errors': {'fail_401': 0.02, 'fail_429': 0.05, 'fail_500': 0.05},
+    'drops': {'drop_rate': 0.2},
+}
+
+
+def run_downloader(config_file, results):
+    """ Run one download in this (child) process and put its figures on the results queue
+    """
+    import download
+
+    downloader = download.CZDSDownloader(config_file)
+    started = time.monotonic()
+    downloader.czds_authenticate()
+    downloader.fetch()
+    seconds = time.monotonic() - started
+    sizes = [entry.get('size', 0) for entry in downloader.day_manifest.entries.values()]
+    results.put({'zones': downloader.downloaded_zones,
+                 'zones_expected': downloader.downloadable_zones,
+                 'bytes': sum(sizes),
+                 'seconds': seconds,
+                 'retries': downloader.retries,
+                 'interrupted': downloader.interrupted_transfers,
+                 'throttled': downloader.scheduler.throttled,
+                 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+def run_scenario(mock, name, parallel, work_dir, options):
+    """ Download all zones of the stand-in server with the given number of parallel
+        downloads and return the figures of the run
+    """
+    mock.configure(**SCENARIOS[name])
+    mock.reset_stats()
+    mock.revoke_tokens()
+
+    out_dir = os.path.join(work_dir, '{}-{}'.format(name, parallel))
+    os.makedirs(out_dir)
+    config = {'czds.user': 'benchmark', 'czds.password': 'benchmark',
+              'czds.auth_url': mock.url, 'czds.download_base_url': mock.url,
+              'output_directory': out_dir, 'output_buffer_size': options.buffer_size,
+              'max_parallel_downloads': parallel, 'max_retries': 20,
+              'retry_backoff': 0.05, 'max_retry_backoff': 2, 'max_request_rate': 1000,
+              'verify_gzip': options.verify_gzip, 'receive_into_buffer': options.receive_into_buffer,
+              'proxy.http': '', 'proxy.https': '', 'send_mail': False,
+              'sender': '', 'recipient': '', 'smtp.server': '', 'smtp.server.port': 0,
+              'smtp.server.starttls': False, 'smtp.username': '', 'smtp.password': ''}
+    config_file = os.path.join(out_dir, 'config.json')
+    with open(config_file, 'w') as config_fd:
+        json.dump(config, config_fd)
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_downloader, args=(config_file, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return {'scenario': name, 'parallel': parallel, 'error': 'downloader exited with {}'.format(process.exitcode)}
+
+    run = results.get()
+    seconds = max(run['seconds'], 1e-6)
+    return {'scenario': name, 'parallel': parallel,
+            'zones': run['zones'], 'zones_expected': run['zones_expected'],
+            'seconds': round(seconds, 3),
+            'zones_per_s': round(run['zones'] / seconds, 2),
+            'mb_per_s': round(run['bytes'] / 1e6 / seconds, 2),
+            'peak_rss_mb': round(run['peak_rss_kb'] / 1024.0, 1),
+            'retries': run['retries'], 'interrupted': run['interrupted'], 'throttled': run['throttled'],
+            'requests': mock.stats.get('requests', 0), 'dropped': mock.stats.get('dropped', 0)}
+
+
+def compare(results, baseline_file, tolerance):
+    """ Return the runs whose MB/s dropped by more than tolerance compared to the baseline
+    """
+    with open(baseline_file, 'r') as baseline_fd:
+        baseline = dict(((run['scenario'], run['parallel']), run) for run in json.load(baseline_fd)
+                        if 'mb_per_s' in run)
+    regressions = []
+    for run in results:
+        before = baseline.get((run['scenario'], run['parallel']))
+        if before and 'mb_per_s' in run and run['mb_per_s'] < before['mb_per_s'] * (1 - tolerance):
+            regressions.append((run, before))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark download.py against a local stand-in CZDS server')
+    parser.add_argument('--zones', type=int, default=20, help='number of synthetic zones')
+    parser.add_argument('--records', type=int, default=200000, help='delegations in the largest zone')
+    parser.add_argument('--parallel', type=str, default='1,4', help='comma separated max_parallel_downloads to try')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run (default: all), can be given several times')
+    parser.add_argument('--buffer-size', type=int, default=1024*1024, help='output_buffer_size of the downloader')
+    parser.add_argument('--verify-gzip', action='store_true', help='run the downloader with verify_gzip')
+    parser.add_argument('--receive-into-buffer', action='store_true',
+                        help='run the downloader with receive_into_buffer')
+    parser.add_argument('--json', type=str, help='write the results to this file')
+    parser.add_argument('--baseline', type=str, help='results of an earlier run to compare MB/s against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fail if MB/s drops by more than this fraction of the baseline')
+    args = parser.parse_args()
+
+    print('Generating {} synthetic zones...'.format(args.zones))
+    zones = dict(('tld{:03d}'.format(i), mock_czds.synthetic_zone('tld{:03d}'.format(i),
+                                                                  max(10, args.records // (i + 1))))
+                 for i in range(args.zones))
+    print('{} bytes of zone data'.format(sum(len(data) for data in zones.values())))
+    mock = mock_czds.MockCZDS(zones).start()
+
+    work_dir = tempfile.mkdtemp(prefix='czds-benchmark-')
+    results = []
+    try:
+        print('{:<10} {:>8} {:>7} {:>9} {:>8} {:>8} {:>8} {:>8} {:>11} {:>9}'
+              .format('scenario', 'parallel', 'zones', 'seconds', 'zones/s', 'MB/s', 'RSS MB', 'retries',
+                      'interrupted', 'throttled'))
+        for name in args.scenario or sorted(SCENARIOS):
+            for parallel in [int(p) for p in args.parallel.split(',')]:
+                run = run_scenario(mock, name, parallel, work_dir, args)
+                results.append(run)
+                if 'error' in run:
+                    print('{:<10} {:>8} {}'.format(name, parallel, run['error']))
+                    continue
+                print('{:<10} {:>8} {:>7} {:>9.2f} {:>8.2f} {:>8.2f} {:>8.1f} {:>8} {:>11} {:>9}'
+                      .format(name, parallel, '{}/{}'.format(run['zones'], run['zones_expected']), run['seconds'],
+                              run['zones_per_s'], run['mb_per_s'], run['peak_rss_mb'], run['retries'],
+                              run['interrupted'], run['throttled']))
+    finally:
+        mock.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as json_fd:
+            json.dump(results, json_fd, indent=1)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for run, before in regressions:
+            print('REGRESSION {} with {} parallel downloads: {} MB/s, was {} MB/s'
+                  .format(run['scenario'], run['parallel'], run['mb_per_s'], before['mb_per_s']))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8
+""" Content-addressed store for zone files, so a zone that did not change is kept on disk
+    once however many days it is in.
+
+    Zone files are stored by their SHA-256 as <store>/<first two hex digits>/<sha256>.gz, and
+    the files in the day folders are hardlinks to them. The day folders look just like
+    before, so whatever reads them keeps working. A stored file is only deleted by the
+    garbage collector, once no day folder links to it any more (its link count is 1). Blobs
+    are made read-only, as writing to one would change the zone in every day it is in.
+
+    The store has to be on the same file system as the day folders. Where a hardlink
+    cannot be made the zone file is left as it is.
+"""
+import argparse
+import datetime
+import errno
+import hashlib
+import os
+import shutil
+import stat
+import sys
+import threading
+import time
+
+
+class ContentStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.linked = 0
+        self.saved_bytes = 0
+
+    def blob_name(self, sha256):
+        return os.path.join(self.path, sha256[:2], sha256 + '.gz')
+
+    def adopt(self, file_name, sha256):
+        """ Put a zone file into the store, or replace it by a hardlink to the stored copy
+            if the store already has it. Returns the name of the blob, or None if the file
+            could not be linked with the store.
+        """
+        blob = self.blob_name(sha256)
+        size = os.path.getsize(file_name)
+        tmp_name = '{}.{}.{}.tmp'.format(blob, os.getpid(), threading.get_ident())
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                try:
+                    blob_stat = os.stat(blob)
+                except FileNotFoundError:
+                    blob_stat = None
+                file_stat = os.stat(file_name)
+                if blob_stat is not None and blob_stat.st_size == size:
+                    if (blob_stat.st_dev, blob_stat.st_ino) == (file_stat.st_dev, file_stat.st_ino):
+                        return blob
+                    # same content as a stored zone: link to that instead
+                    link_name = '{}.{}.tmp'.format(file_name, os.getpid())
+                    os.link(blob, link_name)
+                    os.replace(link_name, file_name)
+                    self.linked += 1
+                    self.saved_bytes += size
+                else:
+                    # first time we see this content (or the stored copy is damaged)
+                    os.chmod(file_name, stat.S_IMODE(file_stat.st_mode) & ~0o222)
+                    os.link(file_name, tmp_name)
+                    os.replace(tmp_name, blob)
+            except OSError as e:
+                for name in (tmp_name, '{}.{}.tmp'.format(file_name, os.getpid())):
+                    if os.path.exists(name):
+                        os.remove(name)
+                if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    return None
+                raise
+        return blob
+
+    def blobs(self):
+        """ Yield (name, os.stat_result) of all blobs in the store
+        """
+        if not os.path.isdir(self.path):
+            return
+        for prefix in sorted(os.listdir(self.path)):
+            directory = os.path.join(self.path, prefix)
+            if len(prefix) != 2 or not os.path.isdir(directory):
+                continue
+            for name in sorted(os.listdir(directory)):
+                if name.endswith('.gz'):
+                    yield os.path.join(directory, name), os.stat(os.path.join(directory, name))
+
+    def collect(self, dry_run=False):
+        """ Delete the blobs no day folder links to any more, and leftover temporary files.
+            Returns (blobs deleted, bytes freed).
+        """
+        deleted = freed = 0
+        for blob, blob_stat in list(self.blobs()):
+            if blob_stat.st_nlink > 1:
+                continue
+            if not dry_run:
+                os.remove(blob)
+            deleted += 1
+            freed += blob_stat.st_size
+        for prefix in os.listdir(self.path) if os.path.isdir(self.path) else []:
+            directory = os.path.join(self.path, prefix)
+            for name in os.listdir(directory) if os.path.isdir(directory) else []:
+                # temporary files of adopt() that were left behind by a crash
+                tmp_name = os.path.join(directory, name)
+                if name.endswith('.tmp') and time.time() - os.stat(tmp_name).st_mtime > 86400 and not dry_run:
+                    os.remove(tmp_name)
+        return deleted, freed
+
+    def stats(self):
+        """ (blobs, bytes stored, bytes referenced by the day folders)
+        """
+        blobs = stored = referenced = 0
+        for blob, blob_stat in self.blobs():
+            blobs += 1
+            stored += blob_stat.st_size
+            referenced += blob_stat.st_size * (blob_stat.st_nlink - 1)
+        return blobs, stored, referenced
+
+
+def day_folders(output_directory):
+    """ Yield (date, path) of the YYYY-MM-DD download folders in output_directory
+    """
+    for name in sorted(os.listdir(output_directory)):
+        try:
+            day = datetime.datetime.strptime(name, '%Y-%m-%d').date()
+        except ValueError:
+            continue
+        if os.path.isdir(os.path.join(output_directory, name)):
+            yield day, os.path.join(output_directory, name)
+
+
+def expire_days(output_directory, keep_days, dry_run=False, today=None):
+    """ Delete the download folders older than keep_days days. Returns the folders deleted.
+    """
+    cutoff = (today or datetime.date.today()) - datetime.timedelta(days=keep_days)
+    expired = [path for day, path in day_folders(output_directory) if day < cutoff]
+    if not dry_run:
+        for path in expired:
+            shutil.rmtree(path)
+    return expired
+
+
+def file_sha256(file_name):
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as in_fd:
+        for data in iter(lambda: in_fd.read(1024*1024), b''):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+def import_days(store, output_directory):
+    """ Move the zone files of existing download folders into the store. Returns
+        (files, files replaced by links, bytes saved).
+    """
+    files = 0
+    linked = store.linked
+    saved = store.saved_bytes
+    for day, path in day_folders(output_directory):
+        for name in sorted(os.listdir(path)):
+            file_name = os.path.join(path, name)
+            if name.endswith('.gz') and os.path.isfile(file_name):
+                store.adopt(file_name, file_sha256(file_name))
+                files += 1
+    return files, store.linked - linked, store.saved_bytes - saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the content-addressed store of zone files')
+    parser.add_argument('output_directory', help='output_directory of download.py')
+    parser.add_argument('--store', type=str, help='path of the store (default: output_directory/.store)')
+    commands = parser.add_subparsers(dest='command')
+    gc = commands.add_parser('gc', help='delete old download folders and the zone files no longer used')
+    gc.add_argument('--keep-days', type=int, help='delete download folders older than this many days')
+    gc.add_argument('-n', '--dry-run', action='store_true', help='only print what would be deleted')
+    commands.add_parser('import', help='move the zone files of existing download folders into the store')
+    commands.add_parser('stats', help='print how much space the store saves')
+    args = parser.parse_args()
+
+    store = ContentStore(args.store or os.path.join(args.output_directory, '.store'))
+    if args.command == 'gc':
+        if args.keep_days is not None:
+            for path in expire_days(args.output_directory, args.keep_days, args.dry_run):
+                print('{} {}'.format('Would delete' if args.dry_run else 'Deleted', path))
+            if args.dry_run:
+                print('(zone files only used by these folders are not counted below)')
+        deleted, freed = store.collect(args.dry_run)
+        print('{} {} unused zone files, {} bytes'.format('Would delete' if args.dry_run else 'Deleted', deleted, freed))
+    elif args.command == 'import':
+        files, linked, saved = import_days(store, args.output_directory)
+        print('{} zone files, {} replaced by links, {} bytes saved'.format(files, linked, saved))
+    elif args.command == 'stats':
+        blobs, stored, referenced = store.stats()
+        print('{} zone files, {} bytes stored for {} bytes in the download folders ({:.1f}x)'
+              .format(blobs, stored, referenced, referenced / float(stored) if stored else 1.0))
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,789 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8
 import argparse
+import atexit
+import base64
+import collections
+import contextlib
 import datetime
+import email.utils
+import errno
+import fcntl
+import hashlib
 import json
 import logging
 import os
+import queue
+import random
 import requests
+import requests.adapters
+import shutil
+import signal
 import smtplib
+import socket
 import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+import urllib3.exceptions
+
+import casstore
+import gzindex
+import zonediff
+import zoneindex
+import zoneparse
+import zonestats
+
+
+# optional stages run on every zone file after it is downloaded, by a pool of worker
+# processes: (config key, name, suffix of the output file, function)
+POST_DOWNLOAD_STAGES = [('parse_zones', 'parse', '.cols', zoneparse.parse_zone_file),
+                        ('index_zones', 'index', '.idx', zoneindex.build_zone_index),
+                        ('gzip_index', 'gzindex', '.gzi', gzindex.build_gzip_index),
+                        ('zone_stats', 'stats', '.stats.json', zonestats.build_zone_stats)]
 
 
 class GetError(Exception):
-    def __init__(self, message):
+    def __init__(self, message, status_code=None, retry_after=None):
         super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
 
 
 class CZDSError(Exception):
     pass
 
 
+class CorruptZoneError(Exception):
+    pass
+
+
+class ZoneDigest(object):
+    """ SHA-256 and size of a zone file, computed on the stream while it is written
+    """
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def finish(self):
+        return {'sha256': self.sha256.hexdigest(), 'size': self.size}
+
+
+class GzipCheck(object):
+    """ Decompresses a zone file on the stream while it is written, so zlib checks the
+        CRC-32 and length in the gzip trailer. The output is thrown away. Raises
+        CorruptZoneError as soon as the data is found to be bad, or at the end if the
+        gzip stream is incomplete.
+    """
+    # decompress at most this much at a time, whatever the compression ratio
+    window = 4 * 1024 * 1024
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.uncompressed = 0
+
+    def update(self, data):
+        try:
+            while data:
+                self.uncompressed += len(self.decompressor.decompress(data, self.window))
+                data = self.decompressor.unconsumed_tail
+                if self.decompressor.eof and self.decompressor.unused_data:
+                    # gzip files may consist of several members
+                    data = self.decompressor.unused_data
+                    self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        except zlib.error as e:
+            raise CorruptZoneError('gzip data is corrupt ({})'.format(e))
+
+    def finish(self):
+        if not self.decompressor.eof:
+            raise CorruptZoneError('gzip data is truncated')
+        return {'gzip_ok': True, 'uncompressed_size': self.uncompressed}
+
+
+class GzipIndexCheck(object):
+    """ Builds the random access index of a zone (see gzindex.py) on the stream while it is
+        written, and writes it next to the zone when the stream is complete. As it
+        decompresses the whole zone, it also finds corrupt data like GzipCheck.
+    """
+    def __init__(self, index_name, span):
+        self.index_name = index_name
+        self.builder = gzindex.GzipIndexBuilder(span)
+
+    def update(self, data):
+        try:
+            self.builder.update(data)
+        except gzindex.GzipIndexError as e:
+            raise CorruptZoneError(str(e))
+
+    def finish(self):
+        try:
+            index_data = self.builder.finish()
+        except gzindex.GzipIndexError as e:
+            raise CorruptZoneError(str(e))
+        gzindex.write_index(index_data, self.index_name)
+        return {'gzip_ok': True, 'uncompressed_size': self.builder.total_out,
+                'gzip_index_points': len(self.builder.points)}
+
+
+class ZoneStatsCheck(object):
+    """ Computes the statistics of a zone (see zonestats.py) on the stream while it is
+        written, on a thread of its own so the download does not wait for the parsing,
+        and writes them next to the zone when the stream is complete. The queue to the
+        thread is bounded: a download that gets too far ahead waits for it.
+    """
+    queued_chunks = 16
+
+    def __init__(self, stats_name, zone_name):
+        self.stats_name = stats_name
+        self.stats = zonestats.ZoneStats(zone_name)
+        self.started = time.monotonic()
+        self.error = None
+        self.chunks = queue.Queue(self.queued_chunks)
+        self.thread = threading.Thread(target=self.run, name='stats-' + zone_name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            data = self.chunks.get()
+            if data is None:
+                return
+            if self.error is None:
+                try:
+                    self.stats.update(data)
+                except zoneparse.ZoneParseError as e:
+                    self.error = e
+
+    def update(self, data):
+        if self.error is not None:
+            raise CorruptZoneError(str(self.error))
+        # the chunk may be a view on a buffer that is about to be reused
+        self.chunks.put(bytes(data))
+
+    def abort(self):
+        """ Stop the thread, for a stream that will not be finished
+        """
+        if self.thread.is_alive():
+            self.error = self.error or zoneparse.ZoneParseError('aborted')
+            self.chunks.put(None)
+            self.thread.join()
+
+    def finish(self):
+        self.chunks.put(None)
+        self.thread.join()
+        try:
+            if self.error is not None:
+                raise self.error
+            stats = self.stats.finish()
+        except zoneparse.ZoneParseError as e:
+            raise CorruptZoneError(str(e))
+        stats['seconds'] = round(time.monotonic() - self.started, 3)
+        zonestats.write_stats(stats, self.stats_name)
+        return dict(('stats_' + key, value) for key, value in zonestats.summary(stats).items())
+
+
+class Notifier(object):
+    """ Sends the mails of the downloader from a background thread, so the download path
+        never waits for the mail relay. Failure messages are collected into one digest mail,
+        sent digest_interval seconds after the first of them, and no more than
+        max_mails_per_hour mails are sent; what is left is sent when the notifier is closed.
+        The SMTP connection is kept open and reused for the next mail.
+    """
+    # at most this many messages are listed in a digest
+    max_digest_messages = 100
+
+    def __init__(self, server, port, starttls, username, password, sender, recipient, digest_interval=300,
+                 max_mails_per_hour=6):
+        self.server = server
+        self.port = port
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.sender = sender
+        self.recipient = recipient
+        self.digest_interval = digest_interval
+        self.max_mails_per_hour = max_mails_per_hour
+        self.queue = queue.Queue()
+        self.pending = []
+        self.sent = collections.deque()
+        self.smtp = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='notifier', daemon=True)
+        self.thread.start()
+
+    def notify(self, msg, fail=True):
+        """ Queue a message; failure messages go into the next digest, others are sent at once
+        """
+        self.queue.put((time.time(), fail, msg))
+
+    def close(self, timeout=120):
+        """ Send everything still queued and wait for the background thread to finish
+        """
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join(timeout)
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.pending:
+                timeout = max(0.0, self.pending[0][0] + self.digest_interval - time.time())
+                if not self.may_send():
+                    # with max_mails_per_hour 0 nothing was sent, and only close() sends the digest
+                    timeout = max(timeout, self.sent[0] + 3600 - time.time()) if self.sent else None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                when, fail, msg = item
+                if fail:
+                    self.pending.append((when, msg))
+                else:
+                    # the failures that led up to it come first
+                    if self.pending:
+                        self.send_digest()
+                    self.send('SUCCESS in fetching data from ICANN CZDS', msg)
+            if self.pending and time.time() >= self.pending[0][0] + self.digest_interval and self.may_send():
+                self.send_digest()
+        # flush on exit, whatever the rate limit says
+        if self.pending:
+            self.send_digest()
+        self.disconnect()
+
+    def may_send(self):
+        while self.sent and time.time() - self.sent[0] > 3600:
+            self.sent.popleft()
+        return len(self.sent) < self.max_mails_per_hour
+
+    def send_digest(self):
+        pending, self.pending = self.pending, []
+        if len(pending) == 1:
+            body = pending[0][1]
+        else:
+            lines = ['{} {}'.format(datetime.datetime.fromtimestamp(when).strftime('%Y-%m-%d %H:%M:%S'), msg)
+                     for when, msg in pending[:self.max_digest_messages]]
+            if len(pending) > self.max_digest_messages:
+                lines.append('... and {} more, see download.log'.format(len(pending) - self.max_digest_messages))
+            body = '{} failures:\n\n{}'.format(len(pending), '\n'.join(lines))
+        self.send('FAILURE to fetch data from ICANN CZDS', body)
+
+    def connect(self):
+        self.smtp = smtplib.SMTP(self.server, self.port, timeout=60)
+        if self.starttls:
+            self.smtp.ehlo()
+            self.smtp.starttls()
+        else:
+            self.smtp.helo()
+        if self.username:
+            self.smtp.login(self.username, self.password)
+
+    def disconnect(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+    def send(self, subject, body):
+        message = 'From: {}\n'.format(self.sender)
+        message += 'To: {}\n'.format(self.recipient)
+        message += 'Subject: {}\n\n'.format(subject)
+        message += body
+        self.sent.append(time.time())
+        # the relay may have dropped the connection we kept, so try once more on a new one
+        for attempt in range(2):
+            try:
+                if self.smtp is None:
+                    self.connect()
+                self.smtp.sendmail(self.sender, self.recipient, message)
+                return
+            except smtplib.SMTPServerDisconnected as e:
+                self.smtp = None
+                error = e
+            except (smtplib.SMTPException, OSError) as e:
+                self.disconnect()
+                error = e
+                break
+        logging.error('Failed to send e-mail: {}'.format(str(error)))
+
+
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    """ HTTPAdapter that gives every request a (connect, read) timeout unless it has its own,
+        so a connection that stalls raises instead of blocking the download (or the daemon)
+        forever. The read timeout applies to each read of a streamed body, not to all of it.
+    """
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+class RequestScheduler(object):
+    """ Paces the requests to CZDS so we stay close to what the server allows without
+        tripping its throttling: a token bucket whose rate adapts to the server (halved on
+        429/503, raised step by step on success), a cap on concurrent requests per host, and
+        exponential backoff with jitter between retries. A Retry-After from the server
+        pauses all requests until it has passed.
+    """
+    def __init__(self, max_rate, min_rate, max_per_host, backoff, max_backoff):
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate)
+        self.rate = self.max_rate
+        self.max_per_host = max_per_host
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.tokens = max(1.0, self.max_rate)
+        self.last_refill = time.monotonic()
+        self.not_before = 0.0
+        self.last_decrease = 0.0
+        self.host_slots = {}
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until the token bucket allows another request
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if now >= self.not_before and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.not_before - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    @contextlib.contextmanager
+    def slot(self, url):
+        """ Hold one of the request slots for the host of url while sending a request
+            and reading the response headers
+        """
+        host = urlparse(url).netloc
+        with self.lock:
+            semaphore = self.host_slots.setdefault(host, threading.BoundedSemaphore(self.max_per_host))
+        with semaphore:
+            self.acquire()
+            yield
+
+    def feedback(self, status_code, retry_after=None):
+        """ Adapt the request rate to the response we got (additive increase,
+            multiplicative decrease)
+        """
+        with self.lock:
+            if status_code in (429, 503):
+                self.throttled += 1
+                # parallel workers tend to get throttled together, count that as one event
+                now = time.monotonic()
+                if now - self.last_decrease >= 1.0:
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    self.last_decrease = now
+                if retry_after is not None:
+                    self.not_before = max(self.not_before, time.monotonic() + retry_after)
+                logging.warning('CZDS is throttling us ({}), request rate lowered to {:.2f}/s'
+                                .format(status_code, self.rate))
+            elif status_code < 500:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def delay(self, attempt, retry_after=None):
+        """ Seconds to wait before retry number attempt (counting from 0)
+        """
+        if retry_after is not None:
+            return retry_after
+        # "full jitter", so workers that failed together do not retry together
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def parse_retry_after(value):
+        """ Retry-After is either a number of seconds or an HTTP date
+        """
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class TokenCache(object):
+    """ CZDS access token kept on disk, so it can be reused by later runs and by other
+        processes downloading into the same output directory. The file is only readable by
+        its owner, and refreshes are serialised with a lock file so that processes whose
+        token expires at the same time do not all log in again.
+    """
+    def __init__(self, path, user):
+        self.path = path
+        self.user = user
+
+    def load(self):
+        """ Return (token, expiry) from the cache, or (None, None)
+        """
+        try:
+            with open(self.path, 'r') as fd:
+                cached = json.load(fd)
+        except (OSError, ValueError):
+            return None, None
+        if cached.get('user') != self.user:
+            return None, None
+        return cached.get('access_token'), cached.get('expires')
+
+    def store(self, token, expires):
+        tmp_name = '{}.{}.tmp'.format(self.path, os.getpid())
+        fd = os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as out_fd:
+            json.dump({'user': self.user, 'access_token': token, 'expires': expires}, out_fd)
+        os.replace(tmp_name, self.path)
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(self.path + '.lock', 'a') as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def jwt_expiry(token):
+        """ Expiry (seconds since the epoch) from the exp claim of a JWT, None if there is none
+        """
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+            return None
+
+
+class RunMetrics(object):
+    """ Timings and counters of one run, per zone and for the run as a whole, for the JSON
+        run report and the Prometheus textfile collector
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.timings = {}
+        self.zones = {}
+
+    def timing(self, name, seconds):
+        with self.lock:
+            self.timings[name] = round(seconds, 6)
+
+    def zone(self, zone_name, **fields):
+        with self.lock:
+            self.zones.setdefault(zone_name, {}).update(fields)
+
+    def get(self, zone_name):
+        with self.lock:
+            return dict(self.zones.get(zone_name, {}))
+
+    def add(self, zone_name, counter, amount=1):
+        with self.lock:
+            entry = self.zones.setdefault(zone_name, {})
+            entry[counter] = entry.get(counter, 0) + amount
+
+    def report(self, **totals):
+        """ The whole run as a dict, with totals given by the downloader
+        """
+        with self.lock:
+            zones = dict((zone_name, dict(entry)) for zone_name, entry in self.zones.items())
+            timings = dict(self.timings)
+        for entry in zones.values():
+            if entry.get('transfer_seconds') and entry.get('size') is not None and not entry.get('reused'):
+                entry['mb_per_s'] = round(entry['size'] / 1e6 / max(entry['transfer_seconds'], 1e-6), 3)
+        report = {'started': datetime.datetime.fromtimestamp(self.started).isoformat(),
+                  'start_timestamp': round(self.started, 3),
+                  'duration_seconds': round(time.time() - self.started, 3),
+                  'zones_failed': len([entry for entry in zones.values() if entry.get('status') == 'failed']),
+                  'bytes_downloaded': sum(entry.get('size', 0) for entry in zones.values()
+                                          if entry.get('status') == 'downloaded'),
+                  'zones': zones}
+        report.update(timings)
+        report.update(totals)
+        return report
+
+    @staticmethod
+    def prometheus(report):
+        """ The run report in the Prometheus text exposition format
+        """
+        lines = []
+
+        def metric(name, help_text, samples, kind='gauge'):
+            lines.append('# HELP czds_{} {}'.format(name, help_text))
+            lines.append('# TYPE czds_{} {}'.format(name, kind))
+            for labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, str(val).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for key, val in labels)
+                lines.append('czds_{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', value))
+
+        metric('run_start_timestamp_seconds', 'Start of the last run.', [((), report['start_timestamp'])])
+        metric('run_duration_seconds', 'Duration of the last run.', [((), report['duration_seconds'])])
+        for name, help_text in (('auth_seconds', 'Time taken to authenticate to CZDS.'),
+                                ('zonelist_seconds', 'Time taken to get the list of zones.')):
+            if name in report:
+                metric(name, help_text, [((), report[name])])
+        for name, help_text in (('zones_downloadable', 'Zones we have access to.'),
+                                ('zones_downloaded', 'Zones downloaded or reused in the last run.'),
+                                ('zones_unchanged', 'Zones reused from an earlier run.'),
+                                ('zones_failed', 'Zones that could not be downloaded in the last run.'),
+                                ('retries', 'Requests retried in the last run.'),
+                                ('throttled', 'Responses in the last run telling us to slow down.'),
+                                ('interrupted_transfers', 'Zone transfers that broke off in the last run.'),
+                                ('bytes_downloaded', 'Bytes of zone data downloaded in the last run.')):
+            if name in report:
+                metric(name, help_text, [((), report[name])])
+
+        zones = sorted(report['zones'].items())
+        for name, key, help_text in (('zone_bytes', 'size', 'Size of the zone file.'),
+                                     ('zone_ttfb_seconds', 'ttfb_seconds', 'Time to the first byte of the zone.'),
+                                     ('zone_transfer_seconds', 'transfer_seconds', 'Time taken to transfer the zone.'),
+                                     ('zone_throughput_mb_per_second', 'mb_per_s', 'Transfer rate of the zone.'),
+                                     ('zone_retries', 'retries', 'Requests for the zone that were retried.'),
+                                     ('zone_interruptions', 'interruptions', 'Transfers of the zone that broke off.'),
+                                     ('zone_records', 'records', 'Records in the zone.'),
+                                     ('zone_parse_seconds', 'parse_seconds', 'Time taken to parse the zone.'),
+                                     ('zone_index_seconds', 'index_seconds', 'Time taken to index the zone.')):
+            samples = [((('zone', zone_name),), entry[key]) for zone_name, entry in zones if key in entry]
+            if samples:
+                metric(name, help_text, samples)
+        metric('zone_success', 'Whether the zone was downloaded (or reused) in the last run.',
+               [((('zone', zone_name),), 0 if entry.get('status') == 'failed' else 1) for zone_name, entry in zones])
+        return '\n'.join(lines) + '\n'
+
+
+class ZoneManifest(object):
+    """ JSON file with one entry per zone. Used for what we know about each zone URL
+        from earlier runs (HTTP validators and the file it was written to), and for the
+        checksums of the zones in a download folder.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        # keys updated by this process, see save()
+        self.updated = set()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as fd:
+                    self.entries = json.load(fd)
+            except (OSError, ValueError) as e:
+                logging.warning("Ignoring unreadable zone manifest '{}' ({})".format(path, e))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return dict(entry) if entry else None
+
+    def update(self, key, **fields):
+        with self.lock:
+            self.entries.setdefault(key, {}).update(fields)
+            self.updated.add(key)
+
+    def save(self, merge=False):
+        """ Write the manifest atomically, so a crash never leaves a truncated file behind.
+            With merge, the entries updated by this process are merged into the manifest on
+            disk under a lock, for manifests written by several hosts at the same time.
+        """
+        with self.lock:
+            if not merge:
+                self.write(self.entries)
+                return
+            with open(self.path + '.lock', 'a') as lock_fd:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+                try:
+                    entries = {}
+                    if os.path.exists(self.path):
+                        with open(self.path, 'r') as fd:
+                            entries = json.load(fd)
+                    entries.update((key, self.entries[key]) for key in self.updated)
+                    self.write(entries)
+                    self.entries = entries
+                finally:
+                    fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    def write(self, entries):
+        tmp_name = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_name, 'w') as fd:
+            json.dump(entries, fd, indent=1, sort_keys=True)
+        os.replace(tmp_name, self.path)
+
+
+class ZoneClaims(object):
+    """ Claims on the zones of a download folder, so that several hosts sharing the output
+        directory (over NFS, say) each download a part of the zones. A host claims a zone
+        by creating <zone>.claim in the .claims folder of the day with O_EXCL, which only
+        one host can do, and records the outcome in <zone>.done once it is through with it.
+        Claims are touched while their zone downloads. A claim that was not touched for
+        timeout seconds belongs to a host that died, and is taken over by the next host that
+        wants the zone. Ages are taken from the clock of the file server, so the hosts'
+        clocks do not have to agree.
+    """
+    def __init__(self, directory, node, timeout):
+        self.path = os.path.join(directory, '.claims')
+        os.makedirs(self.path, exist_ok=True)
+        self.node = node
+        self.timeout = timeout
+        self.owner = {'node': node, 'pid': os.getpid()}
+        self.clock_name = os.path.join(self.path, '.clock.{}.{}'.format(node, os.getpid()))
+        self.lock = threading.Lock()
+        self.held = set()
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self.touch_claims, name='zone-claims', daemon=True)
+        self.heartbeat.start()
+
+    def file_name(self, zone_name, suffix):
+        return os.path.join(self.path, zone_name + suffix)
+
+    def now(self):
+        """ Current time of the file server, from a file we touch
+        """
+        with open(self.clock_name, 'a'):
+            os.utime(self.clock_name)
+        return os.stat(self.clock_name).st_mtime
+
+    def is_done(self, zone_name):
+        return os.path.exists(self.file_name(zone_name, '.done'))
+
+    def claim(self, zone_name):
+        """ Claim a zone. Returns True if it is ours to download, False if it is done or
+            another host has a live claim on it.
+        """
+        claim_name = self.file_name(zone_name, '.claim')
+        for attempt in range(2):
+            if self.is_done(zone_name):
+                return False
+            try:
+                fd = os.open(claim_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                if attempt or not self.take_over(zone_name):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as out_fd:
+                json.dump(dict(self.owner, claimed=datetime.datetime.now().isoformat()), out_fd)
+            with self.lock:
+                self.held.add(zone_name)
+            # the host whose claim we took over may just have finished the zone after all
+            if self.is_done(zone_name):
+                self.release(zone_name)
+                return False
+            return True
+        return False
+
+    def take_over(self, zone_name):
+        """ Remove the claim on a zone if it is stale. Returns True if the zone is free now.
+        """
+        claim_name = self.file_name(zone_name, '.claim')
+        try:
+            if self.now() - os.stat(claim_name).st_mtime < self.timeout:
+                return False
+        except FileNotFoundError:
+            return True
+        # of the hosts that found the claim stale, only one gets to rename it away
+        stale_name = '{}.{}.{}.stale'.format(claim_name, self.node, os.getpid())
+        try:
+            os.rename(claim_name, stale_name)
+        except FileNotFoundError:
+            return False
+        try:
+            if self.now() - os.stat(stale_name).st_mtime < self.timeout:
+                # another host took the claim over between our stat and the rename: give it back
+                try:
+                    os.link(stale_name, claim_name)
+                except FileExistsError:
+                    pass
+                return False
+            with open(stale_name, 'r') as in_fd:
+                previous = json.load(in_fd)
+            logging.warning("Taking over zone '{}' from node {} (pid {}), its claim is stale"
+                            .format(zone_name, previous.get('node'), previous.get('pid')))
+        except (OSError, ValueError) as e:
+            logging.warning("Taking over zone '{}' from a stale claim ({})".format(zone_name, e))
+        finally:
+            os.remove(stale_name)
+        return True
+
+    def release(self, zone_name):
+        """ Give up the claim on a zone, unless another host has taken it over since
+        """
+        with self.lock:
+            self.held.discard(zone_name)
+        claim_name = self.file_name(zone_name, '.claim')
+        try:
+            with open(claim_name, 'r') as in_fd:
+                owner = json.load(in_fd)
+            if owner.get('node') == self.node and owner.get('pid') == os.getpid():
+                os.remove(claim_name)
+        except (OSError, ValueError):
+            pass
+
+    def finish(self, zone_name, **result):
+        """ Record the outcome of a zone we claimed, which makes it done for all hosts
+        """
+        done_name = self.file_name(zone_name, '.done')
+        tmp_name = '{}.{}.{}.tmp'.format(done_name, self.node, os.getpid())
+        with open(tmp_name, 'w') as out_fd:
+            json.dump(dict(result, node=self.node, finished=datetime.datetime.now().isoformat()), out_fd)
+        os.replace(tmp_name, done_name)
+        self.release(zone_name)
+
+    def results(self):
+        """ {zone name: outcome} of all zones that are done, whichever host did them
+        """
+        results = {}
+        for file_name in os.listdir(self.path):
+            if file_name.endswith('.done'):
+                try:
+                    with open(os.path.join(self.path, file_name), 'r') as in_fd:
+                        results[file_name[:-len('.done')]] = json.load(in_fd)
+                except (OSError, ValueError) as e:
+                    logging.warning("Ignoring unreadable zone result '{}' ({})".format(file_name, e))
+        return results
+
+    def claim_summary(self):
+        """ True for the one host that reports on the whole run
+        """
+        try:
+            os.close(os.open(os.path.join(self.path, '.summary'), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            return True
+        except FileExistsError:
+            return False
+
+    def touch_claims(self):
+        while not self.stopped.wait(self.timeout / 4.0):
+            with self.lock:
+                held = list(self.held)
+            for zone_name in held:
+                try:
+                    os.utime(self.file_name(zone_name, '.claim'))
+                except OSError as e:
+                    logging.warning("Could not refresh the claim on zone '{}' ({})".format(zone_name, e))
+
+    def close(self):
+        self.stopped.set()
+        self.heartbeat.join()
+        if os.path.exists(self.clock_name):
+            os.remove(self.clock_name)
+
+
 class CZDSDownloader(object):
     def __init__(self, config_file):
         """ Create a session
@@ -26,13 +791,46 @@ class CZDSDownloader(object):
         self.s = requests.Session()
         self.td = datetime.datetime.today()
         self.config = None
+        self.notifier = None
         self.load_config(config_file)
+        if self.get_config_item('send_mail', True):
+            max_mails_per_hour = int(self.get_config_item('max_mails_per_hour', 6))
+            if max_mails_per_hour < 1:
+                self.send_msg("Invalid max_mails_per_hour {}, must be at least 1".format(max_mails_per_hour))
+                sys.exit(1)
+            self.notifier = Notifier(self.get_config_item('smtp.server'),
+                                     self.get_config_item('smtp.server.port'),
+                                     self.get_config_item('smtp.server.starttls'),
+                                     self.get_config_item('smtp.username'),
+                                     self.get_config_item('smtp.password'),
+                                     self.get_config_item('sender'),
+                                     self.get_config_item('recipient'),
+                                     self.get_config_item('mail_digest_interval', 300),
+                                     max_mails_per_hour)
+            # mails still queued are sent whichever way we exit
+            atexit.register(self.notifier.close)
         self.retries = 0
         self.downloaded_zones = 0
+        self.unchanged_zones = 0
+        self.interrupted_transfers = 0
+        # guards the counters above when zones are downloaded in parallel
+        self.lock = threading.Lock()
+        self.max_parallel_downloads = max(1, int(self.get_config_item('max_parallel_downloads', 1)))
+        # write zones in whole multiples of 64 KiB
+        self.buffer_size = -(-int(self.get_config_item('output_buffer_size', 1024*1024)) // 65536) * 65536
+        self.receive_into_buffer = self.get_config_item('receive_into_buffer', False)
+        self.fsync = self.get_config_item('fsync', 'none')
+        if self.fsync not in ('none', 'file', 'run'):
+            self.send_msg("Invalid fsync policy '{}', must be one of none, file or run".format(self.fsync))
+            sys.exit(1)
+        # files still to be synced at the end of the run
+        self.unsynced_files = []
         # these will be set up as we go
         self.config_fd = None
         self.directory = None
         self.access_token = None
+        self.token_expires = None
+        self.token_lock = threading.Lock()
         self.downloadable_zones = 0
         # set up everything, including logging
         self.prepare_download_folder()
@@ -42,6 +840,89 @@ class CZDSDownloader(object):
                             'https': self.get_config_item('proxy.https')}
         else:
             self.proxies = None
+        self.setup_session()
+        self.scheduler = RequestScheduler(self.get_config_item('max_request_rate', 5),
+                                          self.get_config_item('min_request_rate', 0.1),
+                                          int(self.get_config_item('max_requests_per_host',
+                                                                   self.max_parallel_downloads + 1)),
+                                          self.get_config_item('retry_backoff', 1.0),
+                                          self.get_config_item('max_retry_backoff', 300))
+        self.token_cache = TokenCache(self.get_config_item('token_cache_file',
+                                                           self.get_config_item('output_directory') +
+                                                           '/.czds-token.json'),
+                                      self.get_config_item('czds.user'))
+        # refresh the token this many seconds before it expires
+        self.token_refresh_margin = self.get_config_item('token_refresh_margin', 300)
+        # incremental mode: remember validators per zone and reuse unchanged files
+        if self.get_config_item('incremental', False):
+            self.manifest = ZoneManifest(self.get_config_item('manifest_file',
+                                                              self.get_config_item('output_directory') +
+                                                              '/zone-manifest.json'))
+        else:
+            self.manifest = None
+        # checksums and sizes of the zones downloaded into today's folder
+        self.day_manifest = ZoneManifest(self.directory + '/manifest.json')
+        # sharded mode: the hosts sharing output_directory split the zones between them
+        if self.get_config_item('sharded', False):
+            self.node_name = self.get_config_item('node_name', socket.gethostname())
+            self.claims = ZoneClaims(self.directory, self.node_name, float(self.get_config_item('claim_timeout', 300)))
+        else:
+            self.node_name = None
+            self.claims = None
+        # whether this host reports on the run; in sharded mode, the first host to see all zones done does
+        self.summary_node = True
+        self.shard_totals = None
+        self.metrics = RunMetrics()
+        # keep zone files once by content, with the day folders linking to them
+        if self.get_config_item('content_store', False):
+            self.store = casstore.ContentStore(self.get_config_item('content_store_path',
+                                                                    self.get_config_item('output_directory') +
+                                                                    '/.store'))
+        else:
+            self.store = None
+        # post-download stages that are switched on, and the jobs for them
+        self.stages = [(name, suffix, function) for key, name, suffix, function in POST_DOWNLOAD_STAGES
+                       if self.get_config_item(key, False)]
+        self.stage_options = {'gzindex': {'span': int(self.get_config_item('gzip_index_span', 16*1024*1024))}}
+        self.stage_pool = None
+        self.stage_jobs = {}
+
+    def setup_session(self):
+        """ All requests to CZDS go through self.s, so connections to the download host
+            are kept alive and reused by the download workers instead of doing a new
+            TCP and TLS handshake for every zone.
+        """
+        pool_size = int(self.get_config_item('http_pool_size', self.max_parallel_downloads + 1))
+        # seconds to connect, and to wait for each read of a response
+        connect_timeout, read_timeout = self.get_config_item('http_timeout', [30, 300])
+        self.adapter = TimeoutHTTPAdapter((float(connect_timeout), float(read_timeout)), pool_connections=4,
+                                          pool_maxsize=pool_size, pool_block=True)
+        self.s.mount('https://', self.adapter)
+        self.s.mount('http://', self.adapter)
+        self.s.headers.update({'Content-Type': 'application/json',
+                               'Accept': 'application/json'})
+        logging.debug('HTTP connection pool size is {}'.format(pool_size))
+
+    def request(self, method, url, **kwargs):
+        """ Send a request with the session. The configured proxies are passed with every
+            request: requests lets proxies from the environment override those of the
+            session, but not those of the request.
+        """
+        return self.s.request(method, url, proxies=self.proxies, **kwargs)
+
+    def connection_stats(self):
+        """ Return (opened, reused) connection counts over all connection pools of the session
+        """
+        managers = [self.adapter.poolmanager] + list(self.adapter.proxy_manager.values())
+        opened = requests_made = 0
+        for manager in managers:
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                opened += pool.num_connections
+                requests_made += pool.num_requests
+        return opened, max(0, requests_made - opened)
 
     def load_config(self, cfg_file):
         try:
@@ -66,166 +947,732 @@ class CZDSDownloader(object):
         self.directory = self.get_config_item('output_directory') + '/' + self.td.strftime('%Y-%m-%d')
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
+        # in daemon mode, the log moves on to the folder of the next day with the downloads
+        for handler in logging.root.handlers[:]:
+            logging.root.removeHandler(handler)
+            handler.close()
         logging.basicConfig(filename=self.directory + "/download.log", level=logging.DEBUG,
                             format='%(asctime)s %(levelname)s:%(name)s:%(module)s:%(funcName)s: %(message)s',
                             datefmt='%Y-%m-%d %H:%M:%S')
 
     def czds_authenticate(self):
-        auth_headers = {'Content-Type': 'application/json',
-                        'Accept': 'application/json'}
+        """ Get an access token, from the token cache if it holds one that is still valid
+            for a while, otherwise by logging in to CZDS.
+        """
+        started = time.monotonic()
+        try:
+            with self.token_cache.locked():
+                token, expires = self.token_cache.load()
+                if token and expires and expires - time.time() > self.token_refresh_margin:
+                    self.set_token(token, expires)
+                    self.metrics.timing('auth_seconds', time.monotonic() - started)
+                    logging.info('Using cached CZDS access token for {}, valid until {}'
+                                 .format(self.get_config_item('czds.user'),
+                                         datetime.datetime.fromtimestamp(expires)))
+                    return
+                self.set_token(*self.request_token())
+                self.metrics.timing('auth_seconds', time.monotonic() - started)
+        except CZDSError as e:
+            self.send_msg(str(e))
+            sys.exit(1)
+        except OSError as e:
+            self.send_msg("Failed to use token cache '{}' ({})".format(self.token_cache.path, e))
+            sys.exit(1)
 
+    def request_token(self):
+        """ Log in to CZDS and store the new token in the token cache. Returns (token, expiry),
+            raises CZDSError if CZDS does not give us a token.
+        """
         credentials = {'username': self.get_config_item('czds.user'),
                        'password': self.get_config_item('czds.password')}
 
         auth_url = self.get_config_item('czds.auth_url') + '/api/authenticate'
 
         try:
-            response = requests.post(auth_url, data=json.dumps(credentials),
-                                     headers=auth_headers, proxies=self.proxies)
+            with self.scheduler.slot(auth_url):
+                response = self.request('POST', auth_url, data=json.dumps(credentials))
+        except requests.exceptions.RequestException as e:
+            raise CZDSError("Failed to POST to '{}' ({})".format(auth_url, e))
 
-            if response.status_code == 200:
-                self.access_token = response.json()['accessToken']
-                logging.info('Authenticated to CZDS as {}'.format(self.get_config_item('czds.user')))
-            elif response.status_code == 404:
-                self.send_msg("Invalid URL '{}' (returns a 404)".format(auth_url))
-                sys.exit(1)
-            elif response.status_code == 401:
-                self.send_msg("Authentication to CZDS for {} failed with 401, not authorized"
-                              .format(self.get_config_item('czds.user')))
-                sys.exit(1)
-            elif response.status_code == 500:
-                self.send_msg("CZDS server returned a 500 Internal Server Error for POST to '{}'".format(auth_url))
-                sys.exit(1)
-            else:
-                self.send_msg("CZDS returned {} for POST to '{}'".format(response.status_code, auth_url))
-                sys.exit(1)
-        except Exception as e:
-            self.send_msg("Failed to POST to '{}' ({})".format(auth_url, e))
-            sys.exit(1)
+        if response.status_code == 200:
+            try:
+                token = response.json()['accessToken']
+            except (KeyError, ValueError) as e:
+                raise CZDSError("No access token in the response to POST to '{}' ({})".format(auth_url, e))
+        elif response.status_code == 404:
+            raise CZDSError("Invalid URL '{}' (returns a 404)".format(auth_url))
+        elif response.status_code == 401:
+            raise CZDSError("Authentication to CZDS for {} failed with 401, not authorized"
+                            .format(self.get_config_item('czds.user')))
+        elif response.status_code == 500:
+            raise CZDSError("CZDS server returned a 500 Internal Server Error for POST to '{}'".format(auth_url))
+        else:
+            raise CZDSError("CZDS returned {} for POST to '{}'".format(response.status_code, auth_url))
 
-    def send_msg(self, msg, fail=True):
-        smtp_username = self.get_config_item("smtp.username")
-        smtp_password = self.get_config_item("smtp.password")
+        # CZDS tokens are valid for 24 hours, in case the token does not tell us itself
+        expires = TokenCache.jwt_expiry(token) or time.time() + 24 * 3600
+        self.token_cache.store(token, expires)
+        logging.info('Authenticated to CZDS as {}, token valid until {}'
+                     .format(self.get_config_item('czds.user'), datetime.datetime.fromtimestamp(expires)))
+        return token, expires
 
-        sender = self.get_config_item('sender')
-        rcpt = self.get_config_item('recipient')
+    def set_token(self, token, expires):
+        self.access_token = token
+        self.token_expires = expires
+        self.s.headers['Authorization'] = 'Bearer {0}'.format(token)
 
-        message = 'From: {}\n'.format(sender)
-        message += 'To: {}\n'.format(rcpt)
-        if fail:
-            message += 'Subject: FAILURE to fetch data from ICANN CZDS\n\n'
-        else:
-            message += 'Subject: SUCCESS in fetching data from ICANN CZDS\n\n'
-        message += msg
+    def refresh_token(self, stale_token):
+        """ Replace stale_token, unless another worker (or another process sharing the token
+            cache) already did. Raises GetError if we cannot get a new token.
+        """
+        with self.token_lock:
+            if self.access_token != stale_token:
+                return
+            try:
+                with self.token_cache.locked():
+                    token, expires = self.token_cache.load()
+                    if token and token != stale_token and expires and \
+                            expires - time.time() > self.token_refresh_margin:
+                        logging.info('Picked up a new CZDS access token from the token cache')
+                    else:
+                        token, expires = self.request_token()
+                    self.set_token(token, expires)
+            except (CZDSError, OSError) as e:
+                raise GetError("Failed to refresh CZDS access token ({})".format(e))
 
+    def send_msg(self, msg, fail=True):
+        """ Report a message on stderr and queue it for mailing. Never waits for the mail relay.
+        """
         sys.stderr.write('{}\n'.format(msg))
         sys.stderr.flush()
+        if self.notifier is None:
+            logging.info('Not sending e-mail: {}'.format(msg))
+            return
+        self.notifier.notify(msg, fail)
+
+    def get_with_token(self, url, stream=False, headers=None):
+        token = self.access_token
+        if self.token_expires and self.token_expires - time.time() < self.token_refresh_margin:
+            self.refresh_token(token)
+            token = self.access_token
 
         try:
-            smtpobj = smtplib.SMTP(self.get_config_item('smtp.server'),
-                                   self.get_config_item('smtp.server.port'))
-            if self.get_config_item('smtp.server.starttls'):
-                smtpobj.ehlo()
-                smtpobj.starttls()
-            else:
-                smtpobj.helo()
-            smtpobj.login(smtp_username, smtp_password)
-            smtpobj.sendmail(sender, rcpt, message)
-            smtpobj.close()
-        except smtplib.SMTPException as e:
-            logging.error('Failed to send failure e-mail: {}'.format(str(e)))
-
-    def get_with_token(self, url, stream=False):
-        try:
-            bearer_token_headers = {'Content-Type': 'application/json',
-                                    'Accept': 'application/json',
-                                    'Authorization': 'Bearer {0}'.format(self.access_token)}
-
-            response = requests.get(url, headers=bearer_token_headers, stream=stream, proxies=self.proxies)
-
-            if response.status_code == 200:
-                return response
-            elif response.status_code == 404:
-                raise GetError("GET for '{}' returned 404 (not found)".format(url))
-            elif response.status_code == 401:
-                raise GetError("GET for '{}' returned 401 (not authorised)".format(url))
-            elif response.status_code == 500:
-                raise GetError("GET for '{}' returned 500 (internal server error)".format(url))
-            else:
-                raise GetError("GET for '{}' returned error {}".format(url, response.status_code))
-        except Exception as e:
+            with self.scheduler.slot(url):
+                response = self.request('GET', url, stream=stream, headers=headers)
+            if response.status_code == 401:
+                # the token expired or was revoked under us: get a new one and try again
+                # straight away, this does not count as a retry
+                response.close()
+                logging.info("GET for '{}' returned 401, refreshing the access token".format(url))
+                self.refresh_token(token)
+                with self.scheduler.slot(url):
+                    response = self.request('GET', url, stream=stream, headers=headers)
+        except requests.exceptions.RequestException as e:
             raise GetError("Failed to GET '{}' ({})".format(url, e))
 
+        retry_after = self.scheduler.parse_retry_after(response.headers.get('Retry-After'))
+        self.scheduler.feedback(response.status_code, retry_after)
+
+        # 206 and 304 can only come back for range and conditional requests,
+        # the caller deals with them
+        if response.status_code in (200, 206, 304):
+            return response
+        # hand the connection back to the pool before giving up on this response
+        response.close()
+        if response.status_code == 404:
+            message = "GET for '{}' returned 404 (not found)".format(url)
+        elif response.status_code == 401:
+            message = "GET for '{}' returned 401 (not authorised)".format(url)
+        elif response.status_code == 429:
+            message = "GET for '{}' returned 429 (too many requests)".format(url)
+        elif response.status_code == 500:
+            message = "GET for '{}' returned 500 (internal server error)".format(url)
+        else:
+            message = "GET for '{}' returned error {}".format(url, response.status_code)
+        raise GetError(message, status_code=response.status_code, retry_after=retry_after)
+
+    def with_retries(self, caller, request, zone_name=None):
+        """ Call request() until it does not raise GetError, waiting between attempts as the
+            scheduler says. Every operation (the zone list, each zone) gets its own budget
+            of max_retries retries, so a bad patch early in the run does not use up the
+            retries of the zones that come later. Raises CZDSError when the budget is spent.
+        """
+        max_retries = self.get_config_item('max_retries')
+        attempt = 0
+        while True:
+            try:
+                return request()
+            except GetError as e:
+                if attempt >= max_retries:
+                    raise CZDSError("Maximum number of retries reached in {} ({})".format(caller, e))
+                delay = self.scheduler.delay(attempt, e.retry_after)
+                with self.lock:
+                    self.retries += 1
+                if zone_name:
+                    self.metrics.add(zone_name, 'retries')
+                logging.error("Caught exception in {}, retry #{} in {:.1f}s. Error: {}"
+                              .format(caller, attempt + 1, delay, e))
+                sys.stderr.write("Caught exception in {}, retry #{} in {:.1f}s. Error: {}\n"
+                                 .format(caller, attempt + 1, delay, e))
+                time.sleep(delay)
+                attempt += 1
+
     def get_zonefiles_list(self):
         """ Get all the files that need to be downloaded using CZDS API.
         """
         # Fetch the list of zones
-        while self.retries <= self.get_config_item('max_retries'):
-            zonelist_url = self.get_config_item("czds.download_base_url") + '/czds/downloads/links'
+        zonelist_url = self.get_config_item("czds.download_base_url") + '/czds/downloads/links'
+        started = time.monotonic()
+        zonelist_response = self.with_retries('get_zonefiles_list',
+                                              lambda: self.get_with_token(zonelist_url).json())
+        self.metrics.timing('zonelist_seconds', time.monotonic() - started)
+        try:
+            # remove duplicate zone files
+            full_list = list(zonelist_response)
+            distinct_list = list(set(zonelist_response))
+            if len(distinct_list) != len(full_list):
+                logging.warning("Duplicate entries in zonefile list.")
+                sys.stderr.write("Duplicate entries in zonefile list.\n")
+                self.send_msg("Duplicate entries in zonefile list.")
+        except Exception as e:
+            raise CZDSError("Unable to parse JSON returned from CZDS: \n" + str(e))
+
+        self.downloadable_zones = len(distinct_list)
+        logging.info("get_zonefiles_list returns {} zones".format(len(distinct_list)))
+        logging.debug("get_zonefiles_list returning zones are: {}".format(distinct_list))
+        return distinct_list
+
+    def fetch_zone(self, zone, zone_name, headers=None):
+        """ Do a regular GET call to fetch zonefile. Extra headers (e.g. for a conditional
+            request) are passed on to the GET.
+        """
+        logging.debug("Downloading zone '{}' from '{}'".format(zone_name, zone))
+
+        try:
+            download = self.with_retries('fetch_zone', lambda: self.get_with_token(zone, stream=True, headers=headers),
+                                         zone_name)
+        except CZDSError as e:
+            logging.error("Maximum number of retries reached while trying to obtain zone {} ({})".format(zone_name, e))
+            self.send_msg("Maximum number of retries reached while trying to obtain zone {}".format(zone_name))
+            raise CZDSError("Maximum number of retries reached while trying to obtain zone {}".format(zone_name))
+
+        if download.status_code == 304:
+            return download
+
+        if 'Content-Type' not in download.headers:
+            self.send_msg("GET for '{}' did not return a content type in the header".format(zone))
+            raise CZDSError("GET for '{}' did not return a content type in the header".format(zone))
+
+        if download.headers['Content-Type'] != 'application/x-gzip':
+            self.send_msg("Unsupported content type '{}' for '{}'"
+                          .format(download.headers['Content-Type'], zone))
+            raise CZDSError("Unsupported content type '{}' for '{}'"
+                            .format(download.headers['Content-Type'], zone))
+        return download
+
+    @staticmethod
+    def conditional_headers(previous):
+        """ Request headers that let the server answer 304 if the zone did not change
+            since the previous download
+        """
+        headers = {}
+        if previous is None or not os.path.exists(previous.get('path', '')):
+            return headers
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
+        return headers
+
+    @staticmethod
+    def is_unchanged(download, previous):
+        """ Does the response describe the same zone file as the previous download?
+            Not all servers honour conditional requests, so compare the validators too.
+        """
+        if download.status_code == 304:
+            return True
+        if previous is None:
+            return False
+        etag = download.headers.get('ETag')
+        if etag and etag == previous.get('etag'):
+            return True
+        last_modified = download.headers.get('Last-Modified')
+        content_length = download.headers.get('Content-Length')
+        return bool(last_modified and content_length and
+                    last_modified == previous.get('last_modified') and
+                    content_length == previous.get('content_length'))
+
+    def reuse_previous(self, zone_name, previous, out_name):
+        """ Put the previous download of an unchanged zone into today's folder, as a hardlink
+            where possible. Returns False if the previous file cannot be used.
+        """
+        prev_name = previous.get('path', '')
+        if os.path.abspath(prev_name) == os.path.abspath(out_name):
+            return os.path.exists(out_name)
+        try:
+            if os.path.exists(out_name):
+                os.remove(out_name)
             try:
-                zonelist_response = self.get_with_token(zonelist_url).json()
-            except GetError as e:
-                logging.error("Caught exception in get_zonefiles_list, retry #{}. Error: {}".format(self.retries, e))
-                sys.stderr.write("Caught exception in get_zonefiles_list, retry #{}. Error: {}".format(self.retries, e))
-                if self.retries == self.get_config_item('max_retries'):
-                    raise CZDSError("Maximum number of retries reached while trying to obtain zonelist.")
-                else:
-                    self.retries += 1
-            else:
+                os.link(prev_name, out_name)
+            except OSError:
+                shutil.copyfile(prev_name, out_name)
+        except OSError as e:
+            logging.warning("Could not reuse '{}' for zone '{}' ({})".format(prev_name, zone_name, e))
+            return False
+        logging.info("Zone '{}' unchanged since {}, reusing {}".format(zone_name, previous.get('date'), prev_name))
+        return True
+
+    def stream_checks(self, out_name):
+        """ Fresh set of checks to run on the stream of a zone while it is written
+        """
+        checks = [ZoneDigest()]
+        if self.get_config_item('gzip_index', False):
+            checks.append(GzipIndexCheck(out_name[:-3] + '.gzi', self.stage_options['gzindex']['span']))
+        elif self.get_config_item('verify_gzip', False):
+            checks.append(GzipCheck())
+        if self.get_config_item('zone_stats', False):
+            checks.append(ZoneStatsCheck(out_name[:-3] + '.stats.json', os.path.basename(out_name)[:-3]))
+        return checks
+
+    @staticmethod
+    def abort_checks(checks):
+        """ Stop the checks that run on a thread of their own, for a stream that is given up
+        """
+        for check in checks:
+            if hasattr(check, 'abort'):
+                check.abort()
+
+    def receive(self, download, buffer):
+        """ Read the body of download into the preallocated buffer and yield the filled part
+            each time it is full (and once more at the end). Socket reads are often much
+            smaller than the buffer, this keeps the writes large and of a fixed size.
+        """
+        view = memoryview(buffer)
+        filled = 0
+        try:
+            while True:
+                n = download.raw.readinto(view[filled:])
+                if n == 0:
+                    break
+                filled += n
+                if filled == len(view):
+                    yield view
+                    filled = 0
+        except urllib3.exceptions.HTTPError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        if filled:
+            yield view[:filled]
+
+    def chunks(self, download, buffer):
+        # Content-Encoding has to be undone by requests, the raw stream would still be encoded
+        if self.receive_into_buffer and 'Content-Encoding' not in download.headers:
+            return self.receive(download, buffer)
+        return download.iter_content(self.buffer_size)
+
+    @staticmethod
+    def sync_file(file_name):
+        """ Flush a file and the directory entry pointing to it to disk
+        """
+        fd = os.open(file_name, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        fd = os.open(os.path.dirname(file_name) or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def write_zone(self, zone, zone_name, download, out_name):
+        """ Stream a zone into <out_name>.part and rename it to out_name once it is complete.
+            If the transfer breaks off, the zone is requested again, continuing from the last
+            byte written with a Range request if the server supports it. Each interruption is
+            charged the bytes that have to be transferred again (at least one buffer), and we
+            give up on the zone once that exceeds max_retry_lost_bytes. The stream checks see
+            every byte on the way; if they find the zone corrupt it is fetched again from the
+            start. Returns the last response and the results of the checks.
+        """
+        part_name = out_name + '.part'
+        max_lost_bytes = int(self.get_config_item('max_retry_lost_bytes', 1024*1024*1024))
+        buffer = bytearray(self.buffer_size) if self.receive_into_buffer else None
+        lost_bytes = 0
+        written = 0
+        checks = self.stream_checks(out_name)
+        started = time.monotonic()
+
+        # If-Range makes the server send the whole zone again if it changed in the meantime
+        validator = download.headers.get('ETag') or download.headers.get('Last-Modified')
+        resumable = download.headers.get('Accept-Ranges') == 'bytes' and validator is not None
+        expected = download.headers.get('Content-Length')
+        expected = int(expected) if expected is not None else None
+
+        # chunks are large, so write them straight to the file without another buffer
+        try:
+            with open(part_name, 'wb', buffering=0) as out_fd:
+                while True:
+                    try:
+                        for chunk in self.chunks(download, buffer):
+                            out_fd.write(chunk)
+                            for check in checks:
+                                check.update(chunk)
+                            written += len(chunk)
+                        if expected is not None and written != expected:
+                            raise requests.exceptions.ChunkedEncodingError(
+                                'got {} of {} bytes'.format(written, expected))
+                        results = {}
+                        for check in checks:
+                            results.update(check.finish())
+                        break
+                    except (requests.exceptions.RequestException, CorruptZoneError) as e:
+                        download.close()
+                        with self.lock:
+                            self.interrupted_transfers += 1
+                        self.metrics.add(zone_name, 'interruptions')
+                        logging.warning("Transfer of zone '{}' failed after {} bytes ({})"
+                                        .format(zone_name, written, e))
+                        headers = None
+                        if resumable and not isinstance(e, CorruptZoneError):
+                            headers = {'Range': 'bytes={}-'.format(written), 'If-Range': validator}
+                        download = self.fetch_zone(zone, zone_name, headers=headers)
+                        if headers and download.status_code == 206 and \
+                                download.headers.get('Content-Range', '').startswith('bytes {}-'.format(written)):
+                            lost_bytes += self.buffer_size
+                            logging.info("Resuming zone '{}' at byte {}".format(zone_name, written))
+                        else:
+                            # the server sent the whole zone again, start over
+                            lost_bytes += max(written, self.buffer_size)
+                            out_fd.seek(0)
+                            out_fd.truncate()
+                            written = 0
+                            self.abort_checks(checks)
+                            checks = self.stream_checks(out_name)
+                        if download.headers.get('Content-Length') is not None:
+                            expected = written + int(download.headers['Content-Length'])
+                        if lost_bytes > max_lost_bytes:
+                            download.close()
+                            raise CZDSError("Giving up on zone '{}' after losing {} bytes to failed transfers"
+                                            .format(zone_name, lost_bytes))
+                download.close()
+                if self.fsync == 'file':
+                    os.fsync(out_fd.fileno())
+        except BaseException:
+            self.abort_checks(checks)
+            raise
+
+        os.replace(part_name, out_name)
+        if self.fsync == 'file':
+            self.sync_file(out_name)
+        elif self.fsync == 'run':
+            with self.lock:
+                self.unsynced_files.append(out_name)
+
+        seconds = time.monotonic() - started
+        results['transfer_seconds'] = round(seconds, 3)
+        logging.info("Wrote {} bytes of zone '{}' in {:.1f}s ({:.2f} MB/s)"
+                     .format(written, zone_name, seconds, written / 1e6 / max(seconds, 1e-6)))
+        return download, results
+
+    @staticmethod
+    def file_digest(file_name):
+        """ ZoneDigest of a file that is already on disk
+        """
+        digest = ZoneDigest()
+        with open(file_name, 'rb') as in_fd:
+            for data in iter(lambda: in_fd.read(1024*1024), b''):
+                digest.update(data)
+        return digest.finish()
+
+    def download_zone(self, zone, zone_name):
+        """ Fetch a single zone and write it to the download folder. Runs on a worker thread.
+            Returns True if the zone was written. A failure to fetch or write the zone is
+            logged and only affects this zone; running out of disk space raises CZDSError.
+        """
+        out_name = '{}/{}.gz'.format(self.directory, zone_name)
+        previous = self.manifest.get(zone) if self.manifest else None
+
+        try:
+            download = self.fetch_zone(zone, zone_name, headers=self.conditional_headers(previous))
+            if self.manifest and self.is_unchanged(download, previous):
+                download.close()
+                if self.reuse_previous(zone_name, previous, out_name):
+                    if 'sha256' not in previous:
+                        previous.update(self.file_digest(out_name))
+                    self.manifest.update(zone, path=os.path.abspath(out_name), date=self.td.strftime('%Y-%m-%d'),
+                                         sha256=previous['sha256'], size=previous['size'])
+                    self.day_manifest.update(zone_name, url=zone, sha256=previous['sha256'], size=previous['size'],
+                                             gzip_ok=previous.get('gzip_ok'), reused=previous.get('path'))
+                    self.store_zone(zone_name, out_name, previous['sha256'])
+                    self.metrics.zone(zone_name, status='unchanged', size=previous['size'], reused=True,
+                                      ttfb_seconds=round(download.elapsed.total_seconds(), 6))
+                    self.post_process(zone_name, out_name, previous)
+                    with self.lock:
+                        self.downloaded_zones += 1
+                        self.unchanged_zones += 1
+                    return True
+                download = self.fetch_zone(zone, zone_name)
+        except CZDSError as e:
+            logging.error("Failed to download zone: " + str(e))
+            return False
+
+        self.metrics.zone(zone_name, ttfb_seconds=round(download.elapsed.total_seconds(), 6))
+        if 'Content-Length' in download.headers:
+            logging.info('Downloading {} bytes to {}'.format(download.headers['Content-Length'], out_name))
+        else:
+            logging.info('Downloading to {}'.format(out_name))
+
+        try:
+            download, results = self.write_zone(zone, zone_name, download, out_name)
+        except CZDSError as e:
+            download.close()
+            logging.error("Failed to download zone: " + str(e))
+            return False
+        except OSError as e:
+            download.close()
+            self.send_msg("Failed to write zone '{}' to file ({})".format(zone_name, e))
+            # no point in carrying on with the other zones if the disk is full
+            if e.errno in (errno.ENOSPC, errno.EDQUOT, errno.EROFS):
+                raise CZDSError("Failed to write zone '{}' to file ({})".format(zone_name, e))
+            logging.error("Failed to write zone '{}' to file ({})".format(zone_name, e))
+            return False
+
+        self.day_manifest.update(zone_name, url=zone, completed=datetime.datetime.now().isoformat(), **results)
+        self.store_zone(zone_name, out_name, results['sha256'])
+        self.metrics.zone(zone_name, status='downloaded', size=results['size'],
+                          transfer_seconds=results['transfer_seconds'])
+        if self.manifest:
+            self.manifest.update(zone,
+                                 etag=download.headers.get('ETag'),
+                                 last_modified=download.headers.get('Last-Modified'),
+                                 content_length=str(results['size']),
+                                 path=os.path.abspath(out_name),
+                                 date=self.td.strftime('%Y-%m-%d'),
+                                 **results)
+        # the gzip index and the statistics were built on the stream
+        self.post_process(zone_name, out_name, done=('gzindex', 'stats'))
+        with self.lock:
+            self.downloaded_zones += 1
+        return True
+
+    def store_zone(self, zone_name, out_name, sha256):
+        """ Put a zone file into the content-addressed store, if there is one. A zone file
+            that cannot be stored stays in the day folder as it is.
+        """
+        if not self.store:
+            return
+        try:
+            blob = self.store.adopt(out_name, sha256)
+        except OSError as e:
+            logging.warning("Could not put zone '{}' into the content store ({})".format(zone_name, e))
+            return
+        if blob is None:
+            logging.warning("Could not link zone '{}' with the content store, is it on another file system?"
+                            .format(zone_name))
+            return
+        self.day_manifest.update(zone_name, blob=blob)
+
+    def post_process(self, zone_name, out_name, previous=None, done=()):
+        """ Hand a zone file that was written (or reused) to the post-download stages, as soon
+            as it is there. For an unchanged zone, the outputs of the previous run are reused.
+            Stages in done were already taken care of.
+        """
+        for stage, suffix, function in self.stages:
+            if stage in done:
+                continue
+            stage_name = out_name[:-3] + suffix
+            if previous and previous.get('path', '').endswith('.gz'):
+                prev_name = previous['path'][:-3] + suffix
+                if os.path.abspath(prev_name) == os.path.abspath(stage_name) and os.path.exists(stage_name):
+                    continue
                 try:
-                    # remove duplicate zone files
-                    full_list = list(zonelist_response)
-                    distinct_list = list(set(zonelist_response))
-                    if len(distinct_list) != len(full_list):
-                        logging.warning("Duplicate entries in zonefile list.")
-                        sys.stderr.write("Duplicate entries in zonefile list.\n")
-                        self.send_msg("Duplicate entries in zonefile list.")
-                except Exception as e:
-                    raise CZDSError("Unable to parse JSON returned from CZDS: \n" + str(e))
-
-                self.downloadable_zones = len(distinct_list)
-                logging.info("get_zonefiles_list returns {} zones".format(len(distinct_list)))
-                logging.debug("get_zonefiles_list returning zones are: {}".format(distinct_list))
-                return distinct_list
-
-    def fetch_zone(self, zone, zone_name):
-        """ Do a regular GET call to fetch zonefile
+                    if os.path.exists(stage_name):
+                        os.remove(stage_name)
+                    os.link(prev_name, stage_name)
+                    continue
+                except OSError:
+                    pass
+            with self.lock:
+                self.stage_jobs[(stage, zone_name)] = self.stage_pool.submit(function, out_name, stage_name,
+                                                                             zone_name,
+                                                                             **self.stage_options.get(stage, {}))
+
+    def finish_stages(self):
+        """ Wait for the post-download stages and record the outcome for each zone
         """
-        logging.debug("Downloading zone '{}' from '{}'".format(zone_name, zone))
+        with self.lock:
+            jobs = list(self.stage_jobs.items())
+        if jobs:
+            logging.info('Waiting for {} post-download jobs'.format(len([job for key, job in jobs if not job.done()])))
+        for (stage, zone_name), job in jobs:
+            try:
+                summary = job.result()
+            except (zoneparse.ZoneParseError, OSError) as e:
+                logging.error("Failed to {} zone '{}' ({})".format(stage, zone_name, e))
+                continue
+            logging.info("Zone '{}' {}: {}".format(zone_name, stage,
+                                                   ', '.join('{} {}'.format(key, value)
+                                                             for key, value in sorted(summary.items()))))
+            self.day_manifest.update(zone_name, **dict(('{}_{}'.format(stage, key), value)
+                                                       for key, value in summary.items()))
+            self.metrics.zone(zone_name, **{stage + '_seconds': summary['seconds']})
+            if 'records' in summary:
+                self.metrics.zone(zone_name, records=summary['records'])
 
-        # Never invest more than 10% of the remaining retries into fetching one zone
-        current_retries = 0
-        max_fetch_zone_retries = int(self.retries / 10)
+    def run_zone(self, zone, zone_name):
+        """ download_zone, with the outcome recorded in the run metrics. In sharded mode the
+            zone is claimed first; returns None without downloading it if another host has it.
+        """
+        if self.claims and not self.claims.claim(zone_name):
+            return None
+        succeeded = False
+        try:
+            succeeded = self.download_zone(zone, zone_name)
+        except CZDSError:
+            # a fatal error of this host, another host may well get the zone
+            if self.claims:
+                self.claims.release(zone_name)
+            raise
+        finally:
+            if not succeeded:
+                self.metrics.zone(zone_name, status='failed')
+        if self.claims:
+            entry = self.metrics.get(zone_name)
+            try:
+                self.claims.finish(zone_name, status=entry.get('status'), size=entry.get('size'))
+            except OSError as e:
+                logging.error("Failed to record the outcome of zone '{}' ({})".format(zone_name, e))
+                self.claims.release(zone_name)
+        return succeeded
 
-        while self.retries <= self.get_config_item('max_retries') and current_retries <= max_fetch_zone_retries:
+    def write_reports(self):
+        """ Write the JSON run report, and the Prometheus textfile if one is configured
+        """
+        opened, reused = self.connection_stats()
+        with self.lock:
+            report = self.metrics.report(zones_downloadable=self.downloadable_zones,
+                                         zones_downloaded=self.downloaded_zones,
+                                         zones_unchanged=self.unchanged_zones,
+                                         retries=self.retries,
+                                         throttled=self.scheduler.throttled,
+                                         interrupted_transfers=self.interrupted_transfers,
+                                         connections_opened=opened,
+                                         connections_reused=reused)
+        report_name = 'run-report.{}.json'.format(self.node_name) if self.claims else 'run-report.json'
+        outputs = [(self.get_config_item('run_report', self.directory + '/' + report_name),
+                    json.dumps(report, indent=1, sort_keys=True))]
+        if self.shard_totals and self.summary_node:
+            outputs.append((self.directory + '/run-summary.json', json.dumps(self.shard_totals, indent=1,
+                                                                             sort_keys=True)))
+        if self.get_config_item('prometheus_textfile', ''):
+            outputs.append((self.get_config_item('prometheus_textfile'), RunMetrics.prometheus(report)))
+        for file_name, text in outputs:
+            # the textfile collector may read the file at any time, so replace it in one go
             try:
-                download = self.get_with_token(zone, stream=True)
-            except GetError as e:
-                logging.error("Caught exception in fetch_zone, retry #{}. Error: {}".format(self.retries, e))
-                sys.stderr.write("Caught exception in fetch_zone, retry #{}. Error: {}".format(self.retries, e))
-                if self.retries == self.get_config_item('max_retries'):
-                    logging.error("Maximum number of retries reached while trying to obtain zonefiles. " 
-                                  "Last zone attempted (and failed): {}".format(zone_name))
-                    self.send_msg("Maximum number of retries reached while trying to obtain zonefiles. "
-                                  "Last zone attempted (and failed): {}".format(zone_name))
-                    raise CZDSError("Maximum number of retries reached while trying to obtain zonefiles. "
-                                    "Last zone attempted (and failed): {}".format(zone_name))
+                tmp_name = '{}.{}.tmp'.format(file_name, os.getpid())
+                with open(tmp_name, 'w') as out_fd:
+                    out_fd.write(text)
+                os.replace(tmp_name, file_name)
+            except OSError as e:
+                logging.error("Failed to write run report '{}' ({})".format(file_name, e))
+
+    def combine_results(self):
+        """ Totals of a sharded run over the zones done by all hosts, overall and per host
+        """
+        totals = {'zones_downloaded': 0, 'zones_unchanged': 0, 'zones_failed': 0, 'bytes_downloaded': 0, 'nodes': {}}
+        for zone_name, result in self.claims.results().items():
+            node = totals['nodes'].setdefault(result.get('node'), {'zones_downloaded': 0, 'zones_unchanged': 0,
+                                                                   'zones_failed': 0, 'bytes_downloaded': 0})
+            for counts in (totals, node):
+                if result.get('status') == 'failed':
+                    counts['zones_failed'] += 1
+                    continue
+                counts['zones_downloaded'] += 1
+                if result.get('status') == 'unchanged':
+                    counts['zones_unchanged'] += 1
                 else:
-                    self.retries += 1
-                    current_retries += 1
-            else:
-                if 'Content-Type' not in download.headers:
-                    self.send_msg("GET for '{}' did not return a content type in the header".format(zone))
-                    raise CZDSError("GET for '{}' did not return a content type in the header".format(zone))
-
-                if download.headers['Content-Type'] != 'application/x-gzip':
-                    self.send_msg("Unsupported content type '{}' for '{}'"
-                                  .format(download.headers['Content-Type'], zone))
-                    raise CZDSError("Unsupported content type '{}' for '{}'"
-                                    .format(download.headers['Content-Type'], zone))
-                return download
-
-    def fetch(self):
+                    counts['bytes_downloaded'] += result.get('size') or 0
+        return totals
+
+    def diff_previous_day(self):
+        """ Diff the zones of today's folder against the latest earlier download folder.
+            Returns the summary of the diff, or None if there is nothing to diff against.
+        """
+        previous = zonediff.previous_day(self.get_config_item('output_directory'), self.td.strftime('%Y-%m-%d'))
+        if previous is None:
+            logging.info('No earlier download folder to diff against')
+            return None
+        logging.info("Diffing zones against '{}'".format(previous))
+        started = time.monotonic()
+        try:
+            summary = zonediff.diff_days(previous, self.directory,
+                                         workers=int(self.get_config_item('diff_workers', os.cpu_count() or 1)),
+                                         max_memory=int(self.get_config_item('diff_max_memory', 256*1024*1024)))
+        except OSError as e:
+            logging.error("Failed to diff zones against '{}' ({})".format(previous, e))
+            return None
+        for zone_name, error in summary['failed'].items():
+            logging.error("Failed to diff zone '{}' ({})".format(zone_name, error))
+        logging.info('Diff: {} delegations added, {} removed, {} with changed NS in {:.1f} s'
+                     .format(summary['added'], summary['removed'], summary['changed'], time.monotonic() - started))
+        return summary
+
+    def zone_size(self, zone, zone_name):
+        """ Size of a zone in bytes as far as we know it before downloading: from the zone
+            manifest of the last run, otherwise from a HEAD request if plan_head_requests
+            is set. Returns None if the size is unknown.
+        """
+        previous = self.manifest.get(zone) if self.manifest else None
+        if previous and previous.get('content_length'):
+            return int(previous['content_length'])
+        if not self.get_config_item('plan_head_requests', False):
+            return None
+        try:
+            with self.scheduler.slot(zone):
+                response = self.request('HEAD', zone, allow_redirects=True)
+        except requests.exceptions.RequestException as e:
+            logging.warning("HEAD for zone '{}' failed ({})".format(zone_name, e))
+            return None
+        if response.status_code != 200 or 'Content-Length' not in response.headers:
+            logging.warning("HEAD for zone '{}' returned {} without a size".format(zone_name, response.status_code))
+            return None
+        return int(response.headers['Content-Length'])
+
+    def plan_downloads(self, zones):
+        """ Order the zones largest first. The worker pool starts zones in the order they are
+            submitted, so this keeps a multi-GB zone from starting last and stretching the
+            run. Zones of unknown size go last. Returns a list of (zone, zone_name, size).
+        """
+        with ThreadPoolExecutor(max_workers=self.max_parallel_downloads) as pool:
+            sizes = list(pool.map(lambda z: self.zone_size(*z), zones))
+        plan = sorted(zip(zones, sizes), key=lambda item: item[1] or 0, reverse=True)
+        return [(zone, zone_name, size) for (zone, zone_name), size in plan]
+
+    def estimate_runtime(self, plan):
+        """ Replay the plan on the download workers: each zone goes to the worker that
+            becomes idle first. Returns the worker of each zone and the estimated run time
+            in seconds, assuming plan_bandwidth_per_download bytes/s per download.
+        """
+        bandwidth = float(self.get_config_item('plan_bandwidth_per_download', 5*1024*1024))
+        loads = [0] * self.max_parallel_downloads
+        workers = []
+        for zone, zone_name, size in plan:
+            worker = loads.index(min(loads))
+            loads[worker] += size or 0
+            workers.append(worker)
+        return workers, max(loads) / bandwidth
+
+    def print_plan(self, plan):
+        workers, seconds = self.estimate_runtime(plan)
+        print('{:<40} {:>15} {:>6}'.format('zone', 'bytes', 'worker'))
+        for (zone, zone_name, size), worker in zip(plan, workers):
+            print('{:<40} {:>15} {:>6}'.format(zone_name, size if size is not None else '?', worker))
+        unknown = len([size for zone, zone_name, size in plan if size is None])
+        print('{} zones, {} bytes, {} parallel downloads, estimated transfer time {}{}'
+              .format(len(plan), sum(size or 0 for zone, zone_name, size in plan), self.max_parallel_downloads,
+                      datetime.timedelta(seconds=int(seconds)),
+                      ' ({} zones of unknown size not included)'.format(unknown) if unknown else ''))
+
+    def fetch(self, dry_run=False):
         which_zones = self.get_config_item("zones", "all")
         logging.info('Fetching the following zones from CZDS: {}'.format(which_zones))
 
@@ -235,44 +1682,151 @@ class CZDSDownloader(object):
             self.send_msg("Unrecoverable error: could not obtain zonefiles list" + str(e))
             sys.exit(1)
 
-        # Fetch the zones specified
-        for zone in zonelist:
-            # Extract the zone name from the URL
-            zone_name = zone.split('/')[-1]
-            if which_zones == 'all' or zone_name in which_zones:
-                try:
-                    download = self.fetch_zone(zone, zone_name)
-                except CZDSError as e:
-                    logging.error("Failed to download zone: " + str(e))
-                else:
-                    out_name = '{}/{}.gz'.format(self.directory, zone_name)
+        # Extract the zone names from the URLs and keep the zones specified
+        zones = [(zone, zone.split('/')[-1]) for zone in zonelist]
+        zones = [(zone, zone_name) for zone, zone_name in zones if which_zones == 'all' or zone_name in which_zones]
+        plan = self.plan_downloads(zones)
+        workers, seconds = self.estimate_runtime(plan)
 
-                    if 'Content-Length' in download.headers:
-                        logging.info('Downloading {} bytes to {}'.format(download.headers['Content-Length'], out_name))
-                    else:
-                        logging.info('Downloading to {}'.format(out_name))
+        if dry_run:
+            self.print_plan(plan)
+            return
 
-                    try:
-                        out_fd = open(out_name, 'wb')
+        logging.info('Downloading {} zones with {} parallel downloads, estimated transfer time {}'
+                     .format(len(plan), self.max_parallel_downloads, datetime.timedelta(seconds=int(seconds))))
 
-                        for chunk in download.iter_content(int(self.get_config_item('output_buffer_size', 1024*1024))):
-                            out_fd.write(chunk)
-                            out_fd.flush()
+        if self.stages:
+            self.stage_pool = ProcessPoolExecutor(max_workers=int(self.get_config_item('parse_workers',
+                                                                                       os.cpu_count() or 1)))
+        try:
+            pending = plan
+            while pending:
+                with ThreadPoolExecutor(max_workers=self.max_parallel_downloads) as pool:
+                    futures = [pool.submit(self.run_zone, zone, zone_name) for zone, zone_name, size in pending]
+                    for future in as_completed(futures):
+                        try:
+                            future.result()
+                        except CZDSError as e:
+                            # do not start any more zones, but let the running ones finish
+                            for f in futures:
+                                f.cancel()
+                            with self.lock:
+                                downloaded_zones = self.downloaded_zones
+                            sys.stderr.write("CZDS: After downloading {} domains, fatal error occurred: {}.\n"
+                                             .format(downloaded_zones, e))
+                            logging.error("CZDS: After downloading {} domains, fatal error occurred: {}."
+                                          .format(downloaded_zones, e))
+                            sys.exit(1)
+                if not self.claims:
+                    break
+                # wait for the zones other hosts are downloading, and take them over if a host dies
+                pending = [entry for entry in plan if not self.claims.is_done(entry[1])]
+                if pending:
+                    logging.info('Waiting for {} zones claimed by other nodes'.format(len(pending)))
+                    time.sleep(min(60.0, self.claims.timeout / 2.0))
+            self.finish_stages()
+            if self.claims:
+                self.shard_totals = self.combine_results()
+                self.summary_node = self.claims.claim_summary()
+        finally:
+            if self.stage_pool:
+                for job in self.stage_jobs.values():
+                    job.cancel()
+                self.stage_pool.shutdown()
+            if self.unsynced_files:
+                logging.info('Syncing {} zone files to disk'.format(len(self.unsynced_files)))
+                for file_name in self.unsynced_files:
+                    self.sync_file(file_name)
+                self.unsynced_files = []
+            # keep what we learned about the zones we did get, even after a fatal error
+            self.day_manifest.save(merge=self.claims is not None)
+            if self.manifest:
+                self.manifest.save(merge=self.claims is not None)
+            self.write_reports()
+            if self.claims:
+                self.claims.close()
 
-                        out_fd.close()
-                        self.downloaded_zones += 1
-                    except Exception as e:
-                        self.send_msg("Failed to write zone '{}' to file ({})".format(zone_name, e))
-                        sys.stderr.write("CZDS: After downloading {} domains, fatal error occurred: {}.\n"
-                                         .format(self.downloaded_zones, e))
-                        logging.error("CZDS: After downloading {} domains, fatal error occurred: {}."
-                                      .format(self.downloaded_zones, e))
-                        sys.exit(1)
+    def start_cycle(self):
+        """ Reset the counters for the next polling cycle of the daemon, and move on to the
+            download folder of a new day
+        """
+        with self.lock:
+            self.retries = 0
+            self.downloaded_zones = 0
+            self.unchanged_zones = 0
+            self.interrupted_transfers = 0
+            self.stage_jobs = {}
+        self.metrics = RunMetrics()
+        if self.td.date() != datetime.date.today():
+            self.td = datetime.datetime.today()
+            self.prepare_download_folder()
+            self.day_manifest = ZoneManifest(self.directory + '/manifest.json')
+
+    def end_of_day(self, changed_zones, cycles):
+        """ Report on the day that just ended, in daemon mode, before moving on to the next
+        """
+        diff = self.diff_previous_day() if self.get_config_item('diff_zones', False) else None
+        summary = "Downloaded {} zonefiles that changed on {}, in {} polling cycles.".format(
+            changed_zones, self.td.strftime('%Y-%m-%d'), cycles)
+        if diff:
+            summary += " {} delegations added, {} removed, {} with changed NS since {}.".format(
+                diff['added'], diff['removed'], diff['changed'], os.path.basename(diff['old']))
+        self.send_msg(summary, fail=False)
+
+    def run_daemon(self):
+        """ Keep running and download every zone soon after it changes, until SIGTERM or
+            SIGINT. Every poll_interval seconds the zone list is fetched again and every zone
+            is requested with the validators of the zone manifest, so a zone that did not
+            change costs a 304. The session, its connections and the access token are kept
+            from one cycle to the next, and a cycle that fails is tried again at the next one.
+            The zones of a day go to the folder of that day, as with daily runs.
+        """
+        if not self.manifest:
+            self.send_msg("Daemon mode needs 'incremental': true, to tell which zones changed")
+            sys.exit(1)
+        if self.claims:
+            self.send_msg("Daemon mode cannot be combined with 'sharded': true")
+            sys.exit(1)
+        interval = float(self.get_config_item('poll_interval', 900))
+        stopping = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            # let the running cycle finish, so the manifests are saved
+            signal.signal(signum, lambda signum, frame: stopping.set())
+        logging.info('Running as a daemon, polling CZDS every {} s'.format(interval))
+        changed_zones = cycles = 0
+        while not stopping.is_set():
+            started = time.monotonic()
+            if cycles and self.td.date() != datetime.date.today():
+                self.end_of_day(changed_zones, cycles)
+                changed_zones = cycles = 0
+            self.start_cycle()
+            try:
+                if not self.token_expires or self.token_expires - time.time() < self.token_refresh_margin:
+                    self.czds_authenticate()
+                self.fetch()
+            except SystemExit:
+                # fetch() and czds_authenticate() exit on errors they cannot get around,
+                # for the daemon these only end the cycle
+                logging.error('Polling cycle failed, trying again in {} s'.format(interval))
+            except Exception as e:
+                logging.exception('Polling cycle failed, trying again in {} s ({})'.format(interval, e))
+            cycles += 1
+            with self.lock:
+                changed = self.downloaded_zones - self.unchanged_zones
+            changed_zones += changed
+            logging.info('Polling cycle done in {:.1f} s, {} of {} zones changed'
+                         .format(time.monotonic() - started, changed, self.downloadable_zones))
+            stopping.wait(max(0.0, interval - (time.monotonic() - started)))
+        logging.info('Daemon stopped')
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str, help="use config file")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="only print the download plan and the estimated transfer time")
+    parser.add_argument("-d", "--daemon", action="store_true",
+                        help="keep running and download the zones as they change")
     args = parser.parse_args()
 
     if not args.config:
@@ -283,14 +1837,53 @@ def main():
 
     downloader.czds_authenticate()
 
-    downloader.fetch()
+    if args.dry_run:
+        downloader.fetch(dry_run=True)
+        return
+
+    if args.daemon:
+        downloader.run_daemon()
+        if downloader.notifier:
+            downloader.notifier.close()
+        return
 
+    downloader.fetch()
     logging.info("Complete, downloaded {} zone files of {}."
                  .format(downloader.downloaded_zones, downloader.downloadable_zones))
+    if not downloader.summary_node:
+        logging.info("All zones are done, another node reports on the run")
+        sys.stderr.write("CZDownloads: Complete on node {}, downloaded {} zone files.\n"
+                         .format(downloader.node_name, downloader.downloaded_zones))
+        if downloader.notifier:
+            downloader.notifier.close()
+        return
+    diff = downloader.diff_previous_day() if downloader.get_config_item('diff_zones', False) else None
+
+    logging.info("HTTP connections: {} opened, {} reused".format(*downloader.connection_stats()))
+    logging.info("Retries: {}, throttled by CZDS {} times".format(downloader.retries, downloader.scheduler.throttled))
+    if downloader.store:
+        logging.info("Content store: {} zone files linked to a stored copy, {} bytes saved"
+                     .format(downloader.store.linked, downloader.store.saved_bytes))
+    downloaded_zones = downloader.downloaded_zones
+    unchanged_zones = downloader.unchanged_zones
+    if downloader.shard_totals:
+        downloaded_zones = downloader.shard_totals['zones_downloaded']
+        unchanged_zones = downloader.shard_totals['zones_unchanged']
     sys.stderr.write("CZDownloads: Complete, downloaded {} zone files of {}.\n"
-                     .format(downloader.downloaded_zones, downloader.downloadable_zones))
-    downloader.send_msg("Downloaded {} zonefiles of {}."
-                        .format(downloader.downloaded_zones, downloader.downloadable_zones), fail=False)
+                     .format(downloaded_zones, downloader.downloadable_zones))
+    summary = "Downloaded {} zonefiles of {}.".format(downloaded_zones, downloader.downloadable_zones)
+    if downloader.shard_totals:
+        summary += " Zones downloaded per node: {}.".format(', '.join(
+            '{} {}'.format(node, counts['zones_downloaded'])
+            for node, counts in sorted(downloader.shard_totals['nodes'].items())))
+    if downloader.manifest:
+        summary += " {} zonefiles were unchanged since the last run.".format(unchanged_zones)
+    if diff:
+        summary += " {} delegations added, {} removed, {} with changed NS since {}.".format(
+            diff['added'], diff['removed'], diff['changed'], os.path.basename(diff['old']))
+    downloader.send_msg(summary, fail=False)
+    if downloader.notifier:
+        downloader.notifier.close()
 
 
 if __name__ == "__main__":
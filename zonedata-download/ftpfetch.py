@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8
+""" Download zone files from the FTP servers of registries, with the credentials that
+    credentials-decrypt/decrypt.py prints (server,username,password).
+
+    The servers are fetched from concurrently, with at most max_connections_per_server
+    logged in connections to each of them, as registries limit those. Connections are
+    reused for the next file of the same server. The zone files go into the same dated
+    folder as those of download.py, <output_directory>/<YYYY-MM-DD>/<zone>.gz, with their
+    checksums in the manifest.json of the folder.
+
+    Files are written to <name>.part first. A transfer that is cut off is resumed with
+    REST where it stopped, also in the next run as long as the remote file did not change.
+    The size and modification time (SIZE and MDTM) of every file downloaded are kept in
+    <output_directory>/ftp-manifest.json, and a file with the same size and time as in an
+    earlier run is linked into today's folder instead of being downloaded again. Servers
+    that do not support MDTM have all of their files downloaded every time.
+
+    A server is given as host, host:port or host:port/directory; the files in the
+    directory that match one of the patterns are fetched.
+"""
+import argparse
+import calendar
+import contextlib
+import csv
+import datetime
+import fnmatch
+import ftplib
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import download
+
+
+class FTPFetchError(Exception):
+    pass
+
+
+class FTPServer(object):
+    """ The connections to one FTP server, at most max_connections at a time. Connections
+        that were used without error are kept for the next file.
+    """
+    def __init__(self, address, username, password, max_connections=2, timeout=60, tls=False):
+        self.address = address
+        host, _, self.directory = address.partition('/')
+        self.host, _, port = host.partition(':')
+        self.port = int(port or 21)
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.tls = tls
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = []
+        # cleared once the server turns down REST, so it is not tried again
+        self.rest_supported = True
+
+    def url(self, name):
+        return 'ftp://{}@{}/{}'.format(self.username, self.address.rstrip('/'), name)
+
+    def open(self):
+        ftp = ftplib.FTP_TLS(timeout=self.timeout) if self.tls else ftplib.FTP(timeout=self.timeout)
+        try:
+            ftp.connect(self.host, self.port)
+            ftp.login(self.username, self.password)
+            if self.tls:
+                ftp.prot_p()
+            ftp.voidcmd('TYPE I')
+            if self.directory:
+                ftp.cwd(self.directory)
+        except BaseException:
+            ftp.close()
+            raise
+        return ftp
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ A logged in connection to the server, once one of the slots is free. A
+            connection that raised is closed rather than reused.
+        """
+        with self.slots:
+            with self.lock:
+                ftp = self.idle.pop() if self.idle else None
+            if ftp is None:
+                ftp = self.open()
+            try:
+                yield ftp
+            except BaseException:
+                ftp.close()
+                raise
+            with self.lock:
+                self.idle.append(ftp)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for ftp in idle:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+
+class FTPFetcher(object):
+    def __init__(self, output_directory, credentials, max_parallel_downloads=4, max_connections_per_server=2,
+                 retries=3, timeout=60, patterns=('*.gz',), tls=False, fsync='none', day=None):
+        """ credentials is a list of (server, username, password), like decrypt_all() of
+            credentials-decrypt/decrypt.py returns
+        """
+        self.output_directory = output_directory
+        self.day = day or datetime.date.today()
+        self.directory = os.path.join(output_directory, self.day.strftime('%Y-%m-%d'))
+        self.servers = [FTPServer(server, username, password, max_connections_per_server, timeout, tls)
+                        for server, username, password in credentials]
+        self.max_parallel_downloads = max(1, max_parallel_downloads)
+        self.retries = retries
+        self.patterns = list(patterns)
+        self.fsync = fsync
+        self.block_size = 1024 * 1024
+        self.manifest = download.ZoneManifest(os.path.join(output_directory, 'ftp-manifest.json'))
+        self.day_manifest = None
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(('files', 'downloaded', 'unchanged', 'resumed', 'failed', 'bytes',
+                                     'failed_servers'), 0)
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.counts[key] += amount
+
+    def fetch(self):
+        """ Download the zone files of all servers. Returns the counts of the run: files
+            found, downloaded, unchanged, resumed and failed, bytes transferred and servers
+            that could not be listed.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.day_manifest = download.ZoneManifest(os.path.join(self.directory, 'manifest.json'))
+        with ThreadPoolExecutor(self.max_parallel_downloads) as executor:
+            listings = list(executor.map(self.list_files, self.servers))
+            jobs = self.plan(listings)
+            self.count('files', len(jobs))
+            list(executor.map(lambda job: self.fetch_file(*job), jobs))
+        for server in self.servers:
+            server.close()
+        # download.py may write to the manifest of the folder at the same time
+        self.day_manifest.save(merge=True)
+        self.manifest.save()
+        return dict(self.counts)
+
+    def list_files(self, server):
+        """ The names of the files to fetch from a server, or [] if it cannot be listed
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                with server.connection() as ftp:
+                    try:
+                        names = ftp.nlst()
+                    except ftplib.error_perm as e:
+                        # some servers answer NLST of an empty directory with 550
+                        if not str(e).startswith('550'):
+                            raise
+                        names = []
+                break
+            except ftplib.error_perm as e:
+                logging.error("Cannot list the files on '{}' ({})".format(server.address, e))
+                self.count('failed_servers')
+                return []
+            except ftplib.all_errors as e:
+                if attempt == self.retries:
+                    logging.error("Cannot list the files on '{}' ({})".format(server.address, e))
+                    self.count('failed_servers')
+                    return []
+                self.backoff(attempt, 'listing {}'.format(server.address), e)
+        names = [name.rsplit('/', 1)[-1] for name in names]
+        return sorted(name for name in names if any(fnmatch.fnmatch(name, pattern) for pattern in self.patterns))
+
+    def plan(self, listings):
+        """ (server, file name, zone name) for every file, taking the servers in turns so
+            the downloads are spread over them. A zone offered by several servers is only
+            fetched from the first.
+        """
+        jobs = []
+        seen = {}
+        queues = [[(server, name) for name in names] for server, names in zip(self.servers, listings)]
+        for i in range(max([len(queue) for queue in queues] or [0])):
+            for queue in queues:
+                if i >= len(queue):
+                    continue
+                server, name = queue[i]
+                zone_name = self.zone_name(name)
+                if zone_name in seen:
+                    logging.warning("Zone '{}' is on both '{}' and '{}', only fetching it from the first"
+                                    .format(zone_name, seen[zone_name], server.address))
+                    continue
+                seen[zone_name] = server.address
+                jobs.append((server, name, zone_name))
+        return jobs
+
+    @staticmethod
+    def zone_name(file_name):
+        """ The zone in a file name like com.zone.gz, as download.py names its files
+        """
+        name = file_name[:-3] if file_name.endswith('.gz') else file_name
+        for suffix in ('.zone', '.txt'):
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+        return name.lower()
+
+    def out_name(self, file_name, zone_name):
+        return os.path.join(self.directory, zone_name + '.gz' if file_name.endswith('.gz') else file_name)
+
+    def backoff(self, attempt, what, error):
+        delay = min(60, 2 ** attempt)
+        logging.warning("Error {} ({}), retrying in {} s".format(what, error, delay))
+        time.sleep(delay)
+
+    @staticmethod
+    def remote_info(ftp, name):
+        """ (size, modification time as YYYYMMDDHHMMSS) of a remote file, None where the
+            server does not tell
+        """
+        try:
+            size = ftp.size(name)
+        except ftplib.error_perm:
+            size = None
+        try:
+            mtime = ftp.sendcmd('MDTM ' + name)[4:].strip()[:14]
+        except ftplib.error_perm:
+            mtime = None
+        return size, mtime or None
+
+    @staticmethod
+    def is_unchanged(previous, size, mtime):
+        return bool(previous and size is not None and mtime and previous.get('remote_size') == size and
+                    previous.get('remote_mtime') == mtime and os.path.exists(previous.get('path', '')))
+
+    def fetch_file(self, server, name, zone_name):
+        """ Download one file, or link the previous download if it did not change. Runs on a
+            worker thread. Returns True if the zone is in today's folder.
+        """
+        url = server.url(name)
+        out_name = self.out_name(name, zone_name)
+        previous = self.manifest.get(url)
+        for attempt in range(self.retries + 1):
+            try:
+                with server.connection() as ftp:
+                    size, mtime = self.remote_info(ftp, name)
+                    if self.is_unchanged(previous, size, mtime) and self.link_previous(previous, out_name):
+                        logging.info("Zone '{}' unchanged since {}, reusing {}"
+                                     .format(zone_name, previous.get('date'), previous['path']))
+                        self.day_manifest.update(zone_name, url=url, sha256=previous['sha256'],
+                                                 size=previous['size'], gzip_ok=previous.get('gzip_ok'),
+                                                 reused=previous['path'])
+                        self.manifest.update(url, path=os.path.abspath(out_name),
+                                             date=self.day.strftime('%Y-%m-%d'))
+                        self.count('unchanged')
+                        return True
+                    results = self.transfer(server, ftp, name, out_name, size, mtime)
+                break
+            except (ftplib.error_perm, download.CorruptZoneError) as e:
+                # permanent, unless the data was bad, which a fresh transfer may fix
+                if isinstance(e, ftplib.error_perm) or attempt == self.retries:
+                    logging.error("Failed to download '{}' ({})".format(url, e))
+                    self.count('failed')
+                    return False
+                self.backoff(attempt, 'downloading {}'.format(url), e)
+            except (FTPFetchError,) + ftplib.all_errors as e:
+                if attempt == self.retries:
+                    logging.error("Failed to download '{}' ({})".format(url, e))
+                    self.count('failed')
+                    return False
+                self.backoff(attempt, 'downloading {}'.format(url), e)
+
+        self.day_manifest.update(zone_name, url=url, completed=datetime.datetime.now().isoformat(), **results)
+        self.manifest.update(url, remote_size=size, remote_mtime=mtime, path=os.path.abspath(out_name),
+                             date=self.day.strftime('%Y-%m-%d'), **results)
+        self.count('downloaded')
+        return True
+
+    def transfer(self, server, ftp, name, out_name, size, mtime):
+        """ Download a file into <out_name>.part, resuming a part from an earlier attempt of
+            the same remote file, check it and rename it to out_name. Returns the checksums.
+        """
+        part_name = out_name + '.part'
+        meta_name = part_name + '.json'
+        remote = {'size': size, 'mtime': mtime}
+        offset = 0
+        if os.path.exists(part_name) and size is not None and mtime and server.rest_supported:
+            try:
+                with open(meta_name, 'r') as meta_fd:
+                    if json.load(meta_fd) == remote:
+                        offset = os.path.getsize(part_name)
+            except (OSError, ValueError):
+                pass
+            if offset > size:
+                offset = 0
+        if not offset:
+            with open(meta_name, 'w') as meta_fd:
+                json.dump(remote, meta_fd)
+
+        if offset != size:
+            if offset:
+                logging.info("Resuming '{}' at {} bytes".format(name, offset))
+            with open(part_name, 'ab' if offset else 'wb') as out_fd:
+                before = out_fd.tell()
+                try:
+                    ftp.retrbinary('RETR ' + name, out_fd.write, self.block_size, rest=offset or None)
+                except ftplib.error_perm as e:
+                    if not offset or not str(e).startswith(('500', '501', '502', '504')):
+                        raise
+                    # no REST on this server: start over, and don't try again
+                    server.rest_supported = False
+                    raise FTPFetchError('server does not support REST')
+                finally:
+                    self.count('bytes', out_fd.tell() - before)
+            if offset:
+                self.count('resumed')
+        received = os.path.getsize(part_name)
+        if size is not None and received != size:
+            raise FTPFetchError('transfer ended after {} of {} bytes'.format(received, size))
+
+        results = self.check_file(part_name, name.endswith('.gz'))
+        os.replace(part_name, out_name)
+        os.remove(meta_name)
+        if mtime:
+            timestamp = calendar.timegm(time.strptime(mtime, '%Y%m%d%H%M%S'))
+            os.utime(out_name, (timestamp, timestamp))
+        if self.fsync == 'file':
+            download.CZDSDownloader.sync_file(out_name)
+        return results
+
+    @staticmethod
+    def check_file(file_name, gzipped):
+        """ Checksum and size of a downloaded file, and for gzip files whether they are
+            complete. Raises CorruptZoneError and removes the file if it is not.
+        """
+        checks = [download.ZoneDigest()] + ([download.GzipCheck()] if gzipped else [])
+        try:
+            with open(file_name, 'rb') as in_fd:
+                for data in iter(lambda: in_fd.read(1024*1024), b''):
+                    for check in checks:
+                        check.update(data)
+            results = {}
+            for check in checks:
+                results.update(check.finish())
+        except download.CorruptZoneError:
+            os.remove(file_name)
+            raise
+        return results
+
+    @staticmethod
+    def link_previous(previous, out_name):
+        """ Put the previous download of an unchanged file into today's folder, as a hardlink
+            where possible. Returns False if the previous file cannot be used.
+        """
+        prev_name = previous['path']
+        if os.path.abspath(prev_name) == os.path.abspath(out_name):
+            return True
+        try:
+            if os.path.exists(out_name):
+                os.remove(out_name)
+            try:
+                os.link(prev_name, out_name)
+            except OSError:
+                shutil.copyfile(prev_name, out_name)
+        except OSError as e:
+            logging.warning("Could not reuse '{}' ({})".format(prev_name, e))
+            return False
+        return True
+
+
+def read_credentials(in_fd):
+    """ (server, username, password) from the CSV output of decrypt.py
+    """
+    credentials = []
+    for row in csv.reader(in_fd):
+        if not row or row == ['server', 'username', 'password']:
+            continue
+        if len(row) != 3:
+            raise ValueError('expected server,username,password, got {} fields'.format(len(row)))
+        credentials.append(tuple(row))
+    return credentials
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download zone files from the FTP servers of registries')
+    parser.add_argument('credentials', help='CSV output of credentials-decrypt/decrypt.py, - for stdin')
+    parser.add_argument("-c", "--config", type=str, default='config.json', help="config file of download.py")
+    args = parser.parse_args()
+
+    try:
+        with open(args.config, 'r') as config_fd:
+            config = json.load(config_fd)
+        if args.credentials == '-':
+            credentials = read_credentials(sys.stdin)
+        else:
+            with open(args.credentials, 'r', newline='') as in_fd:
+                credentials = read_credentials(in_fd)
+    except (OSError, ValueError) as e:
+        sys.stderr.write('{}\n'.format(e))
+        sys.exit(1)
+
+    fetcher = FTPFetcher(config['output_directory'], credentials,
+                         max_parallel_downloads=int(config.get('ftp.max_parallel_downloads', 4)),
+                         max_connections_per_server=int(config.get('ftp.max_connections_per_server', 2)),
+                         retries=int(config.get('ftp.retries', 3)),
+                         timeout=config.get('ftp.timeout', 60),
+                         patterns=config.get('ftp.patterns', ['*.gz']),
+                         tls=config.get('ftp.tls', False),
+                         fsync=config.get('fsync', 'none'))
+    os.makedirs(fetcher.directory, exist_ok=True)
+    logging.basicConfig(filename=os.path.join(fetcher.directory, 'ftpfetch.log'), level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s:%(name)s:%(module)s:%(funcName)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    counts = fetcher.fetch()
+    logging.info('Complete: {}'.format(counts))
+    print('{files} files on {servers} servers: {downloaded} downloaded ({resumed} resumed, {bytes} bytes), '
+          '{unchanged} unchanged, {failed} failed, {failed_servers} servers not reached'
+          .format(servers=len(credentials), **counts))
+    if counts['failed'] or counts['failed_servers']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
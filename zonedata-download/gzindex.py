@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8
+""" Random access to gzip-compressed zone files, after the zran example of zlib.
+
+    A deflate stream can only be decompressed from the start, unless the decompressor is
+    set up with the state at some point in the middle: the position in the compressed data
+    (down to the bit) and the last 32 KiB of uncompressed data. The index holds such an
+    access point every span bytes of uncompressed data, so reading anywhere in the file
+    means decompressing at most span bytes. The index also keeps the first owner name after
+    each access point, to find an owner name range in a zone file sorted in DNS canonical
+    order (label by label from the right, as zone files are).
+
+    Python's zlib module does not expose inflatePrime() or stopping at block boundaries,
+    so this talks to libz through ctypes. ctypes releases the GIL, so building an index on
+    a download worker thread does not hold up the others.
+
+    Index file: b'CZDSGZI1' | header length (uint32) | JSON header | zlib-compressed windows
+"""
+import argparse
+import bisect
+import ctypes
+import ctypes.util
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+
+MAGIC = b'CZDSGZI1'
+VERSION = 1
+
+WINDOW_SIZE = 32768
+Z_OK = 0
+Z_STREAM_END = 1
+Z_NEED_DICT = 2
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+
+
+class GzipIndexError(Exception):
+    pass
+
+
+class ZStream(ctypes.Structure):
+    _fields_ = [('next_in', ctypes.c_void_p), ('avail_in', ctypes.c_uint), ('total_in', ctypes.c_ulong),
+                ('next_out', ctypes.c_void_p), ('avail_out', ctypes.c_uint), ('total_out', ctypes.c_ulong),
+                ('msg', ctypes.c_char_p), ('state', ctypes.c_void_p),
+                ('zalloc', ctypes.c_void_p), ('zfree', ctypes.c_void_p), ('opaque', ctypes.c_void_p),
+                ('data_type', ctypes.c_int), ('adler', ctypes.c_ulong), ('reserved', ctypes.c_ulong)]
+
+
+def canonical(name):
+    """ Sort key of an owner name in DNS canonical order: its labels from the right, so a
+        zone apex sorts before the names below it
+    """
+    return name.lower().rstrip(b'.').split(b'.')[::-1]
+
+
+def load_libz():
+    """ libz through ctypes, or None if it cannot be found or is too old (before 1.2.8)
+    """
+    name = ctypes.util.find_library('z') or ctypes.util.find_library('zlib1')
+    if name is None:
+        return None
+    try:
+        libz = ctypes.CDLL(name)
+        libz.inflateGetDictionary
+    except (OSError, AttributeError):
+        return None
+    libz.zlibVersion.restype = ctypes.c_char_p
+    stream = ctypes.POINTER(ZStream)
+    for function, argtypes in (('inflateInit2_', [stream, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]),
+                               ('inflate', [stream, ctypes.c_int]),
+                               ('inflateEnd', [stream]),
+                               ('inflateReset', [stream]),
+                               ('inflateReset2', [stream, ctypes.c_int]),
+                               ('inflatePrime', [stream, ctypes.c_int, ctypes.c_int]),
+                               ('inflateSetDictionary', [stream, ctypes.c_char_p, ctypes.c_uint]),
+                               ('inflateGetDictionary', [stream, ctypes.c_char_p, ctypes.POINTER(ctypes.c_uint)])):
+        getattr(libz, function).argtypes = argtypes
+        getattr(libz, function).restype = ctypes.c_int
+    return libz
+
+
+libz = load_libz()
+
+
+class Inflater(object):
+    """ A z_stream for inflating, window_bits as for inflateInit2 (31 for gzip, -15 for raw)
+    """
+    def __init__(self, window_bits):
+        if libz is None:
+            raise GzipIndexError('gzip indexes need libz 1.2.8 or later')
+        self.stream = ZStream()
+        ret = libz.inflateInit2_(ctypes.byref(self.stream), window_bits, libz.zlibVersion(),
+                                 ctypes.sizeof(ZStream))
+        if ret != Z_OK:
+            raise GzipIndexError('inflateInit2 failed ({})'.format(ret))
+        self.window_bits = window_bits
+        self.input = None
+
+    def close(self):
+        if self.stream is not None:
+            libz.inflateEnd(ctypes.byref(self.stream))
+            self.stream = None
+
+    def feed(self, data):
+        """ Make data the input; the stream reads straight from our copy of it
+        """
+        self.input = ctypes.create_string_buffer(bytes(data), len(data))
+        self.stream.next_in = ctypes.addressof(self.input)
+        self.stream.avail_in = len(data)
+
+    def unused(self):
+        """ The input not consumed yet
+        """
+        if not self.stream.avail_in:
+            return b''
+        return ctypes.string_at(self.stream.next_in, self.stream.avail_in)
+
+    def inflate(self, out, flush=Z_NO_FLUSH):
+        """ Inflate into the ctypes buffer out; returns (return code, bytes produced, consumed)
+        """
+        avail_in = self.stream.avail_in
+        self.stream.next_out = ctypes.addressof(out)
+        self.stream.avail_out = len(out)
+        ret = libz.inflate(ctypes.byref(self.stream), flush)
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            raise GzipIndexError('gzip data is corrupt ({})'.format(
+                self.stream.msg.decode(errors='replace') if self.stream.msg else ret))
+        return ret, len(out) - self.stream.avail_out, avail_in - self.stream.avail_in
+
+    def window(self):
+        window = ctypes.create_string_buffer(WINDOW_SIZE)
+        length = ctypes.c_uint(WINDOW_SIZE)
+        libz.inflateGetDictionary(ctypes.byref(self.stream), window, ctypes.byref(length))
+        return window.raw[:length.value]
+
+
+class GzipIndexBuilder(object):
+    """ Builds the index of a gzip file from its data, fed in order with update(). Can be
+        used as a stream check while the file is downloaded. Raises GzipIndexError if the
+        data is not valid gzip.
+    """
+    def __init__(self, span=16*1024*1024):
+        self.span = span
+        self.inflater = Inflater(31)
+        self.out = ctypes.create_string_buffer(256 * 1024)
+        self.points = []
+        self.windows = []
+        self.total_in = 0
+        self.total_out = 0
+        self.member_done = False
+        self.last_point = None
+        # the first owner name after the last access point, collected from the output
+        self.probe = None
+        self.probe_offset = 0
+
+    def update(self, data):
+        inflater = self.inflater
+        while data:
+            if self.member_done:
+                # another gzip member may follow
+                libz.inflateReset(ctypes.byref(inflater.stream))
+                self.member_done = False
+            inflater.feed(data)
+            while inflater.stream.avail_in:
+                ret, produced, consumed = inflater.inflate(self.out, Z_BLOCK)
+                if self.probe is not None and produced:
+                    self.collect_key(self.out.raw[:produced])
+                self.total_in += consumed
+                self.total_out += produced
+                if ret == Z_STREAM_END:
+                    self.member_done = True
+                    break
+                # at the end of a deflate block that is not the last block of the member
+                if inflater.stream.data_type & 128 and not inflater.stream.data_type & 64 and \
+                        (self.last_point is None or self.total_out - self.last_point >= self.span):
+                    self.add_point()
+                if not produced and not consumed:
+                    break
+            data = inflater.unused() if self.member_done else b''
+
+    def add_point(self):
+        window = self.inflater.window()
+        self.windows.append(zlib.compress(window, 6))
+        self.points.append([self.total_out, self.total_in, self.inflater.stream.data_type & 7, None, None])
+        self.last_point = self.total_out
+        self.probe = b''
+        self.probe_offset = self.total_out
+
+    def collect_key(self, text):
+        """ Find the first complete line after the access point and keep its owner name
+            and offset as the key of the point
+        """
+        self.probe += text[:4096]
+        start = self.probe.find(b'\n')
+        if start < 0:
+            if len(self.probe) > 4096:
+                self.probe = None
+            return
+        end = self.probe.find(b'\n', start + 1)
+        if end < 0:
+            if len(self.probe) > 8192:
+                self.probe = None
+            return
+        fields = self.probe[start + 1:end].split(None, 1)
+        if fields:
+            self.points[-1][3] = fields[0].lower().decode(errors='replace')
+            self.points[-1][4] = self.probe_offset + start + 1
+        self.probe = None
+
+    def finish(self):
+        """ Return the index, as the bytes of an index file
+        """
+        self.inflater.close()
+        if not self.member_done:
+            raise GzipIndexError('gzip data is truncated')
+        keys = [canonical(point[3].encode()) for point in self.points if point[3] is not None]
+        header = {'version': VERSION, 'span': self.span, 'size': self.total_out, 'compressed_size': self.total_in,
+                  'sorted': keys == sorted(keys), 'points': []}
+        window_offset = 0
+        for point, window in zip(self.points, self.windows):
+            header['points'].append({'out': point[0], 'in': point[1], 'bits': point[2], 'key': point[3],
+                                     'key_offset': point[4], 'window': [window_offset, len(window)]})
+            window_offset += len(window)
+        header_data = json.dumps(header, sort_keys=True).encode()
+        return MAGIC + struct.pack('=I', len(header_data)) + header_data + b''.join(self.windows)
+
+
+def write_index(index_data, out_name):
+    tmp_name = '{}.{}.tmp'.format(out_name, os.getpid())
+    with open(tmp_name, 'wb') as out_fd:
+        out_fd.write(index_data)
+    os.replace(tmp_name, out_name)
+
+
+def build_gzip_index(in_name, out_name, zone_name=None, span=16*1024*1024):
+    """ Build the index of the gzip file in_name and write it to out_name. Returns a summary.
+    """
+    started = time.monotonic()
+    builder = GzipIndexBuilder(span)
+    with open(in_name, 'rb') as in_fd:
+        for data in iter(lambda: in_fd.read(1024*1024), b''):
+            builder.update(data)
+    write_index(builder.finish(), out_name)
+    return {'points': len(builder.points), 'size': builder.total_out,
+            'seconds': round(time.monotonic() - started, 3)}
+
+
+class GzipIndexReader(object):
+    """ Random access to a gzip file with an index built by GzipIndexBuilder
+    """
+    def __init__(self, gz_name, index_name=None):
+        self.gz_name = gz_name
+        if index_name is None:
+            index_name = (gz_name[:-3] if gz_name.endswith('.gz') else gz_name) + '.gzi'
+        with open(index_name, 'rb') as index_fd:
+            start = index_fd.read(len(MAGIC) + 4)
+            if start[:len(MAGIC)] != MAGIC:
+                raise GzipIndexError("'{}' is not a gzip index".format(index_fd.name))
+            header_size, = struct.unpack_from('=I', start, len(MAGIC))
+            self.header = json.loads(index_fd.read(header_size).decode())
+            self.windows = index_fd.read()
+        if self.header['version'] != VERSION:
+            raise GzipIndexError("'{}' was written by an incompatible version".format(index_name))
+        if os.path.getsize(gz_name) != self.header['compressed_size']:
+            raise GzipIndexError("'{}' does not match its index".format(gz_name))
+        self.points = self.header['points']
+        self.point_offsets = [point['out'] for point in self.points]
+        self.size = self.header['size']
+        self.gz_fd = open(gz_name, 'rb')
+
+    def close(self):
+        self.gz_fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def stream(self, offset, chunk_size=256*1024):
+        """ Yield the uncompressed data from offset to the end of the file, decompressing
+            from the last access point before offset
+        """
+        i = bisect.bisect_right(self.point_offsets, offset) - 1
+        out = ctypes.create_string_buffer(chunk_size)
+        if i < 0:
+            # before the first access point: start at the beginning of the file
+            inflater = Inflater(31)
+            position = 0
+            self.gz_fd.seek(0)
+        else:
+            point = self.points[i]
+            inflater = Inflater(-15)
+            position = point['out']
+            self.gz_fd.seek(point['in'] - (1 if point['bits'] else 0))
+            if point['bits']:
+                byte = self.gz_fd.read(1)[0]
+                libz.inflatePrime(ctypes.byref(inflater.stream), point['bits'], byte >> (8 - point['bits']))
+            start, length = point['window']
+            window = zlib.decompress(self.windows[start:start + length])
+            libz.inflateSetDictionary(ctypes.byref(inflater.stream), window, len(window))
+        try:
+            skip = offset - position
+            data = self.gz_fd.read(1024*1024)
+            while data:
+                inflater.feed(data)
+                while True:
+                    ret, produced, consumed = inflater.inflate(out)
+                    if produced > skip:
+                        yield out.raw[skip:produced]
+                        skip = 0
+                    else:
+                        skip -= produced
+                    if ret == Z_STREAM_END or (not produced and (not inflater.stream.avail_in or not consumed)):
+                        break
+                if ret != Z_STREAM_END:
+                    data = self.gz_fd.read(1024*1024)
+                    continue
+                # another gzip member may follow. A raw stream started at an access point
+                # leaves the 8 byte trailer of its member unread.
+                data = inflater.unused()
+                if inflater.window_bits < 0:
+                    data = self.skip_trailer(data)
+                    libz.inflateReset2(ctypes.byref(inflater.stream), 31)
+                    inflater.window_bits = 31
+                else:
+                    libz.inflateReset(ctypes.byref(inflater.stream))
+                data = data or self.gz_fd.read(1024*1024)
+        finally:
+            inflater.close()
+
+    def skip_trailer(self, data):
+        if len(data) < 8:
+            data += self.gz_fd.read(8 - len(data))
+        return data[8:]
+
+    def read(self, offset, length):
+        """ length bytes of uncompressed data at offset (fewer at the end of the file)
+        """
+        pieces = []
+        for data in self.stream(offset):
+            pieces.append(data[:length])
+            length -= len(pieces[-1])
+            if length <= 0:
+                break
+        return b''.join(pieces)
+
+    def lines(self, offset):
+        """ Yield the complete lines after offset (the line offset is in is skipped unless
+            offset is 0), without the newline
+        """
+        pending = b''
+        first = offset != 0
+        for data in self.stream(offset):
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            if first:
+                lines = lines[1:]
+                first = False
+            yield from lines
+        if pending and not first:
+            yield pending
+
+    def owner_range(self, first, last=None):
+        """ Yield the lines of the records with owner names from first to last (both
+            included; last defaults to first) of a zone file, in DNS canonical order. If the
+            index found the zone file not to be sorted, the whole file is scanned.
+        """
+        first = canonical(first.encode())
+        last = canonical(last.encode()) if last is not None else first
+        start = 0
+        if self.header['sorted']:
+            # the last access point that starts before the first owner
+            keys = [(canonical(point['key'].encode()), point['key_offset']) for point in self.points
+                    if point['key'] is not None]
+            i = bisect.bisect_left(keys, (first, -1)) - 1
+            if i >= 0:
+                start = keys[i][1]
+        # the lines from a key offset on are complete, so start on the line boundary
+        for line in self.lines(start - 1 if start else 0):
+            fields = line.split(None, 1)
+            if not fields:
+                continue
+            owner = canonical(fields[0])
+            if owner > last and self.header['sorted']:
+                return
+            if first <= owner <= last:
+                yield line
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and use random access indexes of gzip-compressed zone files')
+    commands = parser.add_subparsers(dest='command')
+    build = commands.add_parser('build', help='build the .gzi index of gzip files')
+    build.add_argument('gz_files', nargs='+')
+    build.add_argument('--span', type=int, default=16, help='MiB of uncompressed data between access points')
+    read = commands.add_parser('read', help='print uncompressed data at an offset')
+    read.add_argument('gz_file')
+    read.add_argument('offset', type=int)
+    read.add_argument('length', type=int)
+    owners = commands.add_parser('owners', help='print the records of an owner name range')
+    owners.add_argument('gz_file')
+    owners.add_argument('first')
+    owners.add_argument('last', nargs='?')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        for file_name in args.gz_files:
+            out_name = (file_name[:-3] if file_name.endswith('.gz') else file_name) + '.gzi'
+            summary = build_gzip_index(file_name, out_name, span=args.span * 1024 * 1024)
+            print('{}: {} access points over {} bytes'.format(out_name, summary['points'], summary['size']))
+    elif args.command == 'read':
+        with GzipIndexReader(args.gz_file) as reader:
+            sys.stdout.buffer.write(reader.read(args.offset, args.length))
+    elif args.command == 'owners':
+        with GzipIndexReader(args.gz_file) as reader:
+            for line in reader.owner_range(args.first, args.last):
+                sys.stdout.buffer.write(line + b'\n')
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8
+""" Local stand-in for the CZDS API, to exercise download.py without the ICANN service.
+
+    It implements /api/authenticate, /czds/downloads/links and the gzip zone endpoints
+    (GET and HEAD, with ETag, Last-Modified, conditional and Range requests) for a set of
+    synthetic zones, and can inject latency, a bandwidth cap, 401/429/500 responses and
+    dropped connections.
+"""
+import argparse
+import base64
+import email.utils
+import gzip
+import io
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def synthetic_zone(zone_name, records, seed=0):
+    """ gzip-compressed zone file for zone_name in the format of CZDS zone files, with
+        `records` delegations (two NS records each, and a DS record for every tenth one).
+        Owner names are generated in sorted order.
+    """
+    rnd = random.Random('{}/{}'.format(zone_name, seed))
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6, mtime=0) as gz_fd:
+        gz_fd.write('{0}.\t86400\tin\tsoa\ta.nic.{0}. support.nic.{0}. {1} 1800 900 604800 86400\n'
+                    .format(zone_name, 1000000 + seed).encode())
+        gz_fd.write('{0}.\t172800\tin\tns\ta.nic.{0}.\n'.format(zone_name).encode())
+        lines = []
+        for i in range(records):
+            owner = 'd{:08x}{:04x}.{}.'.format(i, rnd.getrandbits(16), zone_name)
+            provider = rnd.randrange(500)
+            lines.append('{}\t172800\tin\tns\tns1.provider{}.net.\n'.format(owner, provider))
+            lines.append('{}\t172800\tin\tns\tns2.provider{}.net.\n'.format(owner, provider))
+            if i % 10 == 0:
+                lines.append('{}\t86400\tin\tds\t{} 8 2 {:064x}\n'.format(owner, rnd.randrange(65536),
+                                                                         rnd.getrandbits(256)))
+            if len(lines) >= 10000:
+                gz_fd.write(''.join(lines).encode())
+                lines = []
+        gz_fd.write(''.join(lines).encode())
+    return out.getvalue()
+
+
+class MockZone(object):
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.etag = '"{}-{:08x}"'.format(name, zlib.crc32(data))
+        self.last_modified = email.utils.formatdate(time.time(), usegmt=True)
+
+
+class MockCZDS(object):
+    """ The stand-in server. Zones are given as {name: gzip data}; the fault injection
+        settings can be changed while the server is running.
+    """
+    def __init__(self, zones, host='127.0.0.1', port=0, token_ttl=86400):
+        self.zones = dict((name, MockZone(name, data)) for name, data in zones.items())
+        self.token_ttl = token_ttl
+        self.configure()
+        # what happened
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.stats = {}
+        self.random = random.Random(0)
+        self.server = ThreadingHTTPServer((host, port), MockCZDSHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.thread = None
+
+    def configure(self, latency=0.0, bandwidth=None, fail_401=0.0, fail_429=0.0, fail_500=0.0, drop_rate=0.0,
+                  retry_after=1):
+        """ Set up fault injection: latency in seconds before each GET is answered, bandwidth
+            in bytes/s per connection, probabilities of 401/429/500 responses per GET and of
+            a zone transfer being cut off, and the Retry-After sent with 429s
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_401 = fail_401
+        self.fail_429 = fail_429
+        self.fail_500 = fail_500
+        self.drop_rate = drop_rate
+        self.retry_after = retry_after
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server.server_address[:2])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {}
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + amount
+
+    def chance(self, probability):
+        with self.lock:
+            return self.random.random() < probability
+
+    def new_token(self):
+        expires = int(time.time() + self.token_ttl)
+        payload = base64.urlsafe_b64encode(json.dumps({'exp': expires}).encode()).decode().rstrip('=')
+        token = 'eyJhbGciOiJub25lIn0.{}.{:016x}'.format(payload, self.random.getrandbits(64))
+        with self.lock:
+            self.tokens[token] = expires
+        return token
+
+    def token_valid(self, authorization):
+        if not authorization or not authorization.startswith('Bearer '):
+            return False
+        with self.lock:
+            return self.tokens.get(authorization[7:], 0) > time.time()
+
+    def revoke_tokens(self):
+        with self.lock:
+            self.tokens = {}
+
+
+class MockCZDSHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+        self.mock.count('status_{}'.format(status))
+
+    def do_POST(self):
+        self.mock.count('requests')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/api/authenticate':
+            return self.reply(404)
+        try:
+            credentials = json.loads(body.decode())
+            if not credentials.get('username') or not credentials.get('password'):
+                return self.reply(401)
+        except ValueError:
+            return self.reply(400)
+        self.mock.count('logins')
+        self.reply(200, json.dumps({'accessToken': self.mock.new_token(), 'message': 'Authentication Successful'})
+                   .encode(), {'Content-Type': 'application/json'})
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        mock = self.mock
+        mock.count('requests')
+        if mock.latency:
+            time.sleep(mock.latency)
+        if not mock.token_valid(self.headers.get('Authorization')) or mock.chance(mock.fail_401):
+            return self.reply(401)
+        if mock.chance(mock.fail_429):
+            return self.reply(429, headers={'Retry-After': str(mock.retry_after)})
+        if mock.chance(mock.fail_500):
+            return self.reply(500)
+
+        if self.path == '/czds/downloads/links':
+            links = ['{}/czds/downloads/{}.zone'.format(mock.url, name) for name in sorted(mock.zones)]
+            return self.reply(200, json.dumps(links).encode(), {'Content-Type': 'application/json'})
+
+        name = self.path.rsplit('/', 1)[-1]
+        zone = mock.zones.get(name[:-5]) if name.endswith('.zone') else None
+        if zone is None:
+            return self.reply(404)
+        self.send_zone(zone)
+
+    def send_zone(self, zone):
+        headers = {'Content-Type': 'application/x-gzip', 'ETag': zone.etag,
+                   'Last-Modified': zone.last_modified, 'Accept-Ranges': 'bytes'}
+        if self.headers.get('If-None-Match') == zone.etag or \
+                self.headers.get('If-Modified-Since') == zone.last_modified:
+            return self.reply(304, headers={'ETag': zone.etag})
+
+        start = 0
+        status = 200
+        if self.headers.get('Range', '').startswith('bytes=') and \
+                self.headers.get('If-Range') in (None, zone.etag, zone.last_modified):
+            start = int(self.headers['Range'][6:].split('-')[0])
+            status = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, len(zone.data) - 1, len(zone.data))
+        body = memoryview(zone.data)[start:]
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.mock.count('status_{}'.format(status))
+        if self.command == 'HEAD':
+            return
+
+        # cut the connection somewhere in the body, like a flaky network would
+        end = len(body)
+        if self.mock.chance(self.mock.drop_rate):
+            end = self.mock.random.randrange(len(body)) if len(body) else 0
+            self.close_connection = True
+            self.mock.count('dropped')
+        slice_size = 64 * 1024
+        started = time.monotonic()
+        sent = 0
+        try:
+            while sent < end:
+                n = min(slice_size, end - sent)
+                self.wfile.write(body[sent:sent + n])
+                sent += n
+                if self.mock.bandwidth:
+                    ahead = sent / float(self.mock.bandwidth) - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        self.mock.count('bytes_sent', sent)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the CZDS API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--zones', type=int, default=10, help='number of synthetic zones')
+    parser.add_argument('--records', type=int, default=100000, help='delegations in the largest zone')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each GET is answered')
+    parser.add_argument('--bandwidth', type=int, help='bytes/s per connection')
+    parser.add_argument('--fail-401', type=float, default=0.0, help='probability of a 401 per GET')
+    parser.add_argument('--fail-429', type=float, default=0.0, help='probability of a 429 per GET')
+    parser.add_argument('--fail-500', type=float, default=0.0, help='probability of a 500 per GET')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='probability of a dropped zone transfer')
+    parser.add_argument('--token-ttl', type=int, default=86400, help='lifetime of access tokens in seconds')
+    args = parser.parse_args()
+
+    # zone sizes fall off like the real ones: a few big zones and a long tail of small ones
+    zones = dict(('tld{:03d}'.format(i), synthetic_zone('tld{:03d}'.format(i), max(10, args.records // (i + 1))))
+                 for i in range(args.zones))
+    mock = MockCZDS(zones, args.host, args.port, token_ttl=args.token_ttl)
+    mock.configure(latency=args.latency, bandwidth=args.bandwidth, fail_401=args.fail_401,
+                   fail_429=args.fail_429, fail_500=args.fail_500, drop_rate=args.drop_rate)
+    print('Serving {} zones ({} bytes) on {}'.format(len(zones), sum(len(data) for data in zones.values()), mock.url))
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
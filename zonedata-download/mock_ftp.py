@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8
+""" Local stand-in for the FTP server of a registry, to exercise ftpfetch.py without one.
+
+    It implements the part of FTP that ftpfetch.py and ftplib use (login, passive mode,
+    NLST, SIZE, MDTM, REST and RETR) for a set of files, enforces a limit on the
+    connections per user like registries do, and can inject latency, a bandwidth cap and
+    cut off transfers.
+"""
+import argparse
+import random
+import socket
+import socketserver
+import threading
+import time
+
+import mock_czds
+
+
+class MockFile(object):
+    def __init__(self, data, mtime=None):
+        self.data = data
+        self.mtime = time.time() if mtime is None else mtime
+
+
+class MockFTP(object):
+    """ The stand-in server. Files are given as {path: data}, users as {name: password};
+        the fault injection settings can be changed while the server is running.
+    """
+    def __init__(self, files, users, host='127.0.0.1', port=0, max_connections_per_user=2):
+        self.files = dict((path.lstrip('/'), MockFile(data)) for path, data in files.items())
+        self.users = users
+        self.max_connections_per_user = max_connections_per_user
+        self.configure()
+        # what happened
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.connections = {}
+        self.random = random.Random(0)
+        self.server = socketserver.ThreadingTCPServer((host, port), MockFTPHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.thread = None
+
+    def configure(self, latency=0.0, bandwidth=None, drop_rate=0.0, support_rest=True, support_mdtm=True):
+        """ Set up fault injection: latency in seconds before each command is answered,
+            bandwidth in bytes/s per transfer, probability of a transfer being cut off, and
+            whether REST and MDTM are supported
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop_rate = drop_rate
+        self.support_rest = support_rest
+        self.support_mdtm = support_mdtm
+
+    @property
+    def address(self):
+        return '{}:{}'.format(*self.server.server_address[:2])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def set_file(self, path, data, mtime=None):
+        """ Add or change a file, as the registry does when it publishes a new zone
+        """
+        with self.lock:
+            self.files[path.lstrip('/')] = MockFile(data, mtime)
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {}
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + amount
+
+    def chance(self, probability):
+        with self.lock:
+            return self.random.random() < probability
+
+    def connect(self, user):
+        """ Count a logged in connection of user. Returns False if user has too many.
+        """
+        with self.lock:
+            if self.connections.get(user, 0) >= self.max_connections_per_user:
+                return False
+            self.connections[user] = self.connections.get(user, 0) + 1
+            peak = 'peak_connections_{}'.format(user)
+            self.stats[peak] = max(self.stats.get(peak, 0), self.connections[user])
+            return True
+
+    def disconnect(self, user):
+        with self.lock:
+            self.connections[user] -= 1
+
+
+class MockFTPHandler(socketserver.StreamRequestHandler):
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        self.user = None
+        self.logged_in = None
+        self.cwd = ''
+        self.rest = 0
+        self.passive = None
+        self.mock.count('connections')
+        self.reply('220 Mock FTP server ready')
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                command, _, argument = line.decode('utf-8', 'replace').rstrip('\r\n').partition(' ')
+                command = command.upper()
+                if self.mock.latency:
+                    time.sleep(self.mock.latency)
+                if command == 'QUIT':
+                    self.reply('221 Bye')
+                    break
+                handler = getattr(self, 'ftp_' + command.lower(), None)
+                if handler is None:
+                    self.reply('502 Command not implemented')
+                elif self.logged_in is None and command not in ('USER', 'PASS', 'FEAT'):
+                    self.reply('530 Please login with USER and PASS')
+                elif handler(argument) is False:
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            if self.passive:
+                self.passive.close()
+            if self.logged_in is not None:
+                self.mock.disconnect(self.logged_in)
+
+    def path(self, argument):
+        if argument.startswith('/'):
+            return argument.strip('/')
+        return '/'.join(part for part in (self.cwd, argument.strip('/')) if part)
+
+    def file(self, argument):
+        with self.mock.lock:
+            return self.mock.files.get(self.path(argument))
+
+    def ftp_user(self, argument):
+        self.user = argument
+        self.reply('331 Password required')
+
+    def ftp_pass(self, argument):
+        if self.user is None or self.mock.users.get(self.user) != argument:
+            self.mock.count('failed_logins')
+            self.reply('530 Login incorrect')
+            return
+        if not self.mock.connect(self.user):
+            self.mock.count('refused_connections')
+            self.reply('421 Too many connections for this user')
+            return False
+        self.logged_in = self.user
+        self.mock.count('logins')
+        self.reply('230 Logged in')
+
+    def ftp_feat(self, argument):
+        features = ['SIZE'] + (['MDTM'] if self.mock.support_mdtm else []) + \
+            (['REST STREAM'] if self.mock.support_rest else [])
+        self.wfile.write(('211-Features:\r\n' + ''.join(' {}\r\n'.format(f) for f in features) + '211 End\r\n')
+                         .encode())
+
+    def ftp_type(self, argument):
+        self.reply('200 Type set to ' + argument)
+
+    def ftp_noop(self, argument):
+        self.reply('200 OK')
+
+    def ftp_pwd(self, argument):
+        self.reply('257 "/{}" is the current directory'.format(self.cwd))
+
+    def ftp_cwd(self, argument):
+        path = self.path(argument)
+        with self.mock.lock:
+            exists = not path or any(name.startswith(path + '/') for name in self.mock.files)
+        if not exists:
+            return self.reply('550 No such directory')
+        self.cwd = path
+        self.reply('250 Directory changed to /' + path)
+
+    def ftp_size(self, argument):
+        zone_file = self.file(argument)
+        if zone_file is None:
+            return self.reply('550 No such file')
+        self.reply('213 {}'.format(len(zone_file.data)))
+
+    def ftp_mdtm(self, argument):
+        zone_file = self.file(argument)
+        if not self.mock.support_mdtm:
+            return self.reply('502 Command not implemented')
+        if zone_file is None:
+            return self.reply('550 No such file')
+        self.reply('213 ' + time.strftime('%Y%m%d%H%M%S', time.gmtime(zone_file.mtime)))
+
+    def ftp_rest(self, argument):
+        if not self.mock.support_rest:
+            return self.reply('502 Command not implemented')
+        self.rest = int(argument)
+        self.reply('350 Restarting at {}'.format(self.rest))
+
+    def listen(self):
+        """ Open the listening socket of a passive mode data connection
+        """
+        if self.passive:
+            self.passive.close()
+        self.passive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.passive.bind((self.connection.getsockname()[0], 0))
+        self.passive.listen(1)
+        self.passive.settimeout(30)
+        return self.passive.getsockname()[:2]
+
+    def ftp_pasv(self, argument):
+        host, port = self.listen()
+        self.reply('227 Entering Passive Mode ({},{},{})'.format(host.replace('.', ','), port >> 8, port & 0xff))
+
+    def ftp_epsv(self, argument):
+        host, port = self.listen()
+        self.reply('229 Entering Extended Passive Mode (|||{}|)'.format(port))
+
+    def data_connection(self):
+        if self.passive is None:
+            self.reply('425 Use PASV first')
+            return None
+        try:
+            connection, _ = self.passive.accept()
+        except OSError:
+            self.reply('425 Cannot open data connection')
+            return None
+        finally:
+            self.passive.close()
+            self.passive = None
+        return connection
+
+    def ftp_nlst(self, argument):
+        directory = self.path(argument)
+        prefix = directory + '/' if directory else ''
+        with self.mock.lock:
+            names = sorted(name[len(prefix):] for name in self.mock.files
+                           if name.startswith(prefix) and '/' not in name[len(prefix):])
+        connection = self.data_connection()
+        if connection is None:
+            return
+        self.reply('150 Here comes the listing')
+        connection.sendall(''.join(name + '\r\n' for name in names).encode())
+        connection.close()
+        self.reply('226 Transfer complete')
+
+    def ftp_retr(self, argument):
+        zone_file = self.file(argument)
+        start, self.rest = self.rest, 0
+        if zone_file is None:
+            return self.reply('550 No such file')
+        connection = self.data_connection()
+        if connection is None:
+            return
+        self.mock.count('retr')
+        if start:
+            self.mock.count('resumed')
+        self.reply('150 Opening BINARY mode data connection ({} bytes)'.format(len(zone_file.data) - start))
+        body = memoryview(zone_file.data)[start:]
+        # cut the transfer somewhere in the file, like a flaky network would
+        end = len(body)
+        dropped = self.mock.chance(self.mock.drop_rate)
+        if dropped:
+            end = self.mock.random.randrange(len(body)) if len(body) else 0
+            self.mock.count('dropped')
+        slice_size = 64 * 1024
+        started = time.monotonic()
+        sent = 0
+        try:
+            while sent < end:
+                n = min(slice_size, end - sent)
+                connection.sendall(body[sent:sent + n])
+                sent += n
+                if self.mock.bandwidth:
+                    ahead = sent / float(self.mock.bandwidth) - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except OSError:
+            dropped = True
+        finally:
+            connection.close()
+        self.mock.count('bytes_sent', sent)
+        self.reply('426 Connection closed; transfer aborted' if dropped else '226 Transfer complete')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the FTP server of a registry')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2121)
+    parser.add_argument('--zones', type=int, default=3, help='number of synthetic zones')
+    parser.add_argument('--records', type=int, default=100000, help='delegations in the largest zone')
+    parser.add_argument('--user', default='ftp_user')
+    parser.add_argument('--password', default='ftp_password')
+    parser.add_argument('--max-connections', type=int, default=2, help='connections allowed per user')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each command is answered')
+    parser.add_argument('--bandwidth', type=int, help='bytes/s per transfer')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='probability of a cut off transfer')
+    args = parser.parse_args()
+
+    files = dict(('tld{:03d}.zone.gz'.format(i), mock_czds.synthetic_zone('tld{:03d}'.format(i),
+                                                                         max(10, args.records // (i + 1))))
+                 for i in range(args.zones))
+    mock = MockFTP(files, {args.user: args.password}, args.host, args.port, args.max_connections)
+    mock.configure(latency=args.latency, bandwidth=args.bandwidth, drop_rate=args.drop_rate)
+    print('Serving {} zones ({} bytes) on {}, user {} password {}'
+          .format(len(files), sum(len(data) for data in files.values()), mock.address, args.user, args.password))
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8
+
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ftpfetch
+import mock_czds
+import mock_ftp
+
+
+def check(condition, message):
+    if not condition:
+        print("\nError: " + message)
+        sys.exit(1)
+
+
+def fetch(output_directory, address):
+    # one connection at a time, so the transfers the stand-in cuts off are the same every run
+    fetcher = ftpfetch.FTPFetcher(output_directory, [(address + '/zones', 'zone_user', 'secret')],
+                                  max_parallel_downloads=1, max_connections_per_server=1, retries=10)
+    fetcher.backoff = lambda attempt, what, error: None
+    return fetcher, fetcher.fetch()
+
+
+def check_files(fetcher, files):
+    for name, data in files.items():
+        with open(os.path.join(fetcher.directory, fetcher.zone_name(name) + '.gz'), 'rb') as in_fd:
+            check(in_fd.read() == data, "'{}' differs from the file on the server".format(name))
+    check(not [name for name in os.listdir(fetcher.directory) if '.part' in name], 'part files left behind')
+
+
+files = dict(('zone{}.zone.gz'.format(i), mock_czds.synthetic_zone('zone{}'.format(i), 20000)) for i in range(3))
+mock = mock_ftp.MockFTP(dict(('zones/' + name, data) for name, data in files.items()),
+                        {'zone_user': 'secret'}).start()
+output_directory = tempfile.mkdtemp()
+try:
+    # transfers are cut off and the server does not support REST: every retry starts over
+    mock.configure(drop_rate=0.5, support_rest=False)
+    fetcher, counts = fetch(output_directory, mock.address)
+    check(mock.stats.get('dropped', 0) > 0, 'no transfer was cut off')
+    check(counts['files'] == 3 and counts['downloaded'] == 3 and counts['failed'] == 0,
+          'expected 3 files downloaded without REST, got {}'.format(counts))
+    check(counts['resumed'] == 0 and mock.stats.get('resumed', 0) == 0, 'a transfer was resumed without REST')
+    check_files(fetcher, files)
+
+    # nothing changed: all files are linked from the first run
+    mock.configure()
+    fetcher, counts = fetch(output_directory, mock.address)
+    check(counts['unchanged'] == 3 and counts['downloaded'] == 0 and counts['bytes'] == 0,
+          'expected 3 unchanged files, got {}'.format(counts))
+    check_files(fetcher, files)
+
+    # a changed file whose transfers are cut off is resumed with REST
+    files['zone1.zone.gz'] = mock_czds.synthetic_zone('zone1', 40000, seed=1)
+    mock.set_file('zones/zone1.zone.gz', files['zone1.zone.gz'])
+    mock.reset_stats()
+    mock.configure(drop_rate=0.5)
+    fetcher, counts = fetch(output_directory, mock.address)
+    check(counts['downloaded'] == 1 and counts['unchanged'] == 2 and counts['failed'] == 0,
+          'expected 1 file downloaded and 2 unchanged, got {}'.format(counts))
+    check(mock.stats.get('dropped', 0) > 0 and counts['resumed'] == mock.stats.get('resumed', 0) > 0,
+          'expected the cut off transfers to be resumed, got {} and {}'.format(counts, mock.stats))
+    check(counts['bytes'] == len(files['zone1.zone.gz']), 'resumed transfers fetched {} bytes of {}'
+          .format(counts['bytes'], len(files['zone1.zone.gz'])))
+    check_files(fetcher, files)
+
+    # without MDTM, files cannot be told unchanged and are downloaded again
+    mock.configure(support_mdtm=False)
+    fetcher, counts = fetch(output_directory, mock.address)
+    check(counts['downloaded'] == 3 and counts['unchanged'] == 0, 'expected 3 files downloaded without MDTM, got {}'
+          .format(counts))
+    check_files(fetcher, files)
+finally:
+    mock.stop()
+    shutil.rmtree(output_directory)
+
+print("ftpfetch: downloads, unchanged files, REST resume and the fallbacks without REST and MDTM work")
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8
+""" Day-over-day diff of the zones in two download folders: the delegations that were
+    added, the ones that were removed and the ones whose NS set changed.
+
+    Each zone is diffed as a merge of two streams of delegations sorted by name. The NS
+    records of a zone are sorted with an external sort: runs of at most max_memory bytes
+    are sorted in memory and spilled to disk, and the runs are merged with heapq. Zone
+    files that are already sorted take a single run per max_memory. Zones are diffed in
+    parallel by a process pool, each worker stays within its own memory ceiling.
+
+    Output per zone, in the output folder (one delegation per line):
+
+        <zone>.added     name TAB name servers
+        <zone>.removed   name TAB name servers
+        <zone>.changed   name TAB old name servers TAB new name servers
+
+    Name servers are separated by spaces. diff.json holds the counts of all zones.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import zoneparse
+
+# memory taken by a line in a run, on top of its length: bytes object header and list slot
+LINE_OVERHEAD = 41
+
+
+def sorted_ns_records(in_name, work_dir, max_memory, info=None):
+    """ Yield 'owner TAB name server' for every NS record of a delegation in the zone file,
+        in byte order. The apex NS records of the zone are left out. The origin of the zone
+        is put into the info dict, if one is given.
+    """
+    origin = None
+    run = []
+    run_size = 0
+    runs = []
+    try:
+        for lines in zoneparse.zone_lines(in_name):
+            for line in lines:
+                fields = line.split(None, 4)
+                if len(fields) != 5:
+                    continue
+                rtype = fields[3].lower()
+                if origin is None:
+                    origin = fields[0].lower() if rtype == b'soa' else b''
+                    if info is not None:
+                        info['origin'] = origin
+                if rtype != b'ns':
+                    continue
+                owner = fields[0].lower()
+                if owner == origin:
+                    continue
+                record = owner + b'\t' + fields[4].rstrip().lower()
+                run.append(record)
+                run_size += len(record) + LINE_OVERHEAD
+                if run_size > max_memory:
+                    runs.append(spill(run, work_dir))
+                    run = []
+                    run_size = 0
+        run.sort()
+        if not runs:
+            yield from run
+            return
+        runs.append(spill(run, work_dir))
+        run = []
+        run_fds = [open(run_name, 'rb') for run_name in runs]
+        try:
+            for record in heapq.merge(*run_fds):
+                yield record[:-1]
+        finally:
+            for run_fd in run_fds:
+                run_fd.close()
+    finally:
+        for run_name in runs:
+            os.remove(run_name)
+
+
+def spill(run, work_dir):
+    """ Sort a run and write it to a file in work_dir, one record per line
+    """
+    run.sort()
+    run_fd, run_name = tempfile.mkstemp(prefix='run-', dir=work_dir)
+    with os.fdopen(run_fd, 'wb', 1024*1024) as out_fd:
+        for record in run:
+            out_fd.write(record + b'\n')
+    return run_name
+
+
+def delegations(in_name, work_dir, max_memory, info=None):
+    """ Yield (name, name servers) for every delegation in the zone file, sorted by name.
+        The name servers are a sorted tuple without duplicates.
+    """
+    # '\t' sorts before any character of a name, so the records of a name are never
+    # interleaved with those of a longer name that starts with it
+    records = (record.split(b'\t', 1) for record in sorted_ns_records(in_name, work_dir, max_memory, info))
+    for name, group in itertools.groupby(records, key=lambda record: record[0]):
+        yield name, tuple(dict.fromkeys(ns for owner, ns in group))
+
+
+def diff_zone(zone_name, old_name, new_name, out_dir, max_memory=256*1024*1024):
+    """ Diff the delegations of a zone between two zone files and write the added, removed
+        and changed delegations to out_dir. Returns the counts.
+    """
+    started = time.monotonic()
+    work_dir = tempfile.mkdtemp(prefix='.zonediff-', dir=out_dir)
+    outputs = dict((kind, os.path.join(out_dir, '{}.{}'.format(zone_name, kind)))
+                   for kind in ('added', 'removed', 'changed'))
+    counts = {'zone': zone_name, 'old': 0, 'new': 0, 'added': 0, 'removed': 0, 'changed': 0}
+    out_fds = {}
+    try:
+        for kind, out_name in outputs.items():
+            out_fds[kind] = open(out_name + '.tmp', 'wb', 1024*1024)
+        # both streams hold their last run in memory while they are merged
+        old = delegations(old_name, work_dir, max_memory // 2)
+        new = delegations(new_name, work_dir, max_memory // 2)
+        old_entry = next(old, None)
+        new_entry = next(new, None)
+        while old_entry is not None or new_entry is not None:
+            if new_entry is None or (old_entry is not None and old_entry[0] < new_entry[0]):
+                out_fds['removed'].write(old_entry[0] + b'\t' + b' '.join(old_entry[1]) + b'\n')
+                counts['removed'] += 1
+                counts['old'] += 1
+                old_entry = next(old, None)
+            elif old_entry is None or new_entry[0] < old_entry[0]:
+                out_fds['added'].write(new_entry[0] + b'\t' + b' '.join(new_entry[1]) + b'\n')
+                counts['added'] += 1
+                counts['new'] += 1
+                new_entry = next(new, None)
+            else:
+                if old_entry[1] != new_entry[1]:
+                    out_fds['changed'].write(old_entry[0] + b'\t' + b' '.join(old_entry[1]) + b'\t' +
+                                             b' '.join(new_entry[1]) + b'\n')
+                    counts['changed'] += 1
+                counts['old'] += 1
+                counts['new'] += 1
+                old_entry = next(old, None)
+                new_entry = next(new, None)
+        for kind, out_fd in out_fds.items():
+            out_fd.close()
+            os.replace(outputs[kind] + '.tmp', outputs[kind])
+    finally:
+        for kind, out_fd in out_fds.items():
+            out_fd.close()
+            if os.path.exists(outputs[kind] + '.tmp'):
+                os.remove(outputs[kind] + '.tmp')
+        shutil.rmtree(work_dir, ignore_errors=True)
+    counts['seconds'] = round(time.monotonic() - started, 3)
+    return counts
+
+
+def zone_files(directory):
+    """ {zone name: path} of the zone files in a download folder
+    """
+    return dict((file_name[:-3], os.path.join(directory, file_name)) for file_name in os.listdir(directory)
+                if file_name.endswith('.gz'))
+
+
+def diff_days(old_dir, new_dir, out_dir=None, workers=None, max_memory=256*1024*1024, zones=None):
+    """ Diff all zones that are in both download folders, with a pool of worker processes
+        of max_memory bytes each. Zones missing from either folder are not diffed, as a
+        zone that failed to download would otherwise show up as entirely added or removed.
+        Writes and returns the summary of the diff.
+    """
+    out_dir = out_dir or os.path.join(new_dir, 'diff')
+    os.makedirs(out_dir, exist_ok=True)
+    old_zones = zone_files(old_dir)
+    new_zones = zone_files(new_dir)
+    if zones:
+        old_zones = dict((zone_name, path) for zone_name, path in old_zones.items() if zone_name in zones)
+        new_zones = dict((zone_name, path) for zone_name, path in new_zones.items() if zone_name in zones)
+    summary = {'old': os.path.abspath(old_dir), 'new': os.path.abspath(new_dir),
+               'missing_old': sorted(set(new_zones) - set(old_zones)),
+               'missing_new': sorted(set(old_zones) - set(new_zones)),
+               'zones': {}, 'failed': {}}
+    # biggest zones first, so a big zone does not start last and hold up the end of the run
+    common = sorted(set(old_zones) & set(new_zones), key=lambda zone_name: -os.path.getsize(new_zones[zone_name]))
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        jobs = dict((pool.submit(diff_zone, zone_name, old_zones[zone_name], new_zones[zone_name], out_dir,
+                                 max_memory), zone_name) for zone_name in common)
+        for job in as_completed(jobs):
+            try:
+                summary['zones'][jobs[job]] = job.result()
+            except (zoneparse.ZoneParseError, OSError) as e:
+                summary['failed'][jobs[job]] = str(e)
+    for kind in ('added', 'removed', 'changed'):
+        summary[kind] = sum(counts[kind] for counts in summary['zones'].values())
+    with open(os.path.join(out_dir, 'diff.json.tmp'), 'w') as out_fd:
+        json.dump(summary, out_fd, indent=1, sort_keys=True)
+    os.replace(os.path.join(out_dir, 'diff.json.tmp'), os.path.join(out_dir, 'diff.json'))
+    return summary
+
+
+def previous_day(output_directory, day):
+    """ The latest YYYY-MM-DD download folder in output_directory before day, or None
+    """
+    days = []
+    for name in os.listdir(output_directory):
+        try:
+            time.strptime(name, '%Y-%m-%d')
+        except ValueError:
+            continue
+        if name < day and os.path.isdir(os.path.join(output_directory, name)):
+            days.append(name)
+    return os.path.join(output_directory, max(days)) if days else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Diff the delegations of the zones in two download folders')
+    parser.add_argument('old_dir', help='download folder of the earlier day')
+    parser.add_argument('new_dir', help='download folder of the later day')
+    parser.add_argument('-o', '--output-directory', type=str, help='where to write the diff (default: new_dir/diff)')
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--max-memory', type=int, default=256, help='memory ceiling per worker in MiB')
+    parser.add_argument('--zones', type=str, help='comma separated zones to diff (default: all)')
+    args = parser.parse_args()
+
+    summary = diff_days(args.old_dir, args.new_dir, args.output_directory, args.workers,
+                        args.max_memory * 1024 * 1024, args.zones.split(',') if args.zones else None)
+    for zone_name, counts in sorted(summary['zones'].items()):
+        print('{}: {} added, {} removed, {} changed in {} s'
+              .format(zone_name, counts['added'], counts['removed'], counts['changed'], counts['seconds']))
+    for zone_name, error in sorted(summary['failed'].items()):
+        print('{}: failed ({})'.format(zone_name, error))
+    print('Total: {} added, {} removed, {} changed'.format(summary['added'], summary['removed'], summary['changed']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8
+""" Memory-mapped index of the delegations in the downloaded zones, to answer "is this
+    domain delegated, and to which name servers" without decompressing any zone file.
+
+    Every zone gets its own index file, so the index of a day grows zone by zone while the
+    downloads go on. An index file (layout as in zoneparse.write_columns) holds:
+
+        bloom           bytes   Bloom filter over the delegated names
+        names.offsets   uint64  end offset of each name in names.data
+        names.data      bytes   delegated names in byte order, relative to the origin
+        ns.offsets      uint64  end index of the name servers of each name in ns.refs
+        ns.refs         uint32  index into the values table, per name server
+        values.offsets  uint64  end offset of each name server in values.data
+        values.data     bytes   distinct name servers
+
+    A lookup checks the Bloom filter first, so names that are not delegated usually do
+    not touch the name table at all, and otherwise does a binary search on the names.
+"""
+import argparse
+import array
+import hashlib
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import zonediff
+import zoneparse
+
+MAGIC = b'CZDSIDX1'
+VERSION = 1
+
+COLUMNS = [('bloom', 'B'), ('names.offsets', 'Q'), ('names.data', 'B'), ('ns.offsets', 'Q'), ('ns.refs', 'I'),
+           ('values.offsets', 'Q'), ('values.data', 'B')]
+
+
+def bloom_positions(key, bits, hashes):
+    """ Bit positions of key in a Bloom filter, by double hashing one BLAKE2b digest
+    """
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+def build_zone_index(in_name, out_name, zone_name=None, max_memory=256*1024*1024, bits_per_name=10,
+                     max_interned=1 << 20):
+    """ Build the index file out_name for the gzip-compressed zone file in_name and return
+        a summary. Delegations are sorted with the external sort of zonediff, within
+        max_memory bytes.
+    """
+    started = time.monotonic()
+    spill_dir = tempfile.mkdtemp(prefix='.zoneindex-', dir=os.path.dirname(os.path.abspath(out_name)))
+    try:
+        names = zoneparse.StringTable(os.path.join(spill_dir, 'names.data'),
+                                      os.path.join(spill_dir, 'names.offsets'))
+        values = zoneparse.StringTable(os.path.join(spill_dir, 'values.data'),
+                                       os.path.join(spill_dir, 'values.offsets'))
+        interned = {}
+        info = {}
+        # zone files without an SOA record are named after their zone by CZDS (<tld>.zone)
+        origin = zone_name[:-len('.zone')].lower().encode() + b'.' if (zone_name or '').endswith('.zone') else b''
+        suffix = None
+        refs = 0
+        ns_offsets = array.array('Q')
+        ns_refs = array.array('I')
+        with open(os.path.join(spill_dir, 'ns.offsets'), 'wb') as ns_offsets_fd, \
+                open(os.path.join(spill_dir, 'ns.refs'), 'wb') as ns_refs_fd:
+            for name, servers in zonediff.delegations(in_name, spill_dir, max_memory, info):
+                if suffix is None:
+                    origin = info['origin'] or origin
+                    suffix = b'.' + origin if origin else b''
+                names.add(name[:-len(suffix)] if suffix and name.endswith(suffix) else name)
+                for server in servers:
+                    index = interned.get(server)
+                    if index is None:
+                        index = values.add(server)
+                        if len(interned) < max_interned:
+                            interned[server] = index
+                    ns_refs.append(index)
+                refs += len(servers)
+                ns_offsets.append(refs)
+                if len(ns_offsets) >= 65536:
+                    ns_offsets.tofile(ns_offsets_fd)
+                    ns_refs.tofile(ns_refs_fd)
+                    ns_offsets = array.array('Q')
+                    ns_refs = array.array('I')
+                    names.flush()
+                    values.flush()
+            ns_offsets.tofile(ns_offsets_fd)
+            ns_refs.tofile(ns_refs_fd)
+        names.close()
+        values.close()
+        interned = None
+
+        # the number of names is known now, so size the filter for about 1% false positives
+        bits = max(64, names.count * bits_per_name + 7) // 8 * 8
+        hashes = max(1, round(bits / max(names.count, 1) * math.log(2)))
+        bloom = bytearray(bits // 8)
+        suffix = b'.' + origin if origin else b''
+        with open(os.path.join(spill_dir, 'names.data'), 'rb') as data_fd, \
+                open(os.path.join(spill_dir, 'names.offsets'), 'rb') as offsets_fd:
+            start = 0
+            for block in iter(lambda: offsets_fd.read(8 * 65536), b''):
+                ends = array.array('Q', block)
+                data = data_fd.read(ends[-1] - start)
+                base = start
+                for end in ends:
+                    for position in bloom_positions(data[start - base:end - base] + suffix, bits, hashes):
+                        bloom[position >> 3] |= 1 << (position & 7)
+                    start = end
+        with open(os.path.join(spill_dir, 'bloom'), 'wb') as bloom_fd:
+            bloom_fd.write(bloom)
+        bloom = None
+
+        header = {'version': VERSION, 'zone': zone_name, 'origin': origin.decode(), 'names': names.count,
+                  'values': values.count, 'refs': refs, 'bloom_bits': bits, 'bloom_hashes': hashes,
+                  'byteorder': sys.byteorder}
+        zoneparse.write_columns(out_name, MAGIC, header, spill_dir, COLUMNS)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    return {'names': names.count, 'values': values.count, 'size': os.path.getsize(out_name),
+            'seconds': round(time.monotonic() - started, 3)}
+
+
+class ZoneIndexFile(zoneparse.MappedColumns):
+    """ Lookups in the index file of one zone
+    """
+    MAGIC = MAGIC
+    VERSION = VERSION
+
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        self.origin = self.header['origin'].encode()
+        self.suffix = b'.' + self.origin if self.origin else b''
+        self.bits = self.header['bloom_bits']
+        self.hashes = self.header['bloom_hashes']
+        self.bloom = self.column('bloom')
+        self.name_offsets = self.column('names.offsets')
+        self.name_data = self.column('names.data')
+        self.ns_offsets = self.column('ns.offsets')
+        self.ns_refs = self.column('ns.refs')
+        self.value_offsets = self.column('values.offsets')
+        self.value_data = self.column('values.data')
+
+    def __len__(self):
+        return self.header['names']
+
+    def might_contain(self, name):
+        bloom = self.bloom
+        for position in bloom_positions(name, self.bits, self.hashes):
+            if not bloom[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def name(self, index):
+        """ Absolute name number index, as bytes
+        """
+        return bytes(self.name_data[self.name_offsets[index]:self.name_offsets[index + 1]]) + self.suffix
+
+    def find(self, name):
+        """ Index of the delegation of the absolute name (lower case bytes, with the trailing
+            dot), or -1
+        """
+        if not self.might_contain(name):
+            return -1
+        lo = 0
+        hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self) and self.name(lo) == name else -1
+
+    def servers(self, index):
+        values = []
+        for ref in self.ns_refs[self.ns_offsets[index]:self.ns_offsets[index + 1]]:
+            values.append(bytes(self.value_data[self.value_offsets[ref]:self.value_offsets[ref + 1]]).decode())
+        return values
+
+    def lookup(self, name):
+        """ (delegated name, name servers) of the closest delegation in this zone that covers
+            the absolute name, or None
+        """
+        while name.endswith(self.suffix) and len(name) > len(self.suffix):
+            index = self.find(name)
+            if index >= 0:
+                return name.decode(), self.servers(index)
+            name = name.split(b'.', 1)[1]
+        return None
+
+
+class ZoneIndex(object):
+    """ Lookups across the index files of all zones in a download folder. Index files are
+        opened on first use; refresh() picks up the ones written since.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.zones = {}
+        self.open_files = {}
+        self.refresh()
+
+    def refresh(self):
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith('.idx'):
+                continue
+            path = os.path.join(self.directory, file_name)
+            mtime = os.stat(path).st_mtime
+            entry = self.zones.get(path)
+            if entry and entry[1] == mtime:
+                continue
+            try:
+                origin = ZoneIndexFile.read_header(path)['origin'].encode()
+            except (zoneparse.ZoneParseError, ValueError, OSError):
+                continue
+            self.zones[path] = (origin, mtime)
+            if path in self.open_files:
+                self.open_files.pop(path).close()
+        self.by_origin = dict((origin, path) for path, (origin, mtime) in self.zones.items())
+
+    def close(self):
+        for index_file in self.open_files.values():
+            index_file.close()
+        self.open_files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def lookup(self, domain):
+        """ (delegated name, name servers) of the delegation that covers domain, or None if
+            it is not delegated in any of the zones
+        """
+        name = domain.lower().rstrip('.').encode() + b'.'
+        # the zone with the longest origin that name is in
+        labels = name.split(b'.')
+        for i in range(1, len(labels) - 1):
+            path = self.by_origin.get(b'.'.join(labels[i:]))
+            if path is not None:
+                if path not in self.open_files:
+                    self.open_files[path] = ZoneIndexFile(path)
+                return self.open_files[path].lookup(name)
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and query indexes of the delegations in zone files')
+    commands = parser.add_subparsers(dest='command')
+    build = commands.add_parser('build', help='build the index files of gzip-compressed zone files')
+    build.add_argument('zone_files', nargs='+')
+    build.add_argument('--max-memory', type=int, default=256, help='memory ceiling for sorting in MiB')
+    lookup = commands.add_parser('lookup', help='look up domains in the index files of a download folder')
+    lookup.add_argument('directory')
+    lookup.add_argument('domains', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        for file_name in args.zone_files:
+            out_name = (file_name[:-3] if file_name.endswith('.gz') else file_name) + '.idx'
+            summary = build_zone_index(file_name, out_name, os.path.basename(out_name)[:-4],
+                                       args.max_memory * 1024 * 1024)
+            print('{}: {} delegations, {} name servers, {} bytes in {} s'
+                  .format(out_name, summary['names'], summary['values'], summary['size'], summary['seconds']))
+    elif args.command == 'lookup':
+        with ZoneIndex(args.directory) as index:
+            for domain in args.domains:
+                started = time.perf_counter()
+                result = index.lookup(domain)
+                micros = (time.perf_counter() - started) * 1e6
+                if result:
+                    print('{}: delegated as {} to {} ({:.0f} us)'.format(domain, result[0], ' '.join(result[1]),
+                                                                         micros))
+                else:
+                    print('{}: not delegated ({:.0f} us)'.format(domain, micros))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
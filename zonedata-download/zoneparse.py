@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8
+""" Parse gzip-compressed CZDS zone files into a compact columnar file that can be
+    memory-mapped by analytics code.
+
+    The zone file is decompressed and parsed in a single pass with bounded memory: columns
+    are spilled to disk every chunk of input and put together into one file at the end.
+
+    Layout of a columns file (all integers in the byte order given in the header):
+
+        b'CZDSCOL1' | header length (uint32) | JSON header | columns, each aligned to 8 bytes
+
+    The header gives the offset, length and array typecode of every column:
+
+        owner           uint32  index into the names table
+        ttl             uint32
+        rclass          uint16  DNS class code
+        rtype           uint16  DNS type code (codes of unknown mnemonics are in the header)
+        rdata           uint32  index into the values table
+        names.offsets   uint64  end offset of each owner name in names.data
+        names.data      bytes   owner names, relative to the origin of the zone
+        values.offsets  uint64  end offset of each rdata value in values.data
+        values.data     bytes   rdata values
+
+    Owner names are interned by run: CZDS zone files are sorted, so all records of an
+    owner are next to each other. Rdata values (name servers, mostly) are interned in a
+    dictionary of bounded size.
+"""
+import argparse
+import array
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+MAGIC = b'CZDSCOL1'
+VERSION = 1
+
+RR_TYPES = {b'a': 1, b'ns': 2, b'cname': 5, b'soa': 6, b'ptr': 12, b'hinfo': 13, b'mx': 15, b'txt': 16,
+            b'rp': 17, b'aaaa': 28, b'loc': 29, b'srv': 33, b'naptr': 35, b'dname': 39, b'ds': 43,
+            b'sshfp': 44, b'rrsig': 46, b'nsec': 47, b'dnskey': 48, b'nsec3': 50, b'nsec3param': 51,
+            b'tlsa': 52, b'smimea': 53, b'cds': 59, b'cdnskey': 60, b'openpgpkey': 61, b'csync': 62,
+            b'zonemd': 63, b'svcb': 64, b'https': 65, b'caa': 257}
+RR_CLASSES = {b'in': 1, b'ch': 3, b'hs': 4}
+# codes handed out to mnemonics we do not know, from the private use range
+PRIVATE_TYPES = 65280
+
+COLUMNS = [('owner', 'I'), ('ttl', 'I'), ('rclass', 'H'), ('rtype', 'H'), ('rdata', 'I'),
+           ('names.offsets', 'Q'), ('names.data', 'B'), ('values.offsets', 'Q'), ('values.data', 'B')]
+
+if array.array('I').itemsize != 4:
+    raise ImportError('zoneparse needs a platform with 32 bit unsigned ints')
+
+
+class ZoneParseError(Exception):
+    pass
+
+
+class StringTable(object):
+    """ Table of byte strings, written to a data file and an offsets file as it grows
+    """
+    def __init__(self, data_name, offsets_name):
+        self.data_fd = open(data_name, 'wb')
+        self.offsets_fd = open(offsets_name, 'wb')
+        self.pieces = []
+        self.offsets = array.array('Q')
+        self.size = 0
+        self.count = 0
+
+    def add(self, value):
+        self.pieces.append(value)
+        self.size += len(value)
+        self.offsets.append(self.size)
+        self.count += 1
+        return self.count - 1
+
+    def flush(self):
+        self.data_fd.write(b''.join(self.pieces))
+        self.offsets.tofile(self.offsets_fd)
+        self.pieces = []
+        self.offsets = array.array('Q')
+
+    def close(self):
+        self.flush()
+        self.data_fd.close()
+        self.offsets_fd.close()
+
+
+class ZoneColumnsWriter(object):
+    """ Collects the records of one zone into spill files next to out_name, and writes
+        the columns file when closed
+    """
+    def __init__(self, out_name, zone_name=None, max_interned=1 << 20):
+        self.out_name = out_name
+        self.zone_name = zone_name
+        self.max_interned = max_interned
+        self.spill_dir = tempfile.mkdtemp(prefix='.zoneparse-', dir=os.path.dirname(os.path.abspath(out_name)))
+        self.columns = dict((name, array.array(typecode)) for name, typecode in COLUMNS[:5])
+        self.spill_fds = dict((name, open(os.path.join(self.spill_dir, name), 'wb')) for name in self.columns)
+        self.names = StringTable(os.path.join(self.spill_dir, 'names.data'),
+                                 os.path.join(self.spill_dir, 'names.offsets'))
+        self.values = StringTable(os.path.join(self.spill_dir, 'values.data'),
+                                  os.path.join(self.spill_dir, 'values.offsets'))
+        self.interned = {}
+        self.types = dict(RR_TYPES)
+        self.classes = dict(RR_CLASSES)
+        self.origin = None
+        self.suffix = None
+        self.last_owner = None
+        self.owner_index = 0
+        self.records = 0
+        self.skipped = 0
+
+    def type_code(self, mnemonic):
+        """ Code for a type mnemonic not in the table: upper case, TYPEnnn or unknown
+        """
+        lower = mnemonic.lower()
+        if lower not in self.types:
+            if lower.startswith(b'type') and lower[4:].isdigit():
+                self.types[lower] = int(lower[4:])
+            else:
+                self.types[lower] = PRIVATE_TYPES + len([code for code in self.types.values()
+                                                         if code >= PRIVATE_TYPES])
+        self.types[mnemonic] = self.types[lower]
+        return self.types[lower]
+
+    def class_code(self, mnemonic):
+        lower = mnemonic.lower()
+        if lower not in self.classes:
+            if lower.startswith(b'class') and lower[5:].isdigit():
+                self.classes[lower] = int(lower[5:])
+            else:
+                raise ValueError('unknown class')
+        self.classes[mnemonic] = self.classes[lower]
+        return self.classes[lower]
+
+    def add_lines(self, lines):
+        """ Parse a batch of complete lines into the columns. This is the hot loop, so
+            everything it uses is looked up once.
+        """
+        owners, ttls, rclasses, rtypes, rdatas = [self.columns[name] for name, typecode in COLUMNS[:5]]
+        types = self.types
+        classes = self.classes
+        interned = self.interned
+        add_name = self.names.add
+        add_value = self.values.add
+        last_owner = self.last_owner
+        owner_index = self.owner_index
+        records = 0
+        skipped = 0
+        for line in lines:
+            if not line or line[0] in (59, 36):     # blank, ';' comment or '$' directive
+                continue
+            fields = line.split(None, 4)
+            if len(fields) != 5:
+                skipped += 1
+                continue
+            owner, ttl, rclass, rtype, rdata = fields
+            try:
+                ttl = int(ttl)
+                rclass = classes[rclass] if rclass in classes else self.class_code(rclass)
+            except ValueError:
+                skipped += 1
+                continue
+            if self.suffix is None:
+                self.set_origin(owner if rtype.lower() == b'soa' else b'')
+            if owner != last_owner:
+                last_owner = owner
+                if self.suffix and owner.endswith(self.suffix):
+                    owner_index = add_name(owner[:-len(self.suffix)])
+                else:
+                    owner_index = add_name(owner if owner != self.origin else b'@')
+            rdata = rdata.rstrip()
+            value_index = interned.get(rdata)
+            if value_index is None:
+                value_index = add_value(rdata)
+                if len(interned) < self.max_interned:
+                    interned[rdata] = value_index
+            owners.append(owner_index)
+            ttls.append(ttl)
+            rclasses.append(rclass)
+            rtypes.append(types[rtype] if rtype in types else self.type_code(rtype))
+            rdatas.append(value_index)
+            records += 1
+        self.last_owner = last_owner
+        self.owner_index = owner_index
+        self.records += records
+        self.skipped += skipped
+        self.spill()
+
+    def set_origin(self, origin):
+        """ Owner names are stored relative to the owner of the SOA record, which comes first
+        """
+        self.origin = origin.lower()
+        self.suffix = b'.' + self.origin if self.origin else b''
+
+    def spill(self):
+        for name, column in self.columns.items():
+            column.tofile(self.spill_fds[name])
+            self.columns[name] = array.array(column.typecode)
+        self.names.flush()
+        self.values.flush()
+
+    def close(self):
+        """ Put the spilled columns together into the columns file
+        """
+        self.spill()
+        for spill_fd in self.spill_fds.values():
+            spill_fd.close()
+        self.names.close()
+        self.values.close()
+
+        header = {'version': VERSION, 'zone': self.zone_name, 'origin': (self.origin or b'').decode(),
+                  'records': self.records, 'names': self.names.count, 'values': self.values.count,
+                  'skipped': self.skipped, 'byteorder': sys.byteorder,
+                  'types': dict((mnemonic.decode(), code) for mnemonic, code in self.types.items()
+                                if mnemonic == mnemonic.lower()),
+                  'classes': dict((mnemonic.decode(), code) for mnemonic, code in self.classes.items()
+                                  if mnemonic == mnemonic.lower())}
+        try:
+            return write_columns(self.out_name, MAGIC, header, self.spill_dir, COLUMNS)
+        finally:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def abort(self):
+        for spill_fd in self.spill_fds.values():
+            spill_fd.close()
+        self.names.data_fd.close()
+        self.names.offsets_fd.close()
+        self.values.data_fd.close()
+        self.values.offsets_fd.close()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+
+def align(offset):
+    return -(-offset // 8) * 8
+
+
+def write_columns(out_name, magic, header, spill_dir, columns):
+    """ Put the columns spilled to files in spill_dir together into out_name, after magic
+        and header. columns is a list of (name, array typecode); the offsets tables (names
+        ending in .offsets) get a leading 0, so entry i is offsets[i]:offsets[i + 1].
+        Returns the header, with the layout of the columns added.
+    """
+    sizes = dict((name, os.path.getsize(os.path.join(spill_dir, name)) + (8 if name.endswith('.offsets') else 0))
+                 for name, typecode in columns)
+    header = dict(header, columns={})
+    # the header holds the offsets of the columns, which depend on the length of the header
+    header_size = 0
+    while True:
+        offset = align(len(magic) + 4 + header_size)
+        for name, typecode in columns:
+            header['columns'][name] = {'offset': offset, 'length': sizes[name], 'typecode': typecode}
+            offset = align(offset + sizes[name])
+        header_data = json.dumps(header, sort_keys=True).encode()
+        if len(header_data) <= header_size:
+            break
+        header_size = len(header_data)
+    header_data = header_data.ljust(header_size)
+
+    tmp_name = '{}.{}.tmp'.format(out_name, os.getpid())
+    try:
+        with open(tmp_name, 'wb') as out_fd:
+            out_fd.write(magic + struct.pack('=I', header_size) + header_data)
+            for name, typecode in columns:
+                out_fd.write(b'\0' * (header['columns'][name]['offset'] - out_fd.tell()))
+                if name.endswith('.offsets'):
+                    out_fd.write(struct.pack('=Q', 0))
+                with open(os.path.join(spill_dir, name), 'rb') as spill_fd:
+                    shutil.copyfileobj(spill_fd, out_fd, 1024*1024)
+        os.replace(tmp_name, out_name)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+    return header
+
+
+def zone_lines(in_name, chunk_size=1024*1024):
+    """ Decompress the gzip-compressed zone file in_name and yield its lines in batches,
+        one batch per chunk of input. Raises ZoneParseError if the file is not a complete
+        gzip stream.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = b''
+    try:
+        with open(in_name, 'rb') as in_fd:
+            for data in iter(lambda: in_fd.read(chunk_size), b''):
+                text = decompressor.decompress(data)
+                # zone files may consist of several gzip members
+                while decompressor.eof and decompressor.unused_data:
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    text += decompressor.decompress(data)
+                lines = (pending + text).split(b'\n')
+                pending = lines.pop()
+                yield lines
+    except zlib.error as e:
+        raise ZoneParseError("'{}' is not a valid gzip file ({})".format(in_name, e))
+    if not decompressor.eof:
+        raise ZoneParseError("'{}' is truncated".format(in_name))
+    yield [pending]
+
+
+def parse_zone_file(in_name, out_name, zone_name=None, chunk_size=1024*1024, max_interned=1 << 20):
+    """ Parse the gzip-compressed zone file in_name into the columns file out_name and
+        return a summary of the parse. Raises ZoneParseError if the file is not a
+        complete gzip stream.
+    """
+    started = time.monotonic()
+    writer = ZoneColumnsWriter(out_name, zone_name, max_interned)
+    try:
+        for lines in zone_lines(in_name, chunk_size):
+            writer.add_lines(lines)
+    except BaseException:
+        writer.abort()
+        raise
+    header = writer.close()
+    return {'records': header['records'], 'names': header['names'], 'values': header['values'],
+            'skipped': header['skipped'], 'size': os.path.getsize(out_name),
+            'seconds': round(time.monotonic() - started, 3)}
+
+
+class MappedColumns(object):
+    """ Read access to a file written by write_columns. The columns are memoryviews on a
+        shared mmap of the file, so opening even a large file is instant and pages are
+        read as they are used.
+    """
+    MAGIC = None
+    VERSION = None
+
+    @classmethod
+    def read_header(cls, file_name):
+        """ Header of a file, without mapping it
+        """
+        with open(file_name, 'rb') as in_fd:
+            start = in_fd.read(len(cls.MAGIC) + 4)
+            if len(start) < len(cls.MAGIC) + 4 or start[:len(cls.MAGIC)] != cls.MAGIC:
+                raise ZoneParseError("'{}' is not a {} file".format(file_name, cls.MAGIC.decode()))
+            header_size, = struct.unpack_from('=I', start, len(cls.MAGIC))
+            return json.loads(in_fd.read(header_size).decode())
+
+    def __init__(self, file_name):
+        with open(file_name, 'rb') as in_fd:
+            self.mmap = mmap.mmap(in_fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = []
+        if self.mmap[:len(self.MAGIC)] != self.MAGIC:
+            self.mmap.close()
+            raise ZoneParseError("'{}' is not a {} file".format(file_name, self.MAGIC.decode()))
+        header_size, = struct.unpack_from('=I', self.mmap, len(self.MAGIC))
+        self.header = json.loads(self.mmap[len(self.MAGIC) + 4:len(self.MAGIC) + 4 + header_size].decode())
+        if self.header['version'] != self.VERSION or self.header['byteorder'] != sys.byteorder:
+            self.mmap.close()
+            raise ZoneParseError("'{}' was written by an incompatible version or platform".format(file_name))
+        self.view = memoryview(self.mmap)
+
+    def column(self, name):
+        entry = self.header['columns'][name]
+        view = self.view[entry['offset']:entry['offset'] + entry['length']]
+        if entry['typecode'] != 'B':
+            self.views.append(view)
+            view = view.cast(entry['typecode'])
+        self.views.append(view)
+        return view
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for view in reversed(self.views):
+            view.release()
+        self.view.release()
+        self.mmap.close()
+
+
+class ZoneColumns(MappedColumns):
+    """ Read access to a columns file written by parse_zone_file
+    """
+    MAGIC = MAGIC
+    VERSION = VERSION
+
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        self.type_names = dict((code, mnemonic) for mnemonic, code in self.header['types'].items())
+        self.class_names = dict((code, mnemonic) for mnemonic, code in self.header['classes'].items())
+        self.origin = self.header['origin']
+        self.owner = self.column('owner')
+        self.ttl = self.column('ttl')
+        self.rclass = self.column('rclass')
+        self.rtype = self.column('rtype')
+        self.rdata = self.column('rdata')
+        self.name_offsets = self.column('names.offsets')
+        self.name_data = self.column('names.data')
+        self.value_offsets = self.column('values.offsets')
+        self.value_data = self.column('values.data')
+
+    def __len__(self):
+        return self.header['records']
+
+    def name(self, index):
+        """ Absolute owner name number index
+        """
+        name = bytes(self.name_data[self.name_offsets[index]:self.name_offsets[index + 1]]).decode()
+        if name == '@':
+            return self.origin
+        return '{}.{}'.format(name, self.origin) if self.origin else name
+
+    def value(self, index):
+        return bytes(self.value_data[self.value_offsets[index]:self.value_offsets[index + 1]]).decode()
+
+    def type_code(self, mnemonic):
+        return self.header['types'][mnemonic.lower()]
+
+    def records(self):
+        """ Yield all records as (owner, ttl, class, type, rdata) tuples of str and int
+        """
+        for i in range(len(self)):
+            yield (self.name(self.owner[i]), self.ttl[i], self.class_names.get(self.rclass[i]),
+                   self.type_names.get(self.rtype[i]), self.value(self.rdata[i]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parse gzip-compressed zone files into columns files')
+    parser.add_argument('zone_files', nargs='+', help='gzip-compressed zone files')
+    parser.add_argument('-o', '--output-directory', type=str,
+                        help='where to write the columns files (default: next to the zone files)')
+    parser.add_argument('--info', action='store_true', help='print the header of existing columns files instead')
+    args = parser.parse_args()
+
+    for file_name in args.zone_files:
+        if args.info:
+            with ZoneColumns(file_name) as columns:
+                header = dict(columns.header)
+                del header['columns']
+                print(json.dumps(header, indent=1, sort_keys=True))
+            continue
+        zone_name = os.path.basename(file_name)
+        if zone_name.endswith('.gz'):
+            zone_name = zone_name[:-3]
+        out_name = os.path.join(args.output_directory or os.path.dirname(file_name), zone_name + '.cols')
+        summary = parse_zone_file(file_name, out_name, zone_name)
+        print('{}: {} records, {} owner names, {} distinct values, {} bytes in {} s'
+              .format(out_name, summary['records'], summary['names'], summary['values'], summary['size'],
+                      summary['seconds']))
+
+
+if __name__ == "__main__":
+    main()